@@ -0,0 +1,52 @@
+import time
+from collections import defaultdict
+from typing import Callable, Dict, Iterator, List
+
+
+class PhaseProfiler:
+    """Accumulates the CPU time of the thread spent in each phase of the LLM call path.
+
+    The phases are functions wrapped by `wrap`. They may nest, e.g., the function call templating is called by the
+    preprocessing, and the time of a phase excludes the time of the phases called by it. The phases that return an
+    iterator, e.g., the streamed output of the model, are timed over each step of the iteration.
+    """
+
+    def __init__(self):
+        self.cpu_time: Dict[str, float] = defaultdict(float)
+        self.num_calls: Dict[str, int] = defaultdict(int)
+        # The CPU time of the nested phases of each of the currently running phases
+        self._stack: List[float] = []
+
+    def reset(self):
+        self.cpu_time.clear()
+        self.num_calls.clear()
+
+    def wrap(self, name: str, fn: Callable, iterator: bool = False) -> Callable:
+
+        def wrapped(*args, **kwargs):
+            if iterator:
+                return self._wrap_iterator(name, self._timed(name, fn, args, kwargs))
+            return self._timed(name, fn, args, kwargs)
+
+        return wrapped
+
+    def _timed(self, name: str, fn: Callable, args, kwargs):
+        self._stack.append(0.0)
+        start = time.thread_time()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            elapsed = time.thread_time() - start
+            nested = self._stack.pop()
+            self.cpu_time[name] += elapsed - nested
+            self.num_calls[name] += 1
+            if self._stack:
+                self._stack[-1] += elapsed
+
+    def _wrap_iterator(self, name: str, it: Iterator) -> Iterator:
+        while True:
+            try:
+                item = self._timed(name, next, (it,), {})
+            except StopIteration:
+                return
+            yield item
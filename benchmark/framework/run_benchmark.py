@@ -0,0 +1,167 @@
+"""Measure the CPU time that qwen-agent spends on the LLM call path, against the mock LLM.
+
+Usage (qwen-agent must be importable, e.g., installed with `pip install -e .` or found through PYTHONPATH):
+    git checkout main && PYTHONPATH=../.. python run_benchmark.py -o base.json
+    git checkout my-branch && PYTHONPATH=../.. python run_benchmark.py --compare base.json
+"""
+import argparse
+import itertools
+import json
+import platform
+import statistics
+import sys
+import time
+
+from profiler import PhaseProfiler
+from scenarios import build_functions, build_history, build_llm_cfg
+
+import qwen_agent
+import qwen_agent.llm.base as llm_base
+from qwen_agent.llm import get_chat_model
+from qwen_agent.utils.utils import close_iterator
+
+PHASES = ('preprocess', 'truncation', 'fncall_templating', 'model', 'postprocess', 'fncall_parsing', 'text_format',
+          'conversion')
+
+
+def instrument(llm, profiler: PhaseProfiler):
+    """Wrap the phases of `BaseChatModel.chat` of the llm object, and the module-level helpers it calls."""
+    llm._preprocess_messages = profiler.wrap('preprocess', llm._preprocess_messages)
+    llm.fncall_prompt.preprocess_fncall_messages = profiler.wrap('fncall_templating',
+                                                                 llm.fncall_prompt.preprocess_fncall_messages)
+    llm._chat_stream = profiler.wrap('model', llm._chat_stream, iterator=True)
+    llm._chat_no_stream = profiler.wrap('model', llm._chat_no_stream)
+    llm._postprocess_messages = profiler.wrap('postprocess', llm._postprocess_messages)
+    llm.fncall_prompt.postprocess_fncall_messages = profiler.wrap('fncall_parsing',
+                                                                  llm.fncall_prompt.postprocess_fncall_messages)
+    llm._convert_messages_to_target_type = profiler.wrap('conversion', llm._convert_messages_to_target_type)
+
+
+def patch_module_helpers(profiler: PhaseProfiler):
+    llm_base._truncate_input_messages_roughly = profiler.wrap('truncation', llm_base._truncate_input_messages_roughly)
+    llm_base._format_as_text_messages = profiler.wrap('text_format', llm_base._format_as_text_messages)
+
+
+def run_once(llm, messages, functions, stream: bool, profiler: PhaseProfiler) -> dict:
+    profiler.reset()
+    num_chunks = 0
+    start = time.thread_time()
+    if stream:
+        it = llm.chat(messages, functions=functions or None, stream=True)
+        try:
+            for _ in it:
+                num_chunks += 1
+        finally:
+            close_iterator(it)
+    else:
+        llm.chat(messages, functions=functions or None, stream=False)
+        num_chunks = 1
+    total = time.thread_time() - start
+    phases = {name: profiler.cpu_time.get(name, 0.0) for name in PHASES}
+    return {
+        'total': total,
+        'framework': total - phases['model'],
+        'other': total - sum(phases.values()),
+        'num_chunks': num_chunks,
+        **phases,
+    }
+
+
+def run_scenario(mode: str, num_turns: int, num_tools: int, response_tokens: int, repeats: int, min_time: float,
+                 profiler: PhaseProfiler) -> dict:
+    llm = get_chat_model(build_llm_cfg(response_tokens=response_tokens, num_tools=num_tools))
+    instrument(llm, profiler)
+    messages = build_history(num_turns, num_tools)
+    functions = build_functions(num_tools)
+    stream = (mode == 'stream')
+
+    run_once(llm, messages, functions, stream, profiler)  # Warm up the caches, e.g., of the token counts
+    # Run at least `repeats` times and for at least `min_time` seconds, so that the median of the short scenarios
+    # is not dominated by noise
+    runs = []
+    start = time.perf_counter()
+    while len(runs) < repeats or time.perf_counter() - start < min_time:
+        runs.append(run_once(llm, messages, functions, stream, profiler))
+
+    num_chunks = runs[0]['num_chunks']
+    cpu_ms = {k: statistics.median(r[k] for r in runs) * 1000 for k in ('total', 'framework', 'other') + PHASES}
+    return {
+        'name': f'{mode}/history={num_turns}/tools={num_tools}/response={response_tokens}',
+        'params': {
+            'mode': mode,
+            'history_turns': num_turns,
+            'num_tools': num_tools,
+            'response_tokens': response_tokens,
+        },
+        'num_chunks': num_chunks,
+        'num_runs': len(runs),
+        'cpu_ms': {k: round(v, 3) for k, v in cpu_ms.items()},
+        'framework_us_per_chunk': round(cpu_ms['framework'] * 1000 / num_chunks, 1),
+    }
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> bool:
+    """Print the framework CPU time against the baseline. Returns False if any scenario regressed."""
+    baseline_by_name = {s['name']: s for s in baseline['scenarios']}
+    ok = True
+    print(f'{"scenario":<50} {"baseline ms":>12} {"current ms":>12} {"ratio":>7}')
+    for s in results['scenarios']:
+        base = baseline_by_name.get(s['name'])
+        if base is None:
+            continue
+        before, after = base['cpu_ms']['framework'], s['cpu_ms']['framework']
+        ratio = after / before if before > 0 else float('inf')
+        flag = ''
+        if ratio > threshold:
+            flag, ok = '  REGRESSION', False
+        print(f'{s["name"]:<50} {before:>12.3f} {after:>12.3f} {ratio:>7.2f}{flag}')
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--modes', nargs='+', default=['stream', 'nonstream'], choices=['stream', 'nonstream'])
+    parser.add_argument('--history', nargs='+', type=int, default=[1, 10, 50], help='The user turns of the history')
+    parser.add_argument('--tools', nargs='+', type=int, default=[0, 4, 32])
+    parser.add_argument('--response-tokens', nargs='+', type=int, default=[32, 512])
+    parser.add_argument('--repeats', type=int, default=20, help='The minimum number of runs of each scenario')
+    parser.add_argument('--min-time', type=float, default=1.0, help='The minimum seconds spent on each scenario')
+    parser.add_argument('-o', '--output', type=str, default='', help='Write the results to this JSON file')
+    parser.add_argument('--compare', type=str, default='', help='Compare with the results of the base branch')
+    parser.add_argument('--threshold', type=float, default=1.25, help='The ratio to the baseline of a regression')
+    args = parser.parse_args()
+
+    profiler = PhaseProfiler()
+    patch_module_helpers(profiler)
+    scenarios = []
+    for mode, num_turns, num_tools, response_tokens in itertools.product(args.modes, args.history, args.tools,
+                                                                         args.response_tokens):
+        result = run_scenario(mode, num_turns, num_tools, response_tokens, args.repeats, args.min_time, profiler)
+        print(f'{result["name"]:<50} framework {result["cpu_ms"]["framework"]:>9.3f} ms, '
+              f'{result["framework_us_per_chunk"]:>8.1f} us/chunk')
+        scenarios.append(result)
+
+    results = {
+        'meta': {
+            'qwen_agent_version': qwen_agent.__version__,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'processor': platform.processor(),
+            'repeats': args.repeats,
+            'min_time': args.min_time,
+        },
+        'scenarios': scenarios,
+    }
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+            f.write('\n')
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)
+        if not compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
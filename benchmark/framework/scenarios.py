@@ -0,0 +1,58 @@
+import json
+from typing import Dict, List
+
+from qwen_agent.llm.mock import filler_text
+from qwen_agent.llm.schema import ASSISTANT, FUNCTION, USER, FunctionCall, Message
+
+# The tokens of each message in the synthetic history
+HISTORY_MESSAGE_TOKENS = 64
+
+
+def build_functions(num_tools: int) -> List[Dict]:
+    return [{
+        'name': f'tool_{i}',
+        'description': f'Tool number {i}. ' + filler_text(24),
+        'parameters': {
+            'type': 'object',
+            'properties': {
+                'query': {
+                    'type': 'string',
+                    'description': 'The query.'
+                },
+                'limit': {
+                    'type': 'integer',
+                    'description': 'The max number of results.'
+                },
+            },
+            'required': ['query'],
+        },
+    } for i in range(num_tools)]
+
+
+def build_history(num_turns: int, num_tools: int) -> List[Message]:
+    """A conversation of num_turns user messages, where every other turn calls a tool if there are tools."""
+    messages = []
+    for i in range(num_turns):
+        messages.append(Message(USER, f'Question {i}: ' + filler_text(HISTORY_MESSAGE_TOKENS)))
+        if num_tools and i % 2 == 1:
+            arguments = json.dumps({'query': f'question {i}', 'limit': 5})
+            messages.append(Message(ASSISTANT, '', function_call=FunctionCall(name='tool_0', arguments=arguments)))
+            messages.append(Message(FUNCTION, filler_text(HISTORY_MESSAGE_TOKENS), name='tool_0'))
+        if i < num_turns - 1:
+            messages.append(Message(ASSISTANT, filler_text(HISTORY_MESSAGE_TOKENS)))
+    return messages
+
+
+def build_llm_cfg(response_tokens: int, num_tools: int) -> Dict:
+    """A mock LLM without delays, whose response ends with a tool call if there are tools."""
+    response = filler_text(response_tokens)
+    if num_tools:
+        response = {'content': response, 'tool_calls': [{'name': 'tool_0', 'arguments': {'query': 'next'}}]}
+    return {
+        'model': 'mock',
+        'model_type': 'mock',
+        'responses': [response],
+        'generate_cfg': {
+            'fncall_prompt_type': 'nous'
+        },
+    }
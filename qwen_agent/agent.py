@@ -1,17 +1,18 @@
-import copy
 import json
 import traceback
 from abc import ABC, abstractmethod
 from typing import Dict, Iterator, List, Optional, Tuple, Union
 
-from qwen_agent.llm import get_chat_model
+from qwen_agent.llm import get_shared_chat_model
 from qwen_agent.llm.base import BaseChatModel
 from qwen_agent.llm.schema import CONTENT, DEFAULT_SYSTEM_MESSAGE, ROLE, SYSTEM, ContentItem, Message
 from qwen_agent.log import logger
+from qwen_agent.settings import DEBUG_MESSAGE_MUTATION
 from qwen_agent.tools import TOOL_REGISTRY, BaseTool, MCPManager
 from qwen_agent.tools.base import ToolServiceError
 from qwen_agent.tools.simple_doc_parser import DocParserError
-from qwen_agent.utils.utils import has_chinese_messages, merge_generate_cfgs
+from qwen_agent.utils.utils import (CancellationToken, check_messages_unchanged, close_iterator, has_chinese_messages,
+                                    merge_generate_cfgs, snapshot_messages)
 
 
 class Agent(ABC):
@@ -35,12 +36,13 @@ class Agent(ABC):
               such as 'code_interpreter', {'name': 'code_interpreter', 'timeout': 10}, or CodeInterpreter().
             llm: The LLM model configuration or LLM model object.
               Set the configuration as {'model': '', 'api_key': '', 'model_server': ''}.
+              The agents with the same configuration share one LLM object, see `get_shared_chat_model`.
             system_message: The specified system message for LLM chat.
             name: The name of this agent.
             description: The description of this agent, which will be used for multi_agent.
         """
         if isinstance(llm, dict):
-            self.llm = get_chat_model(llm)
+            self.llm = get_shared_chat_model(llm)
         else:
             self.llm = llm
         self.extra_generate_cfg: dict = {}
@@ -70,11 +72,18 @@ class Agent(ABC):
 
         Args:
             messages: A list of messages.
+            cancel_token: Optional. A `CancellationToken` for stopping the run from another thread.
 
         Yields:
             The response generator.
+
+        The token usage of the run, including the nested LLM calls made by tools, memory and sub-agents, can be
+        counted by iterating over the generator in a `qwen_agent.llm.track_usage()` block.
         """
-        messages = copy.deepcopy(messages)
+        cancel_token: Optional[CancellationToken] = kwargs.pop('cancel_token', None)
+        # The input messages are shared rather than deep-copied. Copy a message before modifying it.
+        if DEBUG_MESSAGE_MUTATION:
+            snapshot = snapshot_messages(messages)
         _return_message_type = 'dict'
         new_messages = []
         # Only return dict when all input messages are dict
@@ -86,6 +95,7 @@ class Agent(ABC):
             else:
                 new_messages.append(msg)
                 _return_message_type = 'message'
+        input_msg_ids = {id(msg) for msg in new_messages}
 
         if 'lang' not in kwargs:
             if has_chinese_messages(new_messages):
@@ -100,21 +110,35 @@ class Agent(ABC):
             else:
                 # Already got system message in new_messages
                 if isinstance(new_messages[0][CONTENT], str):
-                    new_messages[0][CONTENT] = self.system_message + '\n\n' + new_messages[0][CONTENT]
+                    new_messages[0] = new_messages[0].shallow_copy(content=self.system_message + '\n\n' +
+                                                                   new_messages[0][CONTENT])
                 else:
                     assert isinstance(new_messages[0][CONTENT], list)
                     assert new_messages[0][CONTENT][0].text
-                    new_messages[0][CONTENT] = [ContentItem(text=self.system_message + '\n\n')
-                                               ] + new_messages[0][CONTENT]  # noqa
-
-        for rsp in self._run(messages=new_messages, **kwargs):
-            for i in range(len(rsp)):
-                if not rsp[i].name and self.name:
-                    rsp[i].name = self.name
-            if _return_message_type == 'message':
-                yield [Message(**x) if isinstance(x, dict) else x for x in rsp]
-            else:
-                yield [x.model_dump() if not isinstance(x, dict) else x for x in rsp]
+                    new_messages[0] = new_messages[0].shallow_copy(
+                        content=[ContentItem(text=self.system_message + '\n\n')] + new_messages[0][CONTENT])
+
+        # Closing the generator returned by `run`, or cancelling the token, closes the running `_run` generator, which
+        # in turn closes the LLM streams and aborts the HTTP requests that are still open.
+        rsp_iter = self._run(messages=new_messages, **kwargs)
+        try:
+            for rsp in rsp_iter:
+                if (cancel_token is not None) and cancel_token.cancelled:
+                    break
+                for i in range(len(rsp)):
+                    if not rsp[i].name and self.name:
+                        if id(rsp[i]) in input_msg_ids:
+                            rsp[i] = rsp[i].shallow_copy(name=self.name)
+                        else:
+                            rsp[i].name = self.name
+                if DEBUG_MESSAGE_MUTATION:
+                    check_messages_unchanged(messages, snapshot, where=f'{type(self).__name__}.run')
+                if _return_message_type == 'message':
+                    yield [Message(**x) if isinstance(x, dict) else x for x in rsp]
+                else:
+                    yield [x.model_dump() if not isinstance(x, dict) else x for x in rsp]
+        finally:
+            close_iterator(rsp_iter)
 
     @abstractmethod
     def _run(self, messages: List[Message], lang: str = 'en', **kwargs) -> Iterator[List[Message]]:
@@ -1,12 +1,12 @@
-import copy
 import datetime
 import json
 from typing import Dict, Iterator, List, Literal, Optional, Union
 
 from qwen_agent.agents.fncall_agent import FnCallAgent
 from qwen_agent.llm import BaseChatModel
-from qwen_agent.llm.schema import CONTENT, DEFAULT_SYSTEM_MESSAGE, ROLE, SYSTEM, ContentItem, Message
+from qwen_agent.llm.schema import CONTENT, DEFAULT_SYSTEM_MESSAGE, ROLE, SYSTEM, USER, ContentItem, Message
 from qwen_agent.log import logger
+from qwen_agent.settings import PROMPT_LAYOUT
 from qwen_agent.tools import BaseTool
 from qwen_agent.utils.utils import get_basename_from_url, print_traceback
 
@@ -82,6 +82,7 @@ class Assistant(FnCallAgent):
                          description=description,
                          files=files,
                          rag_cfg=rag_cfg)
+        self.prompt_layout: Literal['default', 'prefix_cache'] = PROMPT_LAYOUT
 
     def _run(self,
              messages: List[Message],
@@ -104,7 +105,6 @@ class Assistant(FnCallAgent):
                                   lang: Literal['en', 'zh'] = 'en',
                                   knowledge: str = '',
                                   **kwargs) -> List[Message]:
-        messages = copy.deepcopy(messages)
         if not knowledge:
             # Retrieval knowledge from files
             *_, last = self.mem.run(messages=messages, lang=lang, **kwargs)
@@ -123,13 +123,28 @@ class Assistant(FnCallAgent):
         if snippets:
             knowledge_prompt = KNOWLEDGE_TEMPLATE[lang].format(knowledge='\n\n'.join(snippets))
 
+        if knowledge_prompt and (self.prompt_layout == 'prefix_cache'):
+            user_idx = [i for i, msg in enumerate(messages) if msg[ROLE] == USER]
+            if user_idx:
+                # Put the knowledge late, i.e., before the latest question, to keep the prefix stable
+                i = user_idx[-1]
+                usr_msg = messages[i]
+                if isinstance(usr_msg[CONTENT], str):
+                    usr_msg = usr_msg.shallow_copy(content=knowledge_prompt + '\n\n' + usr_msg[CONTENT])
+                else:
+                    usr_msg = usr_msg.shallow_copy(content=[ContentItem(text=knowledge_prompt + '\n\n')] +
+                                                   usr_msg[CONTENT])
+                return messages[:i] + [usr_msg] + messages[i + 1:]
+
         if knowledge_prompt:
             if messages and messages[0][ROLE] == SYSTEM:
-                if isinstance(messages[0][CONTENT], str):
-                    messages[0][CONTENT] += '\n\n' + knowledge_prompt
+                sys_msg = messages[0].shallow_copy()
+                if isinstance(sys_msg[CONTENT], str):
+                    sys_msg[CONTENT] += '\n\n' + knowledge_prompt
                 else:
-                    assert isinstance(messages[0][CONTENT], list)
-                    messages[0][CONTENT] += [ContentItem(text='\n\n' + knowledge_prompt)]
+                    assert isinstance(sys_msg[CONTENT], list)
+                    sys_msg[CONTENT].append(ContentItem(text='\n\n' + knowledge_prompt))
+                messages = [sys_msg] + messages[1:]
             else:
                 messages = [Message(role=SYSTEM, content=knowledge_prompt)] + messages
         return messages
@@ -1,13 +1,14 @@
-import copy
-from typing import Dict, Iterator, List, Literal, Optional, Union
+import contextvars
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, Iterator, List, Literal, Optional, Tuple, Union
 
 from qwen_agent import Agent
 from qwen_agent.llm import BaseChatModel
-from qwen_agent.llm.schema import DEFAULT_SYSTEM_MESSAGE, FUNCTION, Message
+from qwen_agent.llm.schema import DEFAULT_SYSTEM_MESSAGE, FUNCTION, ContentItem, Message
 from qwen_agent.memory import Memory
-from qwen_agent.settings import MAX_LLM_CALL_PER_RUN
+from qwen_agent.settings import EAGER_TOOL_CALLS, MAX_LLM_CALL_PER_RUN, MAX_PARALLEL_TOOL_CALLS
 from qwen_agent.tools import BaseTool
-from qwen_agent.utils.utils import extract_files_from_messages
+from qwen_agent.utils.utils import close_iterator, extract_files_from_messages
 
 
 class FnCallAgent(Agent):
@@ -56,8 +57,18 @@ class FnCallAgent(Agent):
                 mem_llm = self.llm
             self.mem = Memory(llm=mem_llm, files=files, **kwargs)
 
+        self._functions_cache: Optional[Tuple[tuple, List[Dict]]] = None
+        self.eager_tool_calls: bool = EAGER_TOOL_CALLS
+
+    def _get_functions(self) -> List[Dict]:
+        """The function list of the tools, rebuilt only when the tools in `function_map` change."""
+        key = tuple((name, id(tool)) for name, tool in self.function_map.items())
+        if (self._functions_cache is None) or (self._functions_cache[0] != key):
+            self._functions_cache = (key, [func.function for func in self.function_map.values()])
+        return self._functions_cache[1]
+
     def _run(self, messages: List[Message], lang: Literal['en', 'zh'] = 'en', **kwargs) -> Iterator[List[Message]]:
-        messages = copy.deepcopy(messages)
+        messages = list(messages)  # The loop below only appends new messages to the history
         num_llm_calls_available = MAX_LLM_CALL_PER_RUN
         response = []
         while True and num_llm_calls_available > 0:
@@ -67,20 +78,33 @@ class FnCallAgent(Agent):
             if kwargs.get('seed') is not None:
                 extra_generate_cfg['seed'] = kwargs['seed']
             output_stream = self._call_llm(messages=messages,
-                                           functions=[func.function for func in self.function_map.values()],
+                                           functions=self._get_functions(),
                                            extra_generate_cfg=extra_generate_cfg)
             output: List[Message] = []
-            for output in output_stream:
+            eager_calls = _EagerToolCalls(self) if self.eager_tool_calls else None
+            tool_results = None
+            try:
+                for output in output_stream:
+                    if output:
+                        if eager_calls is not None:
+                            eager_calls.start_completed_calls(output, history=messages, **kwargs)
+                        yield response + output
                 if output:
-                    yield response + output
-            if output:
-                response.extend(output)
-                messages.extend(output)
-                used_any_tool = False
-                for out in output:
-                    use_tool, tool_name, tool_args, _ = self._detect_tool(out)
-                    if use_tool:
-                        tool_result = self._call_tool(tool_name, tool_args, messages=messages, **kwargs)
+                    response.extend(output)
+                    messages.extend(output)
+                    tool_calls, started = [], {}
+                    for i, out in enumerate(output):
+                        use_tool, tool_name, tool_args, _ = self._detect_tool(out)
+                        if use_tool:
+                            if eager_calls is not None:
+                                future = eager_calls.pop(i, tool_name, tool_args)
+                                if future is not None:
+                                    started[len(tool_calls)] = future
+                            tool_calls.append((tool_name, tool_args))
+                    if not tool_calls:
+                        break
+                    tool_results = self._call_tools(tool_calls, started=started, messages=list(messages), **kwargs)
+                    for tool_name, tool_result in tool_results:
                         fn_msg = Message(
                             role=FUNCTION,
                             name=tool_name,
@@ -89,11 +113,55 @@ class FnCallAgent(Agent):
                         messages.append(fn_msg)
                         response.append(fn_msg)
                         yield response
-                        used_any_tool = True
-                if not used_any_tool:
-                    break
+            finally:
+                # Release the LLM stream and the pending tool calls right away if the consumer stops early
+                close_iterator(output_stream)
+                close_iterator(tool_results)
+                if eager_calls is not None:
+                    eager_calls.close()
         yield response
 
+    def _call_tools(self,
+                    tool_calls: List[Tuple[str, str]],
+                    started: Optional[Dict[int, Future]] = None,
+                    **kwargs) -> Iterator[Tuple[str, Union[str, List[ContentItem]]]]:
+        """Call the tools requested in one turn, and yield their results in the original call order.
+
+        The calls to thread-safe tools run concurrently on a bounded thread pool, while the calls to the tools that are
+        not thread-safe run one by one in the current thread.
+
+        Args:
+            tool_calls: The (tool_name, tool_args) of the calls.
+            started: The calls that are already running in the background, indexed by their positions in tool_calls.
+        """
+        futures = dict(started or {})
+        concurrent_calls = [
+            i for i, (tool_name, _) in enumerate(tool_calls)
+            if (i not in futures) and self._is_tool_thread_safe(tool_name)
+        ]
+        executor = None
+        if concurrent_calls and (len(tool_calls) - len(futures) >= 2) and (MAX_PARALLEL_TOOL_CALLS >= 2):
+            executor = ThreadPoolExecutor(max_workers=min(MAX_PARALLEL_TOOL_CALLS, len(concurrent_calls)))
+            for i in concurrent_calls:
+                futures[i] = executor.submit(contextvars.copy_context().run, self._call_tool, *tool_calls[i], **kwargs)
+        try:
+            for i, (tool_name, tool_args) in enumerate(tool_calls):
+                if i in futures:
+                    tool_result = futures[i].result()
+                else:
+                    tool_result = self._call_tool(tool_name, tool_args, **kwargs)
+                yield tool_name, tool_result
+        finally:
+            # Do not start the remaining calls if a call fails or the consumer stops early. The calls that are still
+            # running are not waited for, and their results are dropped.
+            for future in futures.values():
+                future.cancel()
+            if executor is not None:
+                executor.shutdown(wait=False)
+
+    def _is_tool_thread_safe(self, tool_name: str) -> bool:
+        return (tool_name not in self.function_map) or self.function_map[tool_name].thread_safe
+
     def _call_tool(self, tool_name: str, tool_args: Union[str, dict] = '{}', **kwargs) -> str:
         if tool_name not in self.function_map:
             return f'Tool {tool_name} does not exists.'
@@ -105,3 +173,48 @@ class FnCallAgent(Agent):
             return super()._call_tool(tool_name, tool_args, files=files, **kwargs)
         else:
             return super()._call_tool(tool_name, tool_args, **kwargs)
+
+
+class _EagerToolCalls:
+    """The tool calls started while the LLM is still generating the rest of its response.
+
+    A function call in the streamed output is complete once the LLM has moved on to the next message, e.g., after
+    `</tool_call>` in the Nous format. Only the calls to thread-safe tools are started early. The results are joined
+    before the next LLM call, and discarded if the final output no longer contains the same call.
+    """
+
+    def __init__(self, agent: FnCallAgent):
+        self.agent = agent
+        self.executor: Optional[ThreadPoolExecutor] = None
+        self.started: Dict[int, Tuple[str, str, Future]] = {}  # index in the output -> (tool_name, tool_args, future)
+        self.num_checked = 0
+
+    def start_completed_calls(self, output: List[Message], history: List[Message], **kwargs):
+        for i in range(self.num_checked, len(output) - 1):
+            use_tool, tool_name, tool_args, _ = self.agent._detect_tool(output[i])
+            if use_tool and self.agent._is_tool_thread_safe(tool_name):
+                if self.executor is None:
+                    self.executor = ThreadPoolExecutor(max_workers=max(MAX_PARALLEL_TOOL_CALLS, 1))
+                future = self.executor.submit(contextvars.copy_context().run,
+                                              self.agent._call_tool,
+                                              tool_name,
+                                              tool_args,
+                                              messages=history + output[:i + 1],
+                                              **kwargs)
+                self.started[i] = (tool_name, tool_args, future)
+        self.num_checked = max(self.num_checked, len(output) - 1)
+
+    def pop(self, index: int, tool_name: str, tool_args: str) -> Optional[Future]:
+        if index in self.started:
+            started_name, started_args, future = self.started.pop(index)
+            if (started_name, started_args) == (tool_name, tool_args):
+                return future
+            future.cancel()
+        return None
+
+    def close(self):
+        for _, _, future in self.started.values():
+            future.cancel()
+        self.started = {}
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
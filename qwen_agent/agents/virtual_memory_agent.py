@@ -39,7 +39,7 @@ class VirtualMemoryAgent(Assistant):
         while True and num_llm_calls_available > 0:
             num_llm_calls_available -= 1
             output_stream = self._call_llm(messages=self._format_file(messages) + response,
-                                           functions=[func.function for func in self.function_map.values()])
+                                           functions=self._get_functions())
             output: List[Message] = []
             for output in output_stream:
                 if output:
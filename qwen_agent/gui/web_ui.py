@@ -9,7 +9,7 @@ from qwen_agent.gui.gradio_utils import format_cover_html
 from qwen_agent.gui.utils import convert_fncall_to_text, convert_history_to_chatbot, get_avatar_image
 from qwen_agent.llm.schema import AUDIO, CONTENT, FILE, IMAGE, NAME, ROLE, USER, VIDEO, Message
 from qwen_agent.log import logger
-from qwen_agent.utils.utils import print_traceback
+from qwen_agent.utils.utils import CancellationToken, print_traceback
 
 
 class WebUI:
@@ -88,6 +88,7 @@ class WebUI:
                 theme=customTheme,
         ) as demo:
             history = gr.State([])
+            run_state = gr.State({})
             with ms.Application():
                 with gr.Row(elem_classes='container'):
                     with gr.Column(scale=4):
@@ -131,6 +132,7 @@ class WebUI:
                                               }])
 
                         input = mgr.MultimodalInput(placeholder=self.input_placeholder,)
+                        stop_button = gr.Button('停止', size='sm')
 
                     with gr.Column(scale=1):
                         if len(self.agent_list) > 1:
@@ -175,18 +177,26 @@ class WebUI:
                             [chatbot, agent_selector],
                         ).then(
                             self.agent_run,
-                            [chatbot, history, agent_selector],
+                            [chatbot, history, agent_selector, run_state],
                             [chatbot, history, agent_selector],
                         )
                     else:
                         input_promise = input_promise.then(
                             self.agent_run,
-                            [chatbot, history],
+                            [chatbot, history, gr.State(None), run_state],
                             [chatbot, history],
                         )
 
                     input_promise.then(self.flushed, None, [input])
 
+                    stop_button.click(
+                        fn=self.stop_run,
+                        inputs=[run_state],
+                        outputs=[input],
+                        cancels=[input_promise],
+                        queue=False,
+                    )
+
             demo.load(None)
 
         demo.queue(default_concurrency_limit=concurrency_limit).launch(share=share,
@@ -241,7 +251,7 @@ class WebUI:
 
         yield _chatbot, _agent_selector
 
-    def agent_run(self, _chatbot, _history, _agent_selector=None):
+    def agent_run(self, _chatbot, _history, _agent_selector=None, _run_state=None):
         if self.verbose:
             logger.info('agent_run input:\n' + pprint.pformat(_history, indent=2))
 
@@ -253,7 +263,11 @@ class WebUI:
         if self.agent_hub:
             agent_runner = self.agent_hub
         responses = []
-        for responses in agent_runner.run(_history, **self.run_kwargs):
+        cancel_token = CancellationToken()
+        if _run_state is not None:
+            _run_state['cancel_token'] = cancel_token  # For the stop button
+        run_iter = agent_runner.run(_history, cancel_token=cancel_token, **self.run_kwargs)
+        for responses in run_iter:
             if not responses:
                 continue
             if responses[-1][CONTENT] == PENDING_USER_INPUT:
@@ -287,6 +301,8 @@ class WebUI:
             else:
                 yield _chatbot, _history
 
+        run_iter.close()
+
         if responses:
             _history.extend([res for res in responses if res[CONTENT] != PENDING_USER_INPUT])
 
@@ -303,6 +319,12 @@ class WebUI:
 
         return gr.update(interactive=True)
 
+    def stop_run(self, _run_state):
+        cancel_token = _run_state.get('cancel_token')
+        if cancel_token is not None:
+            cancel_token.cancel()
+        return self.flushed()
+
     def _get_agent_index_by_name(self, agent_name):
         if agent_name is None:
             return 0
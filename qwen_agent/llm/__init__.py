@@ -1,15 +1,22 @@
 import copy
-from typing import Union
+import threading
+from typing import Dict, Union
+
+from qwen_agent.settings import SHARE_LLM_INSTANCES
+from qwen_agent.utils.utils import json_dumps_compact
 
 from .azure import TextChatAtAzure
 from .base import LLM_REGISTRY, BaseChatModel, ModelServiceError
+from .mock import MockChatModel
 from .oai import TextChatAtOAI
+from .oai_pool import TextChatAtOAIPool
 from .openvino import OpenVINO
 from .qwen_dashscope import QwenChatAtDS
 from .qwenaudio_dashscope import QwenAudioChatAtDS
 from .qwenomni_oai import QwenOmniChatAtOAI
 from .qwenvl_dashscope import QwenVLChatAtDS
 from .qwenvl_oai import QwenVLChatAtOAI
+from .usage import track_usage
 
 
 def get_chat_model(cfg: Union[dict, str] = 'qwen-plus') -> BaseChatModel:
@@ -26,11 +33,24 @@ def get_chat_model(cfg: Union[dict, str] = 'qwen-plus') -> BaseChatModel:
               # 'model': 'Qwen',
               # 'model_server': 'http://127.0.0.1:7905/v1',
 
+              # Or balance the load across several replicas of your model service:
+              # 'model': 'Qwen',
+              # 'model_type': 'oai_pool',
+              # 'model_servers': ['http://127.0.0.1:7905/v1', 'http://127.0.0.1:7906/v1'],
+
+              # Or a deterministic local LLM for tests and benchmarks, see MockChatModel:
+              # 'model_type': 'mock',
+              # 'responses': ['Hello!'],
+
               # (Optional) LLM hyper-parameters:
               'generate_cfg': {
                   'top_p': 0.8,
                   'max_input_tokens': 6500,
                   'max_retries': 10,
+                  # 'hedge': {'percentile': 95, 'budget': 0.1},  # Hedged requests, see HedgePolicy
+                  # 'rate_limit': {'rpm': 60, 'tpm': 100000},  # Client-side rate limits, see RateLimiter
+                  # 'metrics': True,  # Attach the timings of each call to its output, see CallMetrics
+                  # 'service_info': 'final',  # DashScope only: The retention of model_service_info, see build_extra
               }
           }
 
@@ -84,16 +104,49 @@ def get_chat_model(cfg: Union[dict, str] = 'qwen-plus') -> BaseChatModel:
     raise ValueError(f'Invalid model cfg: {cfg}')
 
 
+_shared_models: Dict[str, BaseChatModel] = {}
+_shared_models_lock = threading.Lock()
+
+
+def get_shared_chat_model(cfg: Union[dict, str] = 'qwen-plus') -> BaseChatModel:
+    """Same as `get_chat_model`, but returns the same LLM object for the same configuration within the process.
+
+    The agents created with a dict `llm` share the LLM objects this way, and so do their model clients, caches and, for
+    local models, the model weights. Set the environment variable QWEN_AGENT_SHARE_LLM_INSTANCES=0 to disable it.
+    """
+    if not SHARE_LLM_INSTANCES:
+        return get_chat_model(cfg)
+    if isinstance(cfg, str):
+        cfg = {'model': cfg}
+    key = json_dumps_compact(cfg, sort_keys=True, default=str)
+    with _shared_models_lock:
+        # Held while creating the LLM object, so that a local model is not loaded twice by concurrent agents
+        if key not in _shared_models:
+            _shared_models[key] = get_chat_model(copy.deepcopy(cfg))
+        return _shared_models[key]
+
+
+def clear_shared_chat_models():
+    """Forget the shared LLM objects, e.g., to release a local model. The agents that hold them keep them."""
+    with _shared_models_lock:
+        _shared_models.clear()
+
+
 __all__ = [
     'BaseChatModel',
     'QwenChatAtDS',
     'TextChatAtOAI',
+    'TextChatAtOAIPool',
     'TextChatAtAzure',
     'QwenVLChatAtDS',
     'QwenVLChatAtOAI',
     'QwenAudioChatAtDS',
     'QwenOmniChatAtOAI',
     'OpenVINO',
+    'MockChatModel',
     'get_chat_model',
+    'get_shared_chat_model',
+    'clear_shared_chat_models',
     'ModelServiceError',
+    'track_usage',
 ]
@@ -25,6 +25,8 @@ class TextChatAtAzure(TextChatAtOAI):
         api_key = (api_key or 'EMPTY').strip()
 
         api_version = cfg.get('api_version', '2024-06-01')
+        # Whether `stream_options` is accepted depends on the api_version, so requesting the usage is left to users
+        self.stream_usage = False
 
         api_kwargs = {}
         if api_base:
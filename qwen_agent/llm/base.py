@@ -7,12 +7,19 @@ from abc import ABC, abstractmethod
 from pprint import pformat
 from typing import Any, Dict, Iterator, List, Literal, Optional, Tuple, Union
 
-from qwen_agent.llm.schema import ASSISTANT, DEFAULT_SYSTEM_MESSAGE, SYSTEM, USER, FUNCTION, Message
+from qwen_agent.llm.hedging import HedgePolicy
+from qwen_agent.llm.metrics import CallMetrics, emit_metrics, has_metrics_sinks
+from qwen_agent.llm.rate_limit import RateLimiter, get_rate_limiter
+from qwen_agent.llm.schema import ASSISTANT, DEFAULT_SYSTEM_MESSAGE, FUNCTION, SYSTEM, USER, ContentItem, Message
+from qwen_agent.llm.single_flight import single_flight_call, single_flight_stream
+from qwen_agent.llm.stop_words import StopWordMatcher, StopWordScanner
+from qwen_agent.llm.usage import get_usage, record_usage
 from qwen_agent.log import logger
-from qwen_agent.settings import DEFAULT_MAX_INPUT_TOKENS
-from qwen_agent.utils.tokenization_qwen import tokenizer
-from qwen_agent.utils.utils import (extract_text_from_message, format_as_multimodal_message, format_as_text_message,
-                                    has_chinese_messages, json_dumps_compact, merge_generate_cfgs, print_traceback)
+from qwen_agent.settings import DEBUG_MESSAGE_MUTATION, DEFAULT_MAX_INPUT_TOKENS
+from qwen_agent.utils.tokenization_qwen import count_tokens_cached, tokenizer
+from qwen_agent.utils.utils import (check_messages_unchanged, close_iterator, extract_text_from_message,
+                                    format_as_multimodal_message, format_as_text_message, has_chinese_messages,
+                                    json_dumps_compact, merge_generate_cfgs, print_traceback, snapshot_messages)
 
 LLM_REGISTRY = {}
 
@@ -66,10 +73,22 @@ class BaseChatModel(ABC):
         generate_cfg = copy.deepcopy(cfg.get('generate_cfg', {}))
         cache_dir = cfg.get('cache_dir', generate_cfg.pop('cache_dir', None))
         self.max_retries = generate_cfg.pop('max_retries', 0)
+        hedge_cfg = generate_cfg.pop('hedge', None)
+        self.hedge_policy: Optional[HedgePolicy] = HedgePolicy(**hedge_cfg) if hedge_cfg else None
         self.generate_cfg = generate_cfg
         self.model_type = cfg.get('model_type', '')
         if 'dashscope' in self.model_type:
             self.generate_cfg['incremental_output'] = True
+        rate_limit_cfg = self.generate_cfg.pop('rate_limit', None)
+        if rate_limit_cfg:
+            # Shared by all the LLM objects that call the same model on the same model service
+            key = rate_limit_cfg.pop('key', None)
+            if not key:
+                model_server = cfg.get('model_server') or cfg.get('base_url') or cfg.get('api_base') or self.model_type
+                key = f'{model_server}/{self.model}'
+            self.rate_limiter: Optional[RateLimiter] = get_rate_limiter(key, **rate_limit_cfg)
+        else:
+            self.rate_limiter: Optional[RateLimiter] = None
 
         if cache_dir:
             try:
@@ -84,6 +103,19 @@ class BaseChatModel(ABC):
         else:
             self.cache = None
 
+        # Let the concurrent identical requests share one request to the model service, like the cache does for the
+        # requests that come later. It is opt-in without the cache, since the identical requests then share one sample.
+        self.single_flight: bool = self.generate_cfg.pop('single_flight', self.cache is not None)
+
+        # Whether to attach the timings of each call, i.e., CallMetrics, to its output. They are also collected for
+        # all the LLMs once a sink is added with `qwen_agent.llm.metrics.add_metrics_sink`. They are attached to
+        # extra['metrics'] of the last message of the output. With delta_stream=True, they come in one more chunk
+        # with an empty assistant message at the end, since the chunks already yielded cannot carry them.
+        self.collect_metrics: bool = self.generate_cfg.pop('metrics', False)
+
+        # Precompiled stop word matchers, keyed by the tuple of stop words
+        self._stop_word_matchers: Dict[Tuple[str, ...], StopWordMatcher] = {}
+
     def quick_chat(self, prompt: str) -> str:
         *_, responses = self.chat(messages=[Message(role=USER, content=prompt)])
         assert len(responses) == 1
@@ -113,9 +145,15 @@ class BaseChatModel(ABC):
         Returns:
             the generated message list response by llm.
         """
+        if self.collect_metrics or has_metrics_sinks():
+            call_metrics = CallMetrics(model=self.model, model_type=self.model_type, stream=stream)
+        else:
+            call_metrics = None
 
-        # Unify the input messages to type List[Message]:
-        messages = copy.deepcopy(messages)
+        # Unify the input messages to type List[Message]. The messages are shared rather than deep-copied, and the
+        # preprocessing steps below copy a message before modifying it.
+        if DEBUG_MESSAGE_MUTATION:
+            input_messages, snapshot = messages, snapshot_messages(messages)
         _return_message_type = 'dict'
         new_messages = []
         for msg in messages:
@@ -150,6 +188,15 @@ class BaseChatModel(ABC):
             )
 
         generate_cfg = merge_generate_cfgs(base_generate_cfg=self.generate_cfg, new_generate_cfg=extra_generate_cfg)
+        if self.single_flight:
+            # The canonical key of the request, which excludes the random seed added below
+            flight_key = json_dumps_compact(dict(llm=[type(self).__name__, self.model],
+                                                 messages=messages,
+                                                 functions=functions,
+                                                 generate_cfg=generate_cfg,
+                                                 stream=stream,
+                                                 delta_stream=delta_stream),
+                                            sort_keys=True)
         if 'seed' not in generate_cfg:
             generate_cfg['seed'] = random.randint(a=0, b=2**30)
         if 'lang' in generate_cfg:
@@ -194,7 +241,16 @@ class BaseChatModel(ABC):
                 if k in generate_cfg:
                     del generate_cfg[k]
 
+        if (self.rate_limiter is not None) and (self.rate_limiter.tpm is not None):
+            num_tokens_estimate = sum(_count_tokens(msg) for msg in messages) + generate_cfg.get('max_tokens', 0)
+        else:
+            num_tokens_estimate = 0
+
         def _call_model_service():
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire(num_tokens_estimate)
+            if call_metrics is not None:
+                call_metrics.mark_request_sent()
             if fncall_mode:
                 return self._chat_with_functions(
                     messages=messages,
@@ -217,13 +273,29 @@ class BaseChatModel(ABC):
                         generate_cfg=generate_cfg,
                     )
 
+        def _call_and_observe() -> List[Message]:
+            output = retry_model_service(_call_model_service, max_retries=self.max_retries)
+            usage = get_usage(output)
+            record_usage(usage)
+            if call_metrics is not None:
+                call_metrics.add_chunk(wait_start=call_metrics.request_sent)
+                output = _attach_metrics(output, call_metrics, usage)
+            return output
+
         if stream and delta_stream:
             # No retry for delta streaming
-            output = _call_model_service()
+            output = _observe_model_stream(_call_model_service(), call_metrics, delta_stream=True)
         elif stream and (not delta_stream):
-            output = retry_model_service_iterator(_call_model_service, max_retries=self.max_retries)
+            if self.hedge_policy is not None:
+                output = retry_model_service_iterator(lambda: self.hedge_policy.hedged(_call_model_service),
+                                                      max_retries=self.max_retries)
+            else:
+                output = retry_model_service_iterator(_call_model_service, max_retries=self.max_retries)
+            output = _observe_model_stream(output, call_metrics, delta_stream=False)
+        elif self.single_flight:
+            output = single_flight_call(flight_key, _call_and_observe, share_fn=_shallow_copy_messages)
         else:
-            output = retry_model_service(_call_model_service, max_retries=self.max_retries)
+            output = _call_and_observe()
 
         if isinstance(output, list):
             assert not stream
@@ -233,6 +305,8 @@ class BaseChatModel(ABC):
                 output = _format_as_text_messages(messages=output)
             if self.cache:
                 self.cache.set(cache_key, json_dumps_compact(output))
+            if DEBUG_MESSAGE_MUTATION:
+                check_messages_unchanged(input_messages, snapshot, where=f'{type(self).__name__}.chat')
             return self._convert_messages_to_target_type(output, _return_message_type)
         else:
             assert stream
@@ -246,15 +320,28 @@ class BaseChatModel(ABC):
 
             def _format_and_cache() -> Iterator[List[Message]]:
                 o = []
-                for o in output:
-                    if o:
-                        if not self.support_multimodal_output:
-                            o = _format_as_text_messages(messages=o)
-                        yield o
+                try:
+                    for o in output:
+                        if o:
+                            if not self.support_multimodal_output:
+                                o = _format_as_text_messages(messages=o)
+                            yield o
+                finally:
+                    # Closing the chat stream closes the model stream, which aborts the request to the model service
+                    close_iterator(output)
                 if o and (self.cache is not None):
                     self.cache.set(cache_key, json_dumps_compact(o))
-
-            return self._convert_messages_iterator_to_target_type(_format_and_cache(), _return_message_type)
+                if DEBUG_MESSAGE_MUTATION:
+                    check_messages_unchanged(input_messages, snapshot, where=f'{type(self).__name__}.chat')
+
+            if self.single_flight:
+                final_output = single_flight_stream(flight_key,
+                                                    _format_and_cache,
+                                                    replay=delta_stream,
+                                                    share_fn=_shallow_copy_messages)
+            else:
+                final_output = _format_and_cache()
+            return self._convert_messages_iterator_to_target_type(final_output, _return_message_type)
 
     def _chat(
         self,
@@ -332,7 +419,14 @@ class BaseChatModel(ABC):
         messages: List[Message],
         fncall_mode: bool,
         generate_cfg: dict,
+        stream_state: Optional[dict] = None,
     ) -> List[Message]:
+        """Postprocess the raw model output.
+
+        Args:
+            stream_state: A dict shared by all the chunks of one streamed response, where the postprocessors keep
+              their incremental state. It is None when not streaming.
+        """
         messages = [
             format_as_multimodal_message(msg,
                                          add_upload_info=False,
@@ -341,9 +435,23 @@ class BaseChatModel(ABC):
         ]
         if not generate_cfg.get('skip_stopword_postproc', False):
             stop = generate_cfg.get('stop', [])
-            messages = _postprocess_stop_words(messages, stop=stop)
+            matcher = self._get_stop_word_matcher(stop)
+            scanner = None
+            if stream_state is not None:
+                if 'stop_word_scanner' not in stream_state:
+                    stream_state['stop_word_scanner'] = matcher.new_scanner()
+                scanner = stream_state['stop_word_scanner']
+            messages = _postprocess_stop_words(messages, stop=stop, matcher=matcher, scanner=scanner)
         return messages
 
+    def _get_stop_word_matcher(self, stop: List[str]) -> StopWordMatcher:
+        key = tuple(stop)
+        matcher = self._stop_word_matchers.get(key)
+        if matcher is None:
+            matcher = StopWordMatcher(key)
+            self._stop_word_matchers[key] = matcher
+        return matcher
+
     def _postprocess_messages_iterator(
         self,
         messages: Iterator[List[Message]],
@@ -351,8 +459,15 @@ class BaseChatModel(ABC):
         generate_cfg: dict,
     ) -> Iterator[List[Message]]:
         pre_msg = []
-        for pre_msg in messages:
-            yield self._postprocess_messages(pre_msg, fncall_mode=fncall_mode, generate_cfg=generate_cfg)
+        stream_state = {}
+        try:
+            for pre_msg in messages:
+                yield self._postprocess_messages(pre_msg,
+                                                 fncall_mode=fncall_mode,
+                                                 generate_cfg=generate_cfg,
+                                                 stream_state=stream_state)
+        finally:
+            close_iterator(messages)
         logger.debug(f'LLM Output:\n{pformat([_.model_dump() for _ in pre_msg], indent=2)}')
 
     def _convert_messages_to_target_type(self, messages: List[Message],
@@ -367,8 +482,11 @@ class BaseChatModel(ABC):
     def _convert_messages_iterator_to_target_type(
             self, messages_iter: Iterator[List[Message]],
             target_type: str) -> Union[Iterator[List[Message]], Iterator[List[Dict]]]:
-        for messages in messages_iter:
-            yield self._convert_messages_to_target_type(messages, target_type)
+        try:
+            for messages in messages_iter:
+                yield self._convert_messages_to_target_type(messages, target_type)
+        finally:
+            close_iterator(messages_iter)
 
     def quick_chat_oai(self, messages: List[dict], tools: Optional[list] = None) -> dict:
         """
@@ -404,8 +522,10 @@ class BaseChatModel(ABC):
 
         def _convert_to_oai_message(data):
             message = {'role': 'assistant', 'content': '', 'reasoning_content': '', 'tool_calls': []}
+            usage = None
 
             for item in data:
+                usage = usage or (item.get('extra') or {}).get('usage')
                 if item.get('reasoning_content'):
                     message['reasoning_content'] += item['reasoning_content']
 
@@ -422,17 +542,20 @@ class BaseChatModel(ABC):
                         }
                     }
                     message['tool_calls'].append(tool_call)
-            # Fake token usage
+            # The usage is reported by the model service at the end of the stream, and is zero until then
+            usage = usage or {}
             response = {
                 'choices': [{
                     'message': message
                 }],
                 'usage': {
-                    'prompt_tokens': 0,
-                    'completion_tokens': 0,
-                    'total_tokens': 0
+                    'prompt_tokens': usage.get('prompt_tokens', 0),
+                    'completion_tokens': usage.get('completion_tokens', 0),
+                    'total_tokens': usage.get('total_tokens', 0),
                 }
             }
+            if usage.get('cached_tokens') is not None:
+                response['usage']['prompt_tokens_details'] = {'cached_tokens': usage['cached_tokens']}
             return response
 
         if tools:
@@ -447,6 +570,73 @@ class BaseChatModel(ABC):
             yield _convert_to_oai_message(rsp)
 
 
+def _shallow_copy_messages(messages: List[Message]) -> List[Message]:
+    return [msg.shallow_copy() for msg in messages]
+
+
+def _observe_model_stream(it: Iterator[List[Message]],
+                          call_metrics: Optional[CallMetrics] = None,
+                          delta_stream: bool = False) -> Iterator[List[Message]]:
+    # Add the usage reported by the model service, which usually comes with the last chunk, to the active trackers.
+    # With call_metrics, time the chunks, and yield the metrics as one more chunk at the end.
+    usage, rsp, delta_tokens = None, [], 0
+    metrics_emitted = False
+    try:
+        while True:
+            wait_start = time.monotonic()
+            try:
+                rsp = next(it)
+            except StopIteration:
+                break
+            if call_metrics is not None:
+                call_metrics.add_chunk(wait_start)
+                if delta_stream and (usage is None):
+                    delta_tokens += sum(_count_tokens(msg) for msg in rsp)
+            usage = get_usage(rsp) or usage
+            yield rsp
+        if call_metrics is not None:
+            if delta_stream:
+                metrics_rsp = _attach_metrics([Message(role=ASSISTANT, content='')], call_metrics, usage or
+                                              {'completion_tokens': delta_tokens})
+                metrics_emitted = True
+                yield metrics_rsp
+            elif rsp:
+                rsp = _attach_metrics(rsp, call_metrics, usage)
+                metrics_emitted = True
+                yield rsp
+    finally:
+        close_iterator(it)
+        record_usage(usage)
+        if (call_metrics is not None) and (not metrics_emitted):
+            # The stream ended early, e.g., the consumer stopped reading or the rest of a tool call was cut off
+            if delta_stream:
+                _emit_call_metrics([], call_metrics, usage or {'completion_tokens': delta_tokens})
+            else:
+                _emit_call_metrics(rsp, call_metrics, usage)
+
+
+def _attach_metrics(messages: List[Message], call_metrics: CallMetrics, usage: Optional[Dict[str,
+                                                                                             int]]) -> List[Message]:
+    metrics = _emit_call_metrics(messages, call_metrics, usage)
+    if not messages:
+        return messages
+    last = messages[-1]
+    return messages[:-1] + [last.shallow_copy(extra={**(last.extra or {}), 'metrics': metrics})]
+
+
+def _emit_call_metrics(messages: List[Message], call_metrics: CallMetrics, usage: Optional[Dict[str, int]]) -> dict:
+    usage = usage or {}
+    if 'completion_tokens' in usage:
+        completion_tokens = usage['completion_tokens']
+    else:
+        completion_tokens = sum(_count_tokens(msg) for msg in messages)
+    metrics = call_metrics.as_dict(completion_tokens=completion_tokens,
+                                   prompt_tokens=usage.get('prompt_tokens', 0),
+                                   cached_tokens=usage.get('cached_tokens'))
+    emit_metrics(metrics)
+    return metrics
+
+
 def _format_as_text_messages(messages: List[Message]) -> List[Message]:
     for msg in messages:
         if isinstance(msg.content, list):
@@ -458,56 +648,56 @@ def _format_as_text_messages(messages: List[Message]) -> List[Message]:
     return messages
 
 
-def _postprocess_stop_words(messages: List[Message], stop: List[str]) -> List[Message]:
-    messages = copy.deepcopy(messages)
+def _postprocess_stop_words(messages: List[Message],
+                            stop: List[str],
+                            matcher: Optional[StopWordMatcher] = None,
+                            scanner: Optional[StopWordScanner] = None) -> List[Message]:
+    if scanner is not None:
+        matcher = scanner.matcher
+    elif matcher is None:
+        matcher = StopWordMatcher(stop)
 
     # Make sure it stops before stop words.
+    # The content items are replaced rather than modified, since the model service may still be accumulating them.
     trunc_messages = []
-    for msg in messages:
+    for msg_idx, msg in enumerate(messages):
         truncated = False
         trunc_content = []
         for i, item in enumerate(msg.content):
             item_type, item_text = item.get_type_and_value()
             if item_type == 'text':
-                truncated, item.text = _truncate_at_stop_word(text=item_text, stop=stop)
+                if scanner is not None:
+                    truncated, trunc_text = scanner.truncate(item_text, key=(msg_idx, i))
+                else:
+                    truncated, trunc_text = matcher.truncate(item_text)
+                if truncated:
+                    item = ContentItem.fast_construct(text=trunc_text)
             trunc_content.append(item)
             if truncated:
                 break
-        msg.content = trunc_content
-        trunc_messages.append(msg)
+        trunc_messages.append(msg.shallow_copy(content=trunc_content))
         if truncated:
             break
     messages = trunc_messages
 
     # It may ends with partial stopword 'Observation' when the full stopword is 'Observation:'.
     # The following post-processing step removes partial stop words.
-    partial_stop = []
-    for s in stop:
-        s = tokenizer.tokenize(s)[:-1]
-        if s:
-            s = tokenizer.convert_tokens_to_string(s)
-            partial_stop.append(s)
-    partial_stop = sorted(set(partial_stop))
-    last_msg = messages[-1].content
-    for i in range(len(last_msg) - 1, -1, -1):
-        item_type, item_text = last_msg[i].get_type_and_value()
-        if item_type == 'text':
-            for s in partial_stop:
-                if item_text.endswith(s):
-                    last_msg[i].text = item_text[:-len(s)]
-            break
+    if matcher.partial_stop:
+        last_msg = messages[-1].content
+        for i in range(len(last_msg) - 1, -1, -1):
+            item_type, item_text = last_msg[i].get_type_and_value()
+            if item_type == 'text':
+                new_text = matcher.remove_partial_stop(item_text)
+                if new_text != item_text:
+                    last_msg[i] = ContentItem.fast_construct(text=new_text)
+                break
 
     return messages
 
 
-def _truncate_at_stop_word(text: str, stop: List[str]):
-    truncated = False
-    for s in stop:
-        k = text.find(s)
-        if k >= 0:
-            truncated = True
-            text = text[:k]
-    return truncated, text
+def _count_tokens(msg: Message) -> int:
+    # Memoized, so that only the new messages are tokenized when the history is truncated again on every call.
+    return count_tokens_cached(extract_text_from_message(msg, add_upload_info=True))
 
 
 def _truncate_input_messages_roughly(messages: List[Message], max_tokens: int) -> List[Message]:
@@ -533,9 +723,6 @@ def _truncate_input_messages_roughly(messages: List[Message], max_tokens: int) -
                     message='The input messages (excluding the system message) must start with a user message.',
                 )
 
-    def _count_tokens(msg: Message) -> int:
-        return tokenizer.count_tokens(extract_text_from_message(msg, add_upload_info=True))
-
     def _truncate_message(msg: Message, max_tokens: int, keep_both_sides: bool = False):
         if isinstance(msg.content, str):
             content = tokenizer.truncate(msg.content, max_token=max_tokens, keep_both_sides=keep_both_sides)
@@ -548,14 +735,14 @@ def _truncate_input_messages_roughly(messages: List[Message], max_tokens: int) -
             text = '\n'.join(text)
             content = tokenizer.truncate(text, max_token=max_tokens, keep_both_sides=keep_both_sides)
         return Message(role=msg.role, content=content)
-    
+
     if messages and messages[0].role == SYSTEM:
         sys_msg = messages[0]
         available_token = max_tokens - _count_tokens(sys_msg)
     else:
         sys_msg = None
         available_token = max_tokens
-    
+
     token_cnt = 0
     new_messages = []
     for i in range(len(messages) - 1, -1, -1):
@@ -580,7 +767,7 @@ def _truncate_input_messages_roughly(messages: List[Message], max_tokens: int) -
             else:
                 token_cnt = (max_tokens - available_token) + cur_token_cnt
                 break
-    
+
     if sys_msg is not None:
         new_messages = [sys_msg] + new_messages
 
@@ -618,14 +805,20 @@ def retry_model_service_iterator(
 
     num_retries, delay = 0, 1.0
     while True:
+        it = None
         try:
-            for rsp in it_fn():
+            it = it_fn()
+            for rsp in it:
                 yield rsp
             break
 
         except ModelServiceError as e:
             num_retries, delay = _raise_or_delay(e, num_retries, delay, max_retries)
 
+        finally:
+            # Let the model service stop generating when the consumer stops early
+            close_iterator(it)
+
 
 def _raise_or_delay(
     e: ModelServiceError,
@@ -1,11 +1,52 @@
-from typing import List, Literal, Union
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from typing import Callable, List, Literal, Optional, Union
 
 from qwen_agent.llm.schema import FUNCTION, Message
 from qwen_agent.utils.utils import format_as_multimodal_message, format_as_text_message, has_chinese_messages
 
+TOOL_SYSTEM_CACHE_SIZE = 128
+
+_tool_system_cache: 'OrderedDict[tuple, str]' = OrderedDict()
+_tool_system_cache_lock = threading.Lock()
+
+
+def fingerprint_functions(functions: List[dict]) -> str:
+    """A digest of the function list, which changes whenever a function is added, removed, reordered or altered."""
+    # Not sorting the keys is faster. Functions that only differ in the key order merely get separate cache entries.
+    dump = json.dumps(functions, default=str)
+    return hashlib.sha256(dump.encode('utf-8')).hexdigest()
+
+
+def render_tool_system_cached(render: Callable[..., str], functions: List[dict], *args) -> str:
+    """Return `render(functions, *args)`, memoized by the fingerprint of the functions and the other arguments.
+
+    The tool system prompt is otherwise rendered again on every LLM call of a function calling loop. Reusing the
+    rendered prompt also keeps the prompt prefix byte-identical across calls, which the model service can cache.
+    """
+    key = (render.__module__, render.__qualname__, fingerprint_functions(functions), args)
+    with _tool_system_cache_lock:
+        if key in _tool_system_cache:
+            _tool_system_cache.move_to_end(key)
+            return _tool_system_cache[key]
+    tool_system = render(functions, *args)
+    with _tool_system_cache_lock:
+        _tool_system_cache[key] = tool_system
+        while len(_tool_system_cache) > TOOL_SYSTEM_CACHE_SIZE:
+            _tool_system_cache.popitem(last=False)
+    return tool_system
+
 
 class BaseFnCallPrompt(object):
 
+    # The texts that end a function call and start a function result in the plaintext response, if the format has
+    # them. With both of them, BaseFnCallModel can stop a streamed response early, instead of letting the model
+    # service generate text that is discarded anyway.
+    fncall_end_token: Optional[str] = None
+    fncall_result_token: Optional[str] = None
+
     @staticmethod
     def preprocess_fncall_messages(messages: List[Message],
                                    functions: List[dict],
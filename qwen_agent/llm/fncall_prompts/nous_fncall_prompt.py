@@ -1,16 +1,17 @@
-import copy
 import json
 import os
-from typing import List, Literal, Union
+from typing import Dict, List, Literal, Optional, Tuple, Union
 
-import json5
-
-from qwen_agent.llm.fncall_prompts.base_fncall_prompt import BaseFnCallPrompt
+from qwen_agent.llm.fncall_prompts.base_fncall_prompt import BaseFnCallPrompt, render_tool_system_cached
 from qwen_agent.llm.schema import ASSISTANT, FUNCTION, SYSTEM, USER, ContentItem, FunctionCall, Message
+from qwen_agent.utils.utils import json_loads
 
 
 class NousFnCallPrompt(BaseFnCallPrompt):
 
+    fncall_end_token = '</tool_call>'
+    fncall_result_token = '<tool_response>'
+
     def preprocess_fncall_messages(self,
                                    messages: List[Message],
                                    functions: List[dict],
@@ -25,22 +26,23 @@ class NousFnCallPrompt(BaseFnCallPrompt):
 
         ori_messages = messages
 
-        # Change function_call responses to plaintext responses:
+        # Change function_call responses to plaintext responses.
+        # The input messages are not modified. A message is copied before content items are appended to it.
         messages = []
-        for msg in copy.deepcopy(ori_messages):
+        for msg in ori_messages:
             role, content, reasoning_content = msg.role, msg.content, msg.reasoning_content
             if role in (SYSTEM, USER):
-                messages.append(msg)
+                messages.append(msg.shallow_copy())
             elif role == ASSISTANT:
-                content = (content or [])
+                content = list(content or [])
                 fn_call = msg.function_call
                 if fn_call:
                     if (not SPECIAL_CODE_MODE) or (CODE_TOOL_PATTERN not in fn_call.name):
-                        fc = {'name': fn_call.name, 'arguments': json5.loads(fn_call.arguments)}
+                        fc = {'name': fn_call.name, 'arguments': json_loads(fn_call.arguments)}
                         fc = json.dumps(fc, ensure_ascii=False)
                         fc = f'<tool_call>\n{fc}\n</tool_call>'
                     else:
-                        para = json5.loads(fn_call.arguments)
+                        para = json_loads(fn_call.arguments)
                         code = para['code']
                         para['code'] = ''
                         fc = {'name': fn_call.name, 'arguments': para}
@@ -70,13 +72,7 @@ class NousFnCallPrompt(BaseFnCallPrompt):
             else:
                 raise TypeError
 
-        tool_descs = [{'type': 'function', 'function': f} for f in functions]
-        tool_names = [function.get('name_for_model', function.get('name', '')) for function in functions]
-        tool_descs = '\n'.join([json.dumps(f, ensure_ascii=False) for f in tool_descs])
-        if SPECIAL_CODE_MODE and any([CODE_TOOL_PATTERN in x for x in tool_names]):
-            tool_system = FN_CALL_TEMPLATE_WITH_CI.format(tool_descs=tool_descs)
-        else:
-            tool_system = FN_CALL_TEMPLATE.format(tool_descs=tool_descs)
+        tool_system = render_tool_system_cached(_render_tool_system, functions)
         if messages and messages[0].role == SYSTEM:
             messages[0].content.append(ContentItem(text='\n\n' + tool_system))
         else:
@@ -89,26 +85,37 @@ class NousFnCallPrompt(BaseFnCallPrompt):
         parallel_function_calls: bool = True,
         function_choice: Union[Literal['auto'], str] = 'auto',
         thought_in_content: bool = False,
+        stream_state: Optional[dict] = None,
     ) -> List[Message]:
         if function_choice != 'auto':
             raise NotImplementedError
+
+        if stream_state is None:
+            parser = NousToolCallParser()
+        else:
+            if 'nous_tool_call_parser' not in stream_state:
+                stream_state['nous_tool_call_parser'] = NousToolCallParser()
+            parser = stream_state['nous_tool_call_parser']
+
         # Convert plaintext responses to function_call responses:
         new_messages = []
-        for msg in messages:
+        for msg_idx, msg in enumerate(messages):
             role, content, reasoning_content, extra = msg.role, msg.content, msg.reasoning_content, msg.extra
             assert isinstance(content, list)
 
             if role in (SYSTEM, USER):
                 new_messages.append(
-                    Message(role=role, content=content, reasoning_content=reasoning_content, extra=extra))
+                    Message.fast_construct(role=role, content=content, reasoning_content=reasoning_content,
+                                           extra=extra))
                 continue
 
             # Reasoning content is placed in a separate message
             if reasoning_content:
-                new_messages.append(Message(role=role, content='', reasoning_content=reasoning_content, extra=extra))
+                new_messages.append(
+                    Message.fast_construct(role=role, content='', reasoning_content=reasoning_content, extra=extra))
 
             new_content = []
-            for item in content:
+            for item_idx, item in enumerate(content):
                 item_type, item_text = item.get_type_and_value()
 
                 if item_type != 'text':  # multimodal
@@ -116,95 +123,140 @@ class NousFnCallPrompt(BaseFnCallPrompt):
                     continue
                 if thought_in_content:
                     if '</think>' not in item_text:
-                        new_content.append(ContentItem(text=item_text))
+                        new_content.append(ContentItem.fast_construct(text=item_text))
                         continue
                     _item_text = item_text.split('</think>')
                     # assert len(_item_text) == 2
-                    new_content.append(ContentItem(text='</think>'.join(_item_text[:-1]) + '</think>'))
+                    new_content.append(ContentItem.fast_construct(text='</think>'.join(_item_text[:-1]) + '</think>'))
                     item_text = _item_text[-1]
 
-                i = item_text.find('<tool_call>')
-                # If no function call:
-                if i < 0:
-                    show_text = item_text
-                    if show_text:
-                        new_content.append(ContentItem(text=show_text))
-                    continue
-
-                # split tool-call to separate assistant msg
-                tool_call_list = item_text.split('<tool_call>')
-                pre_thought = tool_call_list[0]
-                if pre_thought.strip():
-                    new_content.append(ContentItem(text=pre_thought))
-                for txt in tool_call_list[1:]:
-                    if not txt.strip():
-                        continue
-
-                    if '</tool_call>' not in txt:
-                        # incomplete </tool_call>: This is to better represent incomplete tool calls in streaming output
-                        fn_name, fn_args = extract_fn(txt)
-                        if fn_name:  # need to call function
-                            if new_content:
-                                new_messages.append(Message(
-                                    role=role,
-                                    content=new_content,
-                                    extra=extra,
-                                ))  # split thought and function call
-                                new_content = []
-                            # TODO: process incomplete tool-call messages
-                            new_messages.append(
-                                Message(
-                                    role=ASSISTANT,
-                                    content=[],
-                                    function_call=FunctionCall(
-                                        name=fn_name,
-                                        arguments=fn_args,
-                                    ),
-                                    extra=extra,
-                                ))
+                for out in parser.parse(item_text, key=(msg_idx, item_idx)):
+                    if isinstance(out, ContentItem):
+                        new_content.append(out)
                         continue
-
-                    one_tool_call_txt = txt.split('</tool_call>')
-
-                    # The complete tool-call response
                     if new_content:
-                        new_messages.append(Message(
+                        new_messages.append(Message.fast_construct(
                             role=role,
                             content=new_content,
                             extra=extra,
                         ))  # split thought and function call
                         new_content = []
-                    if SPECIAL_CODE_MODE and '<code>' in one_tool_call_txt[0] and '</code>' in one_tool_call_txt[0]:
-                        _snips = one_tool_call_txt[0].split('<code>')
-                        fn = None
-                        for i, _s in enumerate(_snips):
-                            if i == 0:
-                                fn = json5.loads(_s)
-                            else:
-                                # TODO: support more flexible params
-                                code = _s.replace('</code>', '')
-                                fn['arguments']['code'] = code
-                    else:
-                        fn = json5.loads(one_tool_call_txt[0].strip())
-                    new_messages.append(
-                        Message(
-                            role=ASSISTANT,
-                            content=[],
-                            function_call=FunctionCall(
-                                name=fn['name'],
-                                arguments=json.dumps(fn['arguments'], ensure_ascii=False),
-                            ),
-                            extra=extra,
-                        ))
-                    # Expected not to output extra tails
-                    # if one_tool_call_txt[1].strip():
-                    #     new_content.append(ContentItem(text=one_tool_call_txt[1]))
+                    # The parser reuses its message objects in the later chunks, so they must not be modified
+                    new_messages.append(out.shallow_copy(extra=extra))
 
             if new_content:
-                new_messages.append(Message(role=role, content=new_content, extra=extra))
+                new_messages.append(Message.fast_construct(role=role, content=new_content, extra=extra))
         return new_messages
 
 
+class NousToolCallParser:
+    """Incremental parser of the <tool_call></tool_call> blocks in a streamed response.
+
+    Every chunk of a streamed response carries the full text generated so far. The parser remembers how far it has
+    got in each text, so that each chunk only scans the new text, and each completed tool call is parsed exactly once
+    and is represented by the same message object in all the later chunks.
+    """
+
+    def __init__(self):
+        self._states: Dict[Tuple[int, int], _NousParseState] = {}
+
+    def parse(self, text: str, key: Tuple[int, int] = (0, 0)) -> List[Union[ContentItem, Message]]:
+        """Split the text into the thought before the tool calls and the function_call messages."""
+        state = self._states.get(key)
+        if (state is None) or (not text.startswith(state.text)):
+            state = _NousParseState()
+            self._states[key] = state
+        state.text = text
+
+        while True:
+            if state.mode in ('thought', 'tail'):
+                i = text.find('<tool_call>', state.cursor)
+                if i < 0:
+                    break
+                if state.mode == 'thought':
+                    pre_thought = text[:i]
+                    if pre_thought.strip():
+                        state.closed.append(ContentItem.fast_construct(text=pre_thought))
+                state.cursor, state.mode = i + len('<tool_call>'), 'tool_call'
+            else:
+                i = text.find('<tool_call>', state.cursor)
+                j = text.find('</tool_call>', state.cursor)
+                if (j >= 0) and ((i < 0) or (j < i)):
+                    # The complete tool-call response
+                    state.closed.append(_parse_tool_call(text[state.cursor:j]))
+                    # Expected not to output extra tails, which are discarded
+                    state.cursor, state.mode = j + len('</tool_call>'), 'tail'
+                elif i >= 0:
+                    # An unclosed tool call followed by another tool call
+                    fn_msg = _parse_incomplete_tool_call(text[state.cursor:i])
+                    if fn_msg:
+                        state.closed.append(fn_msg)
+                    state.cursor = i + len('<tool_call>')
+                else:
+                    break
+
+        outputs = list(state.closed)
+        if state.mode == 'thought':
+            # If no function call:
+            if text:
+                outputs.append(ContentItem.fast_construct(text=text))
+        elif state.mode == 'tool_call':
+            # incomplete </tool_call>: This is to better represent incomplete tool calls in streaming output
+            fn_msg = _parse_incomplete_tool_call(text[state.cursor:])
+            if fn_msg:
+                outputs.append(fn_msg)
+        return outputs
+
+
+class _NousParseState:
+
+    def __init__(self):
+        self.text: str = ''
+        self.cursor: int = 0
+        self.mode: Literal['thought', 'tool_call', 'tail'] = 'thought'
+        self.closed: List[Union[ContentItem, Message]] = []
+
+
+def _parse_tool_call(txt: str) -> Message:
+    if SPECIAL_CODE_MODE and '<code>' in txt and '</code>' in txt:
+        _snips = txt.split('<code>')
+        fn = None
+        for i, _s in enumerate(_snips):
+            if i == 0:
+                fn = json_loads(_s)
+            else:
+                # TODO: support more flexible params
+                code = _s.replace('</code>', '')
+                fn['arguments']['code'] = code
+    else:
+        fn = json_loads(txt.strip())
+    return Message.fast_construct(
+        role=ASSISTANT,
+        content=[],
+        function_call=FunctionCall.fast_construct(
+            name=fn['name'],
+            arguments=json.dumps(fn['arguments'], ensure_ascii=False),
+        ),
+    )
+
+
+def _parse_incomplete_tool_call(txt: str) -> Optional[Message]:
+    if not txt.strip():
+        return None
+    fn_name, fn_args = extract_fn(txt)
+    if not fn_name:
+        return None
+    # TODO: process incomplete tool-call messages
+    return Message.fast_construct(
+        role=ASSISTANT,
+        content=[],
+        function_call=FunctionCall.fast_construct(
+            name=fn_name,
+            arguments=fn_args,
+        ),
+    )
+
+
 FN_CALL_TEMPLATE = """# Tools
 
 You may call one or more functions to assist with the user query.
@@ -243,6 +295,16 @@ Here is the code.
 </tool_call>"""
 
 
+def _render_tool_system(functions: List[dict]) -> str:
+    tool_descs = [{'type': 'function', 'function': f} for f in functions]
+    tool_names = [function.get('name_for_model', function.get('name', '')) for function in functions]
+    tool_descs = '\n'.join([json.dumps(f, ensure_ascii=False) for f in tool_descs])
+    if SPECIAL_CODE_MODE and any([CODE_TOOL_PATTERN in x for x in tool_names]):
+        return FN_CALL_TEMPLATE_WITH_CI.format(tool_descs=tool_descs)
+    else:
+        return FN_CALL_TEMPLATE.format(tool_descs=tool_descs)
+
+
 # Mainly for removing incomplete special tokens when streaming the output
 # This assumes that '<tool_call>\n{"name": "' is the special token for the NousFnCallPrompt
 def remove_incomplete_special_tokens(text: str) -> str:
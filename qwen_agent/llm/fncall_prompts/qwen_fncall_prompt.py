@@ -1,8 +1,8 @@
 import copy
 import json
-from typing import Dict, List, Literal, Union
+from typing import Dict, List, Literal, Optional, Tuple, Union
 
-from qwen_agent.llm.fncall_prompts.base_fncall_prompt import BaseFnCallPrompt
+from qwen_agent.llm.fncall_prompts.base_fncall_prompt import BaseFnCallPrompt, render_tool_system_cached
 from qwen_agent.llm.schema import ASSISTANT, FUNCTION, SYSTEM, USER, ContentItem, FunctionCall, Message
 from qwen_agent.utils.utils import extract_text_from_message
 
@@ -58,10 +58,7 @@ class QwenFnCallPrompt(BaseFnCallPrompt):
                 raise TypeError
 
         # Add a system prompt for function calling:
-        tool_desc_template = FN_CALL_TEMPLATE[lang + ('_parallel' if parallel_function_calls else '')]
-        tool_descs = '\n\n'.join(get_function_description(function, lang=lang) for function in functions)
-        tool_names = ','.join(function.get('name_for_model', function.get('name', '')) for function in functions)
-        tool_system = tool_desc_template.format(tool_descs=tool_descs, tool_names=tool_names)
+        tool_system = render_tool_system_cached(_render_tool_system, functions, lang, parallel_function_calls)
         if messages and messages[0].role == SYSTEM:
             messages[0].content.append(ContentItem(text='\n\n' + tool_system))
         else:
@@ -99,9 +96,17 @@ class QwenFnCallPrompt(BaseFnCallPrompt):
     def postprocess_fncall_messages(messages: List[Message],
                                     parallel_function_calls: bool = True,
                                     function_choice: Union[Literal['auto'], str] = 'auto',
+                                    stream_state: Optional[dict] = None,
                                     **kwargs) -> List[Message]:
         messages = copy.deepcopy(messages)
 
+        if stream_state is None:
+            parser = QwenToolCallParser()
+        else:
+            if 'qwen_tool_call_parser' not in stream_state:
+                stream_state['qwen_tool_call_parser'] = QwenToolCallParser()
+            parser = stream_state['qwen_tool_call_parser']
+
         # Prepend a prefix for function_choice:
         if function_choice not in ('auto', 'none'):
             if messages and messages[0].content:
@@ -124,16 +129,16 @@ class QwenFnCallPrompt(BaseFnCallPrompt):
 
         # Convert plaintext responses to function_call responses:
         new_messages = []
-        for msg in messages:
+        for msg_idx, msg in enumerate(messages):
             role, content, extra = msg.role, msg.content, msg.extra
             assert isinstance(content, list)
 
             if role in (SYSTEM, USER):
-                new_messages.append(Message(role=role, content=content, extra=extra))
+                new_messages.append(Message.fast_construct(role=role, content=content, extra=extra))
                 continue
 
             new_content = []
-            for item in content:
+            for item_idx, item in enumerate(content):
                 item_type, item_text = item.get_type_and_value()
 
                 if item_type != 'text':  # multimodal
@@ -149,7 +154,7 @@ class QwenFnCallPrompt(BaseFnCallPrompt):
                 if i < 0:
                     show_text = remove_incomplete_special_tokens(item_text)
                     if show_text:
-                        new_content.append(ContentItem(text=show_text))
+                        new_content.append(ContentItem.fast_construct(text=show_text))
                     continue
 
                 # If it says something before function call:
@@ -159,9 +164,9 @@ class QwenFnCallPrompt(BaseFnCallPrompt):
                         answer = answer[:-1]
                     show_text = remove_incomplete_special_tokens(answer)
                     if show_text:
-                        new_content.append(ContentItem(text=show_text))
+                        new_content.append(ContentItem.fast_construct(text=show_text))
                     if new_content:
-                        new_messages.append(Message(
+                        new_messages.append(Message.fast_construct(
                             role=role,
                             content=new_content,
                             extra=extra,
@@ -170,34 +175,9 @@ class QwenFnCallPrompt(BaseFnCallPrompt):
                     item_text = item_text[i:]
 
                 # If has function call:
-                for part in item_text.split(f'{FN_NAME}:'):
-                    if not part:
-                        continue
-                    if part.endswith('\n'):
-                        part = part[:-1]
-
-                    arg_sep = f'{FN_ARGS}:'
-                    i = part.find(arg_sep)
-                    if i < 0:
-                        fn_name = part.strip()
-                        list_of_fn_args = ['']
-                    else:
-                        fn_name = part[:i].strip()
-                        list_of_fn_args = [_.strip() for _ in part[i + len(arg_sep):].split(arg_sep)]
-                    fn_name = remove_incomplete_special_tokens(fn_name)
-                    for fn_args in list_of_fn_args:
-                        fn_args = remove_incomplete_special_tokens(fn_args)
-                        fn_args = remove_trailing_comment_of_fn_args(fn_args)
-                        new_messages.append(
-                            Message(
-                                role=ASSISTANT,
-                                content=[],
-                                function_call=FunctionCall(
-                                    name=fn_name,
-                                    arguments=fn_args,
-                                ),
-                                extra=extra,
-                            ))
+                for fn_msg in parser.parse(item_text, key=(msg_idx, item_idx)):
+                    # The parser reuses its message objects in the later chunks, so they must not be modified
+                    new_messages.append(fn_msg.shallow_copy(extra=extra))
 
                 # Keep only one function call if parallelism is disabled
                 if not parallel_function_calls:
@@ -212,10 +192,72 @@ class QwenFnCallPrompt(BaseFnCallPrompt):
                 return new_messages
 
             if new_content:
-                new_messages.append(Message(role=role, content=new_content, extra=extra))
+                new_messages.append(Message.fast_construct(role=role, content=new_content, extra=extra))
         return new_messages
 
 
+class QwenToolCallParser:
+    """Incremental parser of the function calls in a streamed response.
+
+    Every chunk of a streamed response carries the full text generated so far. A function call is complete once the
+    next one starts, so the parser keeps the messages of the complete function calls and, in later chunks, only
+    parses the text after the last complete function call.
+    """
+
+    def __init__(self):
+        self._states: Dict[Tuple[int, int], Tuple[str, int, List[Message]]] = {}  # key -> (text, cursor, closed)
+
+    def parse(self, text: str, key: Tuple[int, int] = (0, 0)) -> List[Message]:
+        """Parse the function calls in a text that starts with the function name token."""
+        sep = f'{FN_NAME}:'
+        assert text.startswith(sep)
+        state = self._states.get(key)
+        if (state is None) or (not text.startswith(state[0])):
+            cursor, closed = len(sep), []
+        else:
+            _, cursor, closed = state
+
+        while True:
+            i = text.find(sep, cursor)
+            if i < 0:
+                break
+            closed = closed + _parse_fn_part(text[cursor:i])
+            cursor = i + len(sep)
+        self._states[key] = (text, cursor, closed)
+        return closed + _parse_fn_part(text[cursor:])
+
+
+def _parse_fn_part(part: str) -> List[Message]:
+    if not part:
+        return []
+    if part.endswith('\n'):
+        part = part[:-1]
+
+    arg_sep = f'{FN_ARGS}:'
+    i = part.find(arg_sep)
+    if i < 0:
+        fn_name = part.strip()
+        list_of_fn_args = ['']
+    else:
+        fn_name = part[:i].strip()
+        list_of_fn_args = [_.strip() for _ in part[i + len(arg_sep):].split(arg_sep)]
+    fn_name = remove_incomplete_special_tokens(fn_name)
+    fn_messages = []
+    for fn_args in list_of_fn_args:
+        fn_args = remove_incomplete_special_tokens(fn_args)
+        fn_args = remove_trailing_comment_of_fn_args(fn_args)
+        fn_messages.append(
+            Message.fast_construct(
+                role=ASSISTANT,
+                content=[],
+                function_call=FunctionCall.fast_construct(
+                    name=fn_name,
+                    arguments=fn_args,
+                ),
+            ))
+    return fn_messages
+
+
 FN_NAME = '✿FUNCTION✿'
 FN_ARGS = '✿ARGS✿'
 FN_RESULT = '✿RESULT✿'
@@ -318,6 +360,13 @@ FN_CALL_TEMPLATE = {
 }
 
 
+def _render_tool_system(functions: List[dict], lang: Literal['en', 'zh'], parallel_function_calls: bool) -> str:
+    tool_desc_template = FN_CALL_TEMPLATE[lang + ('_parallel' if parallel_function_calls else '')]
+    tool_descs = '\n\n'.join(get_function_description(function, lang=lang) for function in functions)
+    tool_names = ','.join(function.get('name_for_model', function.get('name', '')) for function in functions)
+    return tool_desc_template.format(tool_descs=tool_descs, tool_names=tool_names)
+
+
 def get_function_description(function: Dict, lang: Literal['en', 'zh']) -> str:
     """
     Text description of function
@@ -4,6 +4,7 @@ from typing import Dict, Iterator, List, Literal, Optional, Union
 
 from qwen_agent.llm.base import BaseChatModel
 from qwen_agent.llm.schema import ASSISTANT, FUNCTION, USER, ContentItem, Message
+from qwen_agent.utils.utils import close_iterator
 
 
 class BaseFnCallModel(BaseChatModel, ABC):
@@ -53,17 +54,38 @@ class BaseFnCallModel(BaseChatModel, ABC):
         messages: List[Message],
         fncall_mode: bool,
         generate_cfg: dict,
+        stream_state: Optional[dict] = None,
     ) -> List[Message]:
-        messages = super()._postprocess_messages(messages, fncall_mode=fncall_mode, generate_cfg=generate_cfg)
+        messages = super()._postprocess_messages(messages,
+                                                 fncall_mode=fncall_mode,
+                                                 generate_cfg=generate_cfg,
+                                                 stream_state=stream_state)
         if fncall_mode:
             messages = self.fncall_prompt.postprocess_fncall_messages(
                 messages=messages,
                 parallel_function_calls=generate_cfg.get('parallel_function_calls', False),
                 function_choice=generate_cfg.get('function_choice', 'auto'),
                 thought_in_content=generate_cfg.get('thought_in_content', False),
+                stream_state=stream_state,
             )
         return messages
 
+    def _postprocess_messages_iterator(
+        self,
+        messages: Iterator[List[Message]],
+        fncall_mode: bool,
+        generate_cfg: dict,
+    ) -> Iterator[List[Message]]:
+        if fncall_mode and self.fncall_prompt.fncall_end_token and self.fncall_prompt.fncall_result_token:
+            messages = _stop_after_fncall(
+                messages,
+                end_token=self.fncall_prompt.fncall_end_token,
+                result_token=self.fncall_prompt.fncall_result_token,
+                # Only when given explicitly, since all the generated calls have been kept by default
+                stop_after_first=(generate_cfg.get('parallel_function_calls', None) is False),
+                thought_in_content=generate_cfg.get('thought_in_content', False))
+        return super()._postprocess_messages_iterator(messages, fncall_mode=fncall_mode, generate_cfg=generate_cfg)
+
     def _remove_fncall_messages(self, messages: List[Message], lang: Literal['en', 'zh']) -> List[Message]:
         # Change function calls into user messages so that the model won't try
         # to generate function calls when given functions and function_choice="none".
@@ -128,6 +150,57 @@ class BaseFnCallModel(BaseChatModel, ABC):
         return self._chat(messages, stream=stream, delta_stream=False, generate_cfg=generate_cfg)
 
 
+def _stop_after_fncall(messages_iter: Iterator[List[Message]], end_token: str, result_token: str,
+                       stop_after_first: bool, thought_in_content: bool) -> Iterator[List[Message]]:
+    """Stop a streamed response once the rest of it would be discarded by the postprocessing anyway.
+
+    That is, once the model starts to make up a function result after a complete function call, or, if
+    `stop_after_first` is set, right after the first complete function call. Closing the upstream iterator stops the
+    model service from generating further.
+    """
+    max_token_len = max(len(end_token), len(result_token))
+    searched = {}  # (msg_idx, item_idx) -> the length of the text already searched
+    try:
+        for messages in messages_iter:
+            for msg_idx, msg in enumerate(messages):
+                if msg.role != ASSISTANT:
+                    continue
+                if isinstance(msg.content, str):
+                    items = [msg.content]
+                else:
+                    items = [item.text if item.text is not None else '' for item in msg.content]
+                for item_idx, text in enumerate(items):
+                    start = searched.get((msg_idx, item_idx), 0)
+                    start = max(start - max_token_len + 1, 0) if start <= len(text) else 0
+                    if thought_in_content:
+                        k = text.rfind('</think>')
+                        if k < 0:
+                            continue
+                        start = max(start, k + len('</think>'))
+                    searched[(msg_idx, item_idx)] = len(text)
+
+                    k = text.find(end_token, start) if stop_after_first else -1
+                    if k >= 0:
+                        end = k + len(end_token)
+                    else:
+                        k = text.find(result_token, start)
+                        if (k < 0) or (text.rfind(end_token, 0, k) < 0):
+                            continue
+                        end = k
+
+                    # Drop the text that follows, which may contain an incomplete function call
+                    if isinstance(msg.content, str):
+                        msg = msg.shallow_copy(content=text[:end])
+                    else:
+                        msg = msg.shallow_copy(content=msg.content[:item_idx] +
+                                               [ContentItem.fast_construct(text=text[:end])])
+                    yield messages[:msg_idx] + [msg]
+                    return
+            yield messages
+    finally:
+        close_iterator(messages_iter)
+
+
 def simulate_response_completion_with_chat(messages: List[Message]) -> List[Message]:
     if messages and (messages[-1].role == ASSISTANT):
         assert (len(messages) > 1) and (messages[-2].role == USER)
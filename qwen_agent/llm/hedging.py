@@ -0,0 +1,165 @@
+import queue
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Iterator, List, Optional
+
+from qwen_agent.utils.utils import close_iterator
+
+
+class HedgePolicy:
+    """Hedged requests: If the first chunk of a stream has not arrived after a while, send a duplicate request and keep
+    whichever streams first. The slower one is closed as soon as it produces its first chunk.
+
+    The delay is a percentile of the recently observed times to first chunk, and `initial_delay` until enough samples
+    have been observed. The duplicate requests are capped at a `budget` fraction of all requests. With the `oai_pool`
+    model type, the duplicate request goes to another endpoint, since the pool avoids the endpoint that is busy with
+    the original request.
+
+    Enable it with `generate_cfg={'hedge': {'percentile': 95, 'budget': 0.1}}`. It applies to the streaming calls
+    with `delta_stream=False`.
+    """
+
+    def __init__(self,
+                 percentile: float = 95.0,
+                 initial_delay: float = 2.0,
+                 min_delay: float = 0.0,
+                 budget: float = 0.1,
+                 window: int = 200,
+                 min_samples: int = 20):
+        self.percentile = percentile
+        self.initial_delay = initial_delay
+        self.min_delay = min_delay
+        self.budget = budget
+        self.min_samples = min_samples
+        self._ttfts = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self.num_requests = 0
+        self.num_hedged = 0
+        self.num_hedge_wins = 0
+
+    @property
+    def delay(self) -> float:
+        """How long to wait for the first chunk before sending a duplicate request."""
+        with self._lock:
+            samples = sorted(self._ttfts)
+        if len(samples) < self.min_samples:
+            return self.initial_delay
+        k = min(int(len(samples) * self.percentile / 100), len(samples) - 1)
+        return max(samples[k], self.min_delay)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'num_requests': self.num_requests,
+                'num_hedged': self.num_hedged,
+                'num_hedge_wins': self.num_hedge_wins,
+                'hedge_rate': self.num_hedged / max(self.num_requests, 1),
+                'win_rate': self.num_hedge_wins / max(self.num_hedged, 1),
+            }
+
+    def _record_ttft(self, seconds: float):
+        with self._lock:
+            self._ttfts.append(seconds)
+
+    def _try_hedge(self) -> bool:
+        with self._lock:
+            if self.num_hedged + 1 <= self.budget * self.num_requests:
+                self.num_hedged += 1
+                return True
+            return False
+
+    def hedged(self, it_fn: Callable[[], Iterator]) -> Iterator:
+        """Iterate over `it_fn()`, which is called a second time if the first call is slow to produce a chunk."""
+        with self._lock:
+            self.num_requests += 1
+        lock = threading.Lock()
+        events = queue.Queue()
+        attempts: List[_Attempt] = []
+
+        def _start_attempt():
+            attempt = _Attempt(index=len(attempts))
+            attempts.append(attempt)
+            threading.Thread(target=self._fetch_first_chunk, args=(it_fn, attempt, events, lock), daemon=True).start()
+
+        winner: Optional[_Attempt] = None
+        try:
+            _start_attempt()
+            num_pending, errors = 1, []
+            timeout = self.delay
+            while winner is None:
+                try:
+                    attempt = events.get(timeout=timeout)
+                except queue.Empty:
+                    timeout = None
+                    if self._try_hedge():
+                        _start_attempt()
+                        num_pending += 1
+                    continue
+                num_pending -= 1
+                if attempt.error is not None:
+                    errors.append(attempt.error)
+                    if num_pending == 0:
+                        raise errors[0]
+                    continue
+                winner = attempt
+
+            if winner.index > 0:
+                with self._lock:
+                    self.num_hedge_wins += 1
+            self._cancel_losers(attempts, winner, lock)
+            if winner.has_first:
+                yield winner.first
+                yield from winner.it
+        finally:
+            self._cancel_losers(attempts, winner, lock)
+            if winner is not None:
+                close_iterator(winner.it)
+
+    def _fetch_first_chunk(self, it_fn: Callable[[], Iterator], attempt: '_Attempt', events: queue.Queue,
+                           lock: threading.Lock):
+        t0 = time.monotonic()
+        try:
+            attempt.it = it_fn()
+            try:
+                attempt.first = next(attempt.it)
+                attempt.has_first = True
+                self._record_ttft(time.monotonic() - t0)
+            except StopIteration:
+                pass
+        except Exception as e:
+            attempt.error = e
+        with lock:
+            lost = attempt.lost
+            attempt.finished = True
+        if lost:
+            close_iterator(attempt.it)
+        else:
+            events.put(attempt)
+
+    @staticmethod
+    def _cancel_losers(attempts: List['_Attempt'], winner: Optional['_Attempt'], lock: threading.Lock):
+        # The running attempts close their streams themselves once they get the first chunk, since a generator cannot
+        # be closed while another thread is running it.
+        for attempt in attempts:
+            if attempt is winner:
+                continue
+            with lock:
+                if attempt.lost:
+                    continue
+                attempt.lost = True
+                finished = attempt.finished
+            if finished:
+                close_iterator(attempt.it)
+
+
+class _Attempt:
+
+    def __init__(self, index: int):
+        self.index = index
+        self.it: Optional[Iterator] = None
+        self.first: Any = None
+        self.has_first = False
+        self.error: Optional[Exception] = None
+        self.finished = False
+        self.lost = False
@@ -0,0 +1,198 @@
+import json
+import math
+import threading
+import time
+from collections import deque
+from typing import Dict, List, Optional, Tuple
+
+from qwen_agent.llm.usage import cache_hit_ratio
+from qwen_agent.log import logger
+
+
+class CallMetrics:
+    """The timings of one LLM call, from the call of `BaseChatModel.chat` to the end of its output.
+
+    The record produced by `as_dict` contains:
+        queue_time: The seconds before the request is sent, e.g., spent on preprocessing and waiting for the rate limit.
+        ttft: The seconds from sending the request to receiving the first chunk.
+        duration: The seconds from the call of `chat` to the end of the output.
+        model_time: The seconds spent waiting for the model service.
+        client_time: The rest of the duration, i.e., the time spent in qwen-agent and the consumer of the stream.
+        completion_tokens, tokens_per_second: The output tokens, and their rate after the first chunk.
+        prompt_tokens, cached_tokens, cache_hit_ratio: The input tokens, and the part served by the prefix cache, if
+          the model service reports them.
+        num_chunks, itl_p50, itl_p90, itl_p99, itl_max: The chunks, and the percentiles of the gaps between them.
+    """
+
+    def __init__(self, model: str, model_type: str, stream: bool):
+        self.model = model
+        self.model_type = model_type
+        self.stream = stream
+        self.start = time.monotonic()
+        self.request_sent: Optional[float] = None
+        self.chunk_times: List[float] = []
+        self.model_time = 0.0
+
+    def mark_request_sent(self):
+        # Marked again by each retry
+        self.request_sent = time.monotonic()
+
+    def add_chunk(self, wait_start: float):
+        now = time.monotonic()
+        self.model_time += now - wait_start
+        self.chunk_times.append(now)
+
+    def as_dict(self, completion_tokens: int = 0, prompt_tokens: int = 0, cached_tokens: Optional[int] = None) -> dict:
+        end = time.monotonic()
+        request_sent = self.request_sent or self.start
+        first = self.chunk_times[0] if self.chunk_times else end
+        gaps = sorted(b - a for a, b in zip(self.chunk_times, self.chunk_times[1:]))
+        duration = end - self.start
+        return {
+            'model': self.model,
+            'model_type': self.model_type,
+            'stream': self.stream,
+            'queue_time': request_sent - self.start,
+            'ttft': first - request_sent,
+            'duration': duration,
+            'model_time': self.model_time,
+            'client_time': max(duration - self.model_time, 0.0),
+            'completion_tokens': completion_tokens,
+            'prompt_tokens': prompt_tokens,
+            'cached_tokens': cached_tokens,
+            'cache_hit_ratio': cache_hit_ratio(prompt_tokens, cached_tokens),
+            'tokens_per_second': (completion_tokens / (end - first)) if end > first else None,
+            'num_chunks': len(self.chunk_times),
+            'itl_p50': _percentile(gaps, 50),
+            'itl_p90': _percentile(gaps, 90),
+            'itl_p99': _percentile(gaps, 99),
+            'itl_max': gaps[-1] if gaps else None,
+        }
+
+
+def _percentile(sorted_values: List[float], percentile: float) -> Optional[float]:
+    if not sorted_values:
+        return None
+    k = max(math.ceil(len(sorted_values) * percentile / 100) - 1, 0)
+    return sorted_values[k]
+
+
+class MetricsSink:
+    """Receives the metrics of every LLM call, once the call is complete. See `CallMetrics` for the fields."""
+
+    def record(self, metrics: dict):
+        raise NotImplementedError
+
+
+class InMemoryMetricsSink(MetricsSink):
+    """Keeps the latest `maxlen` records in memory."""
+
+    def __init__(self, maxlen: int = 1000):
+        self.records = deque(maxlen=maxlen)
+
+    def record(self, metrics: dict):
+        self.records.append(metrics)
+
+
+class LogMetricsSink(MetricsSink):
+    """Logs every record as one JSON line."""
+
+    def record(self, metrics: dict):
+        logger.info('LLM metrics: ' + json.dumps(metrics, ensure_ascii=False))
+
+
+# The upper bounds of the histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class PrometheusMetricsSink(MetricsSink):
+    """Aggregates the records into histograms per model, and renders them in the Prometheus text format, e.g., to be
+    served at the `/metrics` endpoint of an application."""
+
+    HISTOGRAMS = ('queue_time', 'ttft', 'duration', 'itl_p50')
+    COUNTERS = ('completion_tokens', 'prompt_tokens', 'cached_tokens')
+
+    def __init__(self, prefix: str = 'qwen_agent_llm', buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.prefix = prefix
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        # {(model_type, model): {name: [bucket counts..., count, sum]}}
+        self._histograms: Dict[Tuple[str, str], Dict[str, list]] = {}
+        self._counters: Dict[Tuple[str, str], Dict[str, float]] = {}
+
+    def record(self, metrics: dict):
+        labels = (metrics['model_type'], metrics['model'])
+        with self._lock:
+            histograms = self._histograms.setdefault(labels, {})
+            for name in self.HISTOGRAMS:
+                value = metrics.get(name)
+                if value is None:
+                    continue
+                h = histograms.setdefault(name, [0] * (len(self.buckets) + 2))
+                for i, bound in enumerate(self.buckets):
+                    if value <= bound:
+                        h[i] += 1
+                h[-2] += 1
+                h[-1] += value
+            counters = self._counters.setdefault(labels, {})
+            counters['requests'] = counters.get('requests', 0) + 1
+            for name in self.COUNTERS:
+                counters[name] = counters.get(name, 0) + (metrics.get(name) or 0)
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            for name in self.HISTOGRAMS:
+                metric = f'{self.prefix}_{name}_seconds'
+                lines.append(f'# TYPE {metric} histogram')
+                for labels, histograms in self._histograms.items():
+                    if name not in histograms:
+                        continue
+                    h, label_str = histograms[name], _format_labels(labels)
+                    for i, bound in enumerate(self.buckets):
+                        lines.append(f'{metric}_bucket{{{label_str},le="{bound}"}} {h[i]}')
+                    lines.append(f'{metric}_bucket{{{label_str},le="+Inf"}} {h[-2]}')
+                    lines.append(f'{metric}_count{{{label_str}}} {h[-2]}')
+                    lines.append(f'{metric}_sum{{{label_str}}} {h[-1]}')
+            for name in ('requests',) + self.COUNTERS:
+                metric = f'{self.prefix}_{name}_total'
+                lines.append(f'# TYPE {metric} counter')
+                for labels, counters in self._counters.items():
+                    lines.append(f'{metric}{{{_format_labels(labels)}}} {counters.get(name, 0)}')
+        return '\n'.join(lines) + '\n'
+
+
+def _format_labels(labels: Tuple[str, str]) -> str:
+    model_type, model = [v.replace('\\', '\\\\').replace('"', '\\"') for v in labels]
+    return f'model_type="{model_type}",model="{model}"'
+
+
+_sinks: List[MetricsSink] = []
+_sinks_lock = threading.Lock()
+
+
+def add_metrics_sink(sink: MetricsSink):
+    """Send the metrics of all the LLM calls of the process to the sink. The metrics are collected once there is a
+    sink, or when the LLM is configured with `generate_cfg={'metrics': True}`."""
+    with _sinks_lock:
+        _sinks.append(sink)
+
+
+def remove_metrics_sink(sink: MetricsSink):
+    with _sinks_lock:
+        if sink in _sinks:
+            _sinks.remove(sink)
+
+
+def has_metrics_sinks() -> bool:
+    return bool(_sinks)
+
+
+def emit_metrics(metrics: dict):
+    with _sinks_lock:
+        sinks = list(_sinks)
+    for sink in sinks:
+        try:
+            sink.record(metrics)
+        except Exception as e:
+            logger.warning(f'Failed to record the LLM metrics to {type(sink).__name__}: {e}')
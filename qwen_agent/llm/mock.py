@@ -0,0 +1,158 @@
+import json
+import random
+import re
+import threading
+import time
+from typing import Dict, Iterator, List, Optional, Union
+
+from qwen_agent.llm.base import ModelServiceError, register_llm
+from qwen_agent.llm.function_calling import BaseFnCallModel
+from qwen_agent.llm.schema import ASSISTANT, USER, Message
+from qwen_agent.utils.utils import extract_text_from_message
+
+
+@register_llm('mock')
+class MockChatModel(BaseFnCallModel):
+    """A deterministic local LLM, for testing and benchmarking the agents without a model service.
+
+    It runs in-process and goes through the same preprocessing, function call templating, postprocessing and retries
+    as the real LLMs. Example cfg:
+        llm_cfg = {
+            'model_type': 'mock',
+            # The responses, used in turn and then from the start again. A response is either a text, or a dict of
+            # the content and the tool calls, which are written in the format of the fncall_prompt_type.
+            # The texts may contain the placeholders {call_index} and {last_user}, i.e., the text of the last user
+            # message of the prompt, after the function calls are templated.
+            'responses': [
+                {'content': 'Let me check.', 'tool_calls': [{'name': 'get_weather', 'arguments': {'city': 'Paris'}}]},
+                'The weather in Paris is sunny.',
+            ],
+            # Without responses, each response is filler text of this many tokens:
+            # 'response_tokens': 32,
+            'ttft': 0.2,  # The seconds to the first chunk
+            'tokens_per_second': 50,  # The rate of the following chunks, or 0 to not wait
+            'chunk_tokens': 1,  # The tokens per chunk
+            'error_rate': 0.0,  # The probability that a call fails with error_code
+            'fail_first': 0,  # The number of the first calls that fail with error_code
+            'error_code': '500',
+            'seed': 0,  # The seed of the error injection
+            'generate_cfg': {'fncall_prompt_type': 'nous'},
+        }
+
+    A token is a word, a run of spaces or a CJK character, which also makes up the reported token usage.
+    """
+
+    def __init__(self, cfg: Optional[Dict] = None):
+        cfg = cfg or {}
+        self.fncall_prompt_type = (cfg.get('generate_cfg') or {}).get('fncall_prompt_type', 'nous')
+        super().__init__(cfg)
+        self.model = self.model or 'mock'
+        self.responses: List[Union[str, dict]] = cfg.get('responses') or []
+        self.response_tokens: int = cfg.get('response_tokens', 32)
+        self.ttft: float = cfg.get('ttft', 0.0)
+        self.tokens_per_second: float = cfg.get('tokens_per_second', 0)
+        self.chunk_tokens: int = max(cfg.get('chunk_tokens', 1), 1)
+        self.error_rate: float = cfg.get('error_rate', 0.0)
+        self.fail_first: int = cfg.get('fail_first', 0)
+        self.error_code: str = str(cfg.get('error_code', '500'))
+        self._random = random.Random(cfg.get('seed', 0))
+        self._lock = threading.Lock()
+        self.num_calls = 0
+
+    def _chat_stream(
+        self,
+        messages: List[Message],
+        delta_stream: bool,
+        generate_cfg: dict,
+    ) -> Iterator[List[Message]]:
+        text, usage = self._start_call(messages)
+        tokens = tokenize(text)
+        if self.ttft > 0:
+            time.sleep(self.ttft)
+        full_text = ''
+        for i in range(0, len(tokens), self.chunk_tokens):
+            if i > 0 and self.tokens_per_second > 0:
+                time.sleep(self.chunk_tokens / self.tokens_per_second)
+            new_text = ''.join(tokens[i:i + self.chunk_tokens])
+            full_text += new_text
+            yield [Message(ASSISTANT, new_text if delta_stream else full_text)]
+        yield [Message(ASSISTANT, '' if delta_stream else full_text, extra={'usage': usage})]
+
+    def _chat_no_stream(
+        self,
+        messages: List[Message],
+        generate_cfg: dict,
+    ) -> List[Message]:
+        text, usage = self._start_call(messages)
+        delay = self.ttft
+        if self.tokens_per_second > 0:
+            delay += usage['completion_tokens'] / self.tokens_per_second
+        if delay > 0:
+            time.sleep(delay)
+        return [Message(ASSISTANT, text, extra={'usage': usage})]
+
+    def _start_call(self, messages: List[Message]):
+        with self._lock:
+            call_index = self.num_calls
+            self.num_calls += 1
+            fail = (call_index < self.fail_first) or (self.error_rate > 0 and self._random.random() < self.error_rate)
+        if fail:
+            raise ModelServiceError(code=self.error_code, message=f'Mock error of call {call_index}')
+
+        last_user = ''
+        for msg in reversed(messages):
+            if msg.role == USER:
+                last_user = extract_text_from_message(msg, add_upload_info=False)
+                break
+        if self.responses:
+            response = self.responses[call_index % len(self.responses)]
+        else:
+            response = filler_text(self.response_tokens)
+        text = self._render_response(response).replace('{last_user}',
+                                                       last_user).replace('{call_index}', str(call_index))
+
+        prompt_tokens = sum(len(tokenize(extract_text_from_message(msg, add_upload_info=False))) for msg in messages)
+        completion_tokens = len(tokenize(text))
+        usage = {
+            'prompt_tokens': prompt_tokens,
+            'completion_tokens': completion_tokens,
+            'total_tokens': prompt_tokens + completion_tokens,
+            'cached_tokens': 0,
+        }
+        return text, usage
+
+    def _render_response(self, response: Union[str, dict]) -> str:
+        if isinstance(response, str):
+            return response
+        parts = [response['content']] if response.get('content') else []
+        tool_calls = response.get('tool_calls', [])
+        if self.fncall_prompt_type == 'qwen':
+            from qwen_agent.llm.fncall_prompts.qwen_fncall_prompt import FN_ARGS, FN_NAME, FN_RESULT
+            for call in tool_calls:
+                parts.append(f'{FN_NAME}: {call["name"]}\n{FN_ARGS}: {_dump_arguments(call)}')
+            if tool_calls:
+                parts.append(FN_RESULT)
+        else:
+            for call in tool_calls:
+                fc = json.dumps({'name': call['name'], 'arguments': call.get('arguments', {})}, ensure_ascii=False)
+                parts.append(f'<tool_call>\n{fc}\n</tool_call>')
+        return '\n'.join(parts)
+
+
+def _dump_arguments(call: dict) -> str:
+    arguments = call.get('arguments', {})
+    return arguments if isinstance(arguments, str) else json.dumps(arguments, ensure_ascii=False)
+
+
+_TOKEN_PATTERN = re.compile(r'[\u4e00-\u9fff]|\s*[^\s\u4e00-\u9fff]+|\s+')
+
+_FILLER_WORDS = ('the', 'quick', 'brown', 'fox', 'jumps', 'over', 'a', 'lazy', 'dog', 'and', 'runs', 'away')
+
+
+def tokenize(text: str) -> List[str]:
+    """Split the text into the tokens of the mock LLM, which join back into the text."""
+    return _TOKEN_PATTERN.findall(text)
+
+
+def filler_text(num_tokens: int) -> str:
+    return ''.join((' ' if i else '') + _FILLER_WORDS[i % len(_FILLER_WORDS)] for i in range(num_tokens))
@@ -2,7 +2,8 @@ import copy
 import logging
 import os
 from pprint import pformat
-from typing import Dict, Iterator, List, Optional
+from typing import Dict, Iterator, List, Literal, Optional, Union
+from urllib.parse import urlparse
 
 import openai
 
@@ -11,16 +12,26 @@ if openai.__version__.startswith('0.'):
 else:
     from openai import OpenAIError
 
-from qwen_agent.llm.base import ModelServiceError, register_llm
+from qwen_agent.llm.base import BaseChatModel, ModelServiceError, register_llm
 from qwen_agent.llm.function_calling import BaseFnCallModel
-from qwen_agent.llm.schema import ASSISTANT, Message
+from qwen_agent.llm.schema import ASSISTANT, FUNCTION, FunctionCall, Message
+from qwen_agent.llm.usage import normalize_usage
 from qwen_agent.log import logger
 
+# The model services known to accept `stream_options`, through which the token usage of a stream is requested
+STREAM_USAGE_HOSTS = ('api.openai.com', 'dashscope.aliyuncs.com', 'dashscope-intl.aliyuncs.com')
+
 
 @register_llm('oai')
 class TextChatAtOAI(BaseFnCallModel):
 
     def __init__(self, cfg: Optional[Dict] = None):
+        # With fncall_prompt_type='native', the functions are sent as `tools`, and the model service parses the tool
+        # calls, e.g., vLLM with `--enable-auto-tool-choice`. No function calling template is applied on our side.
+        self.native_fncall = ((cfg or {}).get('generate_cfg') or {}).get('fncall_prompt_type') == 'native'
+        if self.native_fncall:
+            cfg = copy.deepcopy(cfg)
+            del cfg['generate_cfg']['fncall_prompt_type']
         super().__init__(cfg)
         self.model = self.model or 'gpt-4o-mini'
         cfg = cfg or {}
@@ -34,6 +45,11 @@ class TextChatAtOAI(BaseFnCallModel):
         api_key = api_key or os.getenv('OPENAI_API_KEY')
         api_key = (api_key or 'EMPTY').strip()
 
+        # Other servers may reject the unknown field, so they need to opt in by setting `stream_options` themselves
+        host = (urlparse(api_base).hostname or '') if api_base else 'api.openai.com'
+        self.stream_usage = (not openai.__version__.startswith('0.')) and any(
+            host == h or host.endswith('.' + h) for h in STREAM_USAGE_HOSTS)
+
         if openai.__version__.startswith('0.'):
             if api_base:
                 openai.api_base = api_base
@@ -86,33 +102,59 @@ class TextChatAtOAI(BaseFnCallModel):
         generate_cfg: dict,
     ) -> Iterator[List[Message]]:
         messages = self.convert_messages_to_dicts(messages)
+        # Ask for the token usage, which arrives in an extra chunk at the end of the stream. This is only done by
+        # default for the services in STREAM_USAGE_HOSTS; others can set `stream_options` in generate_cfg.
+        generate_cfg = copy.copy(generate_cfg)
+        if self.stream_usage:
+            generate_cfg.setdefault('stream_options', {'include_usage': True})
+        if generate_cfg.get('stream_options', '') is None:
+            del generate_cfg['stream_options']
+        response = None
         try:
             response = self._chat_complete_create(model=self.model, messages=messages, stream=True, **generate_cfg)
             if delta_stream:
                 for chunk in response:
+                    if getattr(chunk, 'usage', None) and (not chunk.choices):
+                        yield [
+                            Message.fast_construct(role=ASSISTANT,
+                                                   content='',
+                                                   extra={'usage': normalize_usage(chunk.usage)})
+                        ]
                     if chunk.choices:
                         if hasattr(chunk.choices[0].delta,
                                    'reasoning_content') and chunk.choices[0].delta.reasoning_content:
                             yield [
-                                Message(role=ASSISTANT,
-                                        content='',
-                                        reasoning_content=chunk.choices[0].delta.reasoning_content)
+                                Message.fast_construct(role=ASSISTANT,
+                                                       content='',
+                                                       reasoning_content=chunk.choices[0].delta.reasoning_content)
                             ]
                         if hasattr(chunk.choices[0].delta, 'content') and chunk.choices[0].delta.content:
-                            yield [Message(role=ASSISTANT, content=chunk.choices[0].delta.content)]
+                            yield [Message.fast_construct(role=ASSISTANT, content=chunk.choices[0].delta.content)]
             else:
                 full_response = ''
                 full_reasoning_content = ''
+                full_tool_calls = []
                 for chunk in response:
+                    if getattr(chunk, 'usage', None) and (not chunk.choices):
+                        yield _build_response(full_response,
+                                              full_reasoning_content,
+                                              full_tool_calls,
+                                              extra={'usage': normalize_usage(chunk.usage)})
                     if chunk.choices:
                         if hasattr(chunk.choices[0].delta,
                                    'reasoning_content') and chunk.choices[0].delta.reasoning_content:
                             full_reasoning_content += chunk.choices[0].delta.reasoning_content
                         if hasattr(chunk.choices[0].delta, 'content') and chunk.choices[0].delta.content:
                             full_response += chunk.choices[0].delta.content
-                        yield [Message(role=ASSISTANT, content=full_response, reasoning_content=full_reasoning_content)]
+                        for tool_call in (getattr(chunk.choices[0].delta, 'tool_calls', None) or []):
+                            _add_tool_call_delta(full_tool_calls, tool_call)
+                        yield _build_response(full_response, full_reasoning_content, full_tool_calls)
         except OpenAIError as ex:
             raise ModelServiceError(exception=ex)
+        finally:
+            # Close the HTTP stream, which aborts the generation if the consumer stops early
+            if hasattr(response, 'close'):
+                response.close()
 
     def _chat_no_stream(
         self,
@@ -122,14 +164,16 @@ class TextChatAtOAI(BaseFnCallModel):
         messages = self.convert_messages_to_dicts(messages)
         try:
             response = self._chat_complete_create(model=self.model, messages=messages, stream=False, **generate_cfg)
-            if hasattr(response.choices[0].message, 'reasoning_content'):
-                return [
-                    Message(role=ASSISTANT,
-                            content=response.choices[0].message.content,
-                            reasoning_content=response.choices[0].message.reasoning_content)
-                ]
-            else:
-                return [Message(role=ASSISTANT, content=response.choices[0].message.content)]
+            message = response.choices[0].message
+            tool_calls = [{
+                'id': tool_call.id,
+                'name': tool_call.function.name,
+                'arguments': tool_call.function.arguments
+            } for tool_call in (getattr(message, 'tool_calls', None) or [])]
+            return _build_response(message.content or '',
+                                   getattr(message, 'reasoning_content', None),
+                                   tool_calls,
+                                   extra={'usage': normalize_usage(getattr(response, 'usage', None))})
         except OpenAIError as ex:
             raise ModelServiceError(exception=ex)
 
@@ -138,8 +182,149 @@ class TextChatAtOAI(BaseFnCallModel):
         # TODO: Change when the VLLM deployed model needs to pass reasoning_complete.
         #  At this time, in order to be compatible with lower versions of vLLM,
         #  and reasoning content is currently not useful
-        messages = [msg.model_dump() for msg in messages]
+        messages = convert_fncall_messages_to_oai([msg.model_dump() for msg in messages])
 
         if logger.isEnabledFor(logging.DEBUG):
             logger.debug(f'LLM Input:\n{pformat(messages, indent=2)}')
         return messages
+
+    def _preprocess_messages(
+        self,
+        messages: List[Message],
+        lang: Literal['en', 'zh'],
+        generate_cfg: dict,
+        functions: Optional[List[Dict]] = None,
+    ) -> List[Message]:
+        if self.native_fncall and functions and (generate_cfg.get('function_choice', 'auto') != 'none'):
+            # Keep the function calls and results as they are, without the function calling template
+            return BaseChatModel._preprocess_messages(self,
+                                                      messages,
+                                                      lang=lang,
+                                                      generate_cfg=generate_cfg,
+                                                      functions=functions)
+        return super()._preprocess_messages(messages, lang=lang, generate_cfg=generate_cfg, functions=functions)
+
+    def _postprocess_messages(
+        self,
+        messages: List[Message],
+        fncall_mode: bool,
+        generate_cfg: dict,
+        stream_state: Optional[dict] = None,
+    ) -> List[Message]:
+        # The tool calls parsed by the model service need no parsing on our side
+        return super()._postprocess_messages(messages,
+                                             fncall_mode=fncall_mode and (not self.native_fncall),
+                                             generate_cfg=generate_cfg,
+                                             stream_state=stream_state)
+
+    def _postprocess_messages_iterator(
+        self,
+        messages: Iterator[List[Message]],
+        fncall_mode: bool,
+        generate_cfg: dict,
+    ) -> Iterator[List[Message]]:
+        return super()._postprocess_messages_iterator(messages,
+                                                      fncall_mode=fncall_mode and (not self.native_fncall),
+                                                      generate_cfg=generate_cfg)
+
+    def _chat_with_functions(
+        self,
+        messages: List[Message],
+        functions: List[Dict],
+        stream: bool,
+        delta_stream: bool,
+        generate_cfg: dict,
+        lang: Literal['en', 'zh'],
+    ) -> Union[List[Message], Iterator[List[Message]]]:
+        if not self.native_fncall:
+            return super()._chat_with_functions(messages,
+                                                functions=functions,
+                                                stream=stream,
+                                                delta_stream=delta_stream,
+                                                generate_cfg=generate_cfg,
+                                                lang=lang)
+        if delta_stream:
+            raise NotImplementedError('Please use stream=True with delta_stream=False, because delta_stream=True'
+                                      ' is not implemented for function calling due to some technical reasons.')
+        generate_cfg = copy.copy(generate_cfg)
+        fn_choice = generate_cfg.pop('function_choice', 'auto')
+        parallel_function_calls = generate_cfg.pop('parallel_function_calls', None)
+        generate_cfg.pop('thought_in_content', None)
+
+        tools = []
+        for f in functions:
+            f = {k: v for k, v in f.items() if k in ('name', 'description', 'parameters')}
+            tools.append({'type': 'function', 'function': f})
+        generate_cfg['tools'] = tools
+        if fn_choice != 'auto':
+            generate_cfg['tool_choice'] = {'type': 'function', 'function': {'name': fn_choice}}
+        if parallel_function_calls is not None:
+            # Only when given explicitly, like the templates, which keep all the generated calls by default
+            generate_cfg['parallel_tool_calls'] = parallel_function_calls
+        return self._chat(messages, stream=stream, delta_stream=False, generate_cfg=generate_cfg)
+
+
+def _add_tool_call_delta(tool_calls: List[dict], delta) -> None:
+    """Merge one streamed `tool_calls` delta into the tool calls received so far."""
+    index = delta.index if (getattr(delta, 'index', None) is not None) else len(tool_calls)
+    while len(tool_calls) <= index:
+        tool_calls.append({'id': '', 'name': '', 'arguments': ''})
+    tool_call = tool_calls[index]
+    if delta.id:
+        tool_call['id'] = delta.id
+    if delta.function is not None:
+        tool_call['name'] += delta.function.name or ''
+        tool_call['arguments'] += delta.function.arguments or ''
+
+
+def _build_response(content: str,
+                    reasoning_content: Optional[str],
+                    tool_calls: List[dict],
+                    extra: Optional[dict] = None) -> List[Message]:
+    """Build the messages of a response in the same layout as the function calling templates produce, i.e., the
+    text first, followed by one message per function call."""
+    messages = []
+    if content or reasoning_content or (not tool_calls):
+        messages.append(Message.fast_construct(role=ASSISTANT, content=content, reasoning_content=reasoning_content))
+    for tool_call in tool_calls:
+        messages.append(
+            Message.fast_construct(role=ASSISTANT,
+                                   content='',
+                                   function_call=FunctionCall.fast_construct(name=tool_call['name'],
+                                                                             arguments=tool_call['arguments']),
+                                   extra={'function_id': tool_call['id']}))
+    if extra:
+        messages[-1] = messages[-1].shallow_copy(extra={**(messages[-1].extra or {}), **extra})
+    return messages
+
+
+def convert_fncall_messages_to_oai(messages: List[dict]) -> List[dict]:
+    """Convert the function calls and results of the dumped messages into the `tool_calls` and the tool messages of
+    the OpenAI API, and drop the fields that the API does not accept.
+
+    The consecutive calls are merged into the preceding assistant message. The results are matched with the calls in
+    order, unless they have `function_id` in their extra.
+    """
+    new_messages = []
+    pending_ids = []  # The ids of the calls whose results are yet to come
+    num_calls = 0
+    for msg in messages:
+        extra = msg.pop('extra', None) or {}
+        function_call = msg.pop('function_call', None)
+        if function_call:
+            num_calls += 1
+            call_id = extra.get('function_id') or f'call_{num_calls}'
+            tool_call = {'id': call_id, 'type': 'function', 'function': function_call}
+            if new_messages and (new_messages[-1]['role'] == ASSISTANT):
+                new_messages[-1].setdefault('tool_calls', []).append(tool_call)
+            else:
+                new_messages.append({'role': ASSISTANT, 'content': msg.get('content') or '', 'tool_calls': [tool_call]})
+            pending_ids.append(call_id)
+        elif msg['role'] == FUNCTION:
+            call_id = extra.get('function_id') or (pending_ids[0] if pending_ids else '')
+            if call_id in pending_ids:
+                pending_ids.remove(call_id)
+            new_messages.append({'role': 'tool', 'tool_call_id': call_id, 'content': msg['content']})
+        else:
+            new_messages.append(msg)
+    return new_messages
@@ -0,0 +1,209 @@
+import copy
+import threading
+import time
+from typing import Dict, Iterator, List, Literal, Optional, Sequence
+
+from qwen_agent.llm.base import ModelServiceError, register_llm
+from qwen_agent.llm.function_calling import BaseFnCallModel
+from qwen_agent.llm.oai import TextChatAtOAI
+from qwen_agent.llm.schema import Message
+from qwen_agent.log import logger
+from qwen_agent.utils.tokenization_qwen import count_tokens_cached
+from qwen_agent.utils.utils import close_iterator, extract_text_from_message
+
+# The keys of the pool configuration, which are not passed on to the endpoints
+POOL_CFG_KEYS = ('model_servers', 'load_balance', 'failure_threshold', 'cooldown')
+
+
+class _Endpoint:
+    """One model service in the pool, together with its load and its circuit breaker state."""
+
+    def __init__(self, llm: TextChatAtOAI, name: str):
+        self.llm = llm
+        self.name = name
+        self.in_flight = 0
+        self.queued_tokens = 0  # The estimated input tokens of the in-flight requests
+        self.consecutive_failures = 0
+        self.open_until = 0.0  # The endpoint is ejected from the pool until this time
+        self.trial_in_flight = False  # Whether the single trial request after the cooldown is running
+        self.num_requests = 0
+        self.num_failures = 0
+
+
+@register_llm('oai_pool')
+class TextChatAtOAIPool(BaseFnCallModel):
+    """A pool of OpenAI-compatible model services that serve the same model, e.g., several vLLM replicas.
+
+    Each request goes to the healthy endpoint with the least outstanding load, i.e., the fewest in-flight requests,
+    or the fewest queued input tokens if `load_balance` is 'tokens'. Ties are broken in a round-robin fashion.
+
+    An endpoint that fails `failure_threshold` times in a row is ejected for `cooldown` seconds (the circuit breaker is
+    open), after which a single trial request decides whether it rejoins the pool. A request that fails before any
+    output is received is sent to another endpoint right away. The other errors are raised as ModelServiceError and go
+    through the usual retry mechanism, which is configured by `max_retries` in `generate_cfg`.
+
+    Example:
+        llm_cfg = {
+            'model': 'Qwen2.5-7B-Instruct',
+            'model_type': 'oai_pool',
+            'model_servers': [
+                'http://10.0.0.1:8000/v1',
+                {'model_server': 'http://10.0.0.2:8000/v1', 'api_key': 'EMPTY'},
+            ],
+            'load_balance': 'requests',  # or 'tokens'
+            'failure_threshold': 3,
+            'cooldown': 30,
+        }
+    """
+
+    def __init__(self, cfg: Optional[Dict] = None):
+        super().__init__(cfg)
+        cfg = cfg or {}
+        if not cfg.get('model_servers'):
+            raise ValueError('Please provide the list of endpoints through `model_servers` in cfg.')
+        self.load_balance: Literal['requests', 'tokens'] = cfg.get('load_balance', 'requests')
+        if self.load_balance not in ('requests', 'tokens'):
+            raise ValueError(f'load_balance must be "requests" or "tokens", but received "{self.load_balance}".')
+        self.failure_threshold: int = max(cfg.get('failure_threshold', 3), 1)
+        self.cooldown: float = cfg.get('cooldown', 30.0)
+
+        endpoint_base_cfg = {k: v for k, v in cfg.items() if k not in POOL_CFG_KEYS + ('cache_dir', 'generate_cfg')}
+        endpoint_base_cfg['model_type'] = 'oai'
+        self.endpoints: List[_Endpoint] = []
+        for server in cfg['model_servers']:
+            endpoint_cfg = copy.deepcopy(endpoint_base_cfg)
+            endpoint_cfg.update({'model_server': server} if isinstance(server, str) else server)
+            self.endpoints.append(_Endpoint(TextChatAtOAI(endpoint_cfg), name=endpoint_cfg['model_server']))
+        self.model = self.endpoints[0].llm.model
+
+        self._lock = threading.Lock()
+        self._num_acquired = 0
+
+    def endpoint_stats(self) -> List[dict]:
+        """The load and the health of each endpoint."""
+        now = time.monotonic()
+        with self._lock:
+            return [{
+                'model_server': ep.name,
+                'in_flight': ep.in_flight,
+                'queued_tokens': ep.queued_tokens,
+                'healthy': ep.open_until <= now,
+                'num_requests': ep.num_requests,
+                'num_failures': ep.num_failures,
+            } for ep in self.endpoints]
+
+    def _chat_stream(
+        self,
+        messages: List[Message],
+        delta_stream: bool,
+        generate_cfg: dict,
+    ) -> Iterator[List[Message]]:
+        num_tokens = self._estimate_tokens(messages)
+        tried = []
+        while True:
+            ep = self._acquire(num_tokens, exclude=tried)
+            tried.append(ep)
+            it, error, succeeded, started = None, None, False, False
+            try:
+                it = ep.llm._chat_stream(messages, delta_stream=delta_stream, generate_cfg=generate_cfg)
+                for rsp in it:
+                    started = True
+                    yield rsp
+                succeeded = True
+                return
+            except ModelServiceError as e:
+                error = e
+                if started or (not _is_endpoint_failure(e)) or (not self._has_candidates(exclude=tried)):
+                    raise
+            finally:
+                close_iterator(it)
+                self._release(ep, num_tokens, succeeded=succeeded, error=error)
+            logger.warning(f'Model service {ep.name} failed, retrying on another endpoint: {str(error).strip()}')
+
+    def _chat_no_stream(
+        self,
+        messages: List[Message],
+        generate_cfg: dict,
+    ) -> List[Message]:
+        num_tokens = self._estimate_tokens(messages)
+        tried = []
+        while True:
+            ep = self._acquire(num_tokens, exclude=tried)
+            tried.append(ep)
+            error, succeeded = None, False
+            try:
+                output = ep.llm._chat_no_stream(messages, generate_cfg=generate_cfg)
+                succeeded = True
+                return output
+            except ModelServiceError as e:
+                error = e
+                if (not _is_endpoint_failure(e)) or (not self._has_candidates(exclude=tried)):
+                    raise
+            finally:
+                self._release(ep, num_tokens, succeeded=succeeded, error=error)
+            logger.warning(f'Model service {ep.name} failed, retrying on another endpoint: {str(error).strip()}')
+
+    def _estimate_tokens(self, messages: List[Message]) -> int:
+        if self.load_balance != 'tokens':
+            return 0
+        return sum(count_tokens_cached(extract_text_from_message(msg, add_upload_info=False)) for msg in messages)
+
+    def _is_available(self, ep: _Endpoint, now: float) -> bool:
+        if ep.open_until > now:
+            return False
+        if (ep.consecutive_failures >= self.failure_threshold) and ep.trial_in_flight:
+            return False  # Half-open, and the trial request is still running
+        return True
+
+    def _has_candidates(self, exclude: Sequence[_Endpoint] = ()) -> bool:
+        now = time.monotonic()
+        with self._lock:
+            return any((ep not in exclude) and self._is_available(ep, now) for ep in self.endpoints)
+
+    def _acquire(self, num_tokens: int, exclude: Sequence[_Endpoint] = ()) -> _Endpoint:
+        now = time.monotonic()
+        with self._lock:
+            candidates = [
+                (i, ep) for i, ep in enumerate(self.endpoints) if (ep not in exclude) and self._is_available(ep, now)
+            ]
+            if not candidates:
+                raise ModelServiceError(code='503', message='No healthy model service is available in the pool.')
+            start = self._num_acquired % len(self.endpoints)
+            self._num_acquired += 1
+
+            def _load(candidate) -> tuple:
+                i, ep = candidate
+                load = ep.queued_tokens if self.load_balance == 'tokens' else ep.in_flight
+                return load, ep.consecutive_failures, (i - start) % len(self.endpoints)
+
+            _, ep = min(candidates, key=_load)
+            if ep.consecutive_failures >= self.failure_threshold:
+                ep.trial_in_flight = True
+            ep.in_flight += 1
+            ep.queued_tokens += num_tokens
+            ep.num_requests += 1
+            return ep
+
+    def _release(self, ep: _Endpoint, num_tokens: int, succeeded: bool, error: Optional[ModelServiceError] = None):
+        with self._lock:
+            ep.in_flight -= 1
+            ep.queued_tokens -= num_tokens
+            ep.trial_in_flight = False
+            if (error is not None) and _is_endpoint_failure(error):
+                ep.consecutive_failures += 1
+                ep.num_failures += 1
+                if ep.consecutive_failures >= self.failure_threshold:
+                    ep.open_until = time.monotonic() + self.cooldown
+                    logger.warning(f'Ejecting model service {ep.name} from the pool for {self.cooldown}s '
+                                   f'after {ep.consecutive_failures} consecutive failures.')
+            elif succeeded:
+                ep.consecutive_failures = 0
+
+
+def _is_endpoint_failure(e: ModelServiceError) -> bool:
+    """Whether the error is likely caused by the endpoint rather than by the request, e.g., a 5xx or a refused
+    connection. Bad requests, such as an input that is too long, would fail on every endpoint."""
+    status_code = getattr(e.exception, 'status_code', None)
+    if status_code is not None:
+        return (status_code >= 500) or (status_code == 429)
+    return e.code != '400'
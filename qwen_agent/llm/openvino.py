@@ -1,7 +1,11 @@
 import copy
+import json
+import queue
+import time
+from collections import OrderedDict
 from pprint import pformat
-from threading import Thread
-from typing import Dict, Iterator, List, Optional
+from threading import Event, Lock, Thread
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Union
 
 from qwen_agent.llm.base import register_llm
 from qwen_agent.llm.function_calling import BaseFnCallModel
@@ -37,6 +41,10 @@ class OpenVINO(BaseFnCallModel):
                 system_message=system_instruction,
                 function_list=tools,
                 files=files)
+
+    To reuse the KV cache of the longest common prefix with a previous call, e.g., the system message, the tools and
+    the history in a loop of tool calls, export the model without the stateful KV cache (`--disable-stateful`) and set
+    `'kv_cache_reuse': True` in the cfg. The KV caches are kept in an LRU of at most `kv_cache_max_bytes`.
     """
 
     def __init__(self, cfg: Optional[Dict] = None):
@@ -65,7 +73,24 @@ class OpenVINO(BaseFnCallModel):
         )
         self.tokenizer = AutoTokenizer.from_pretrained(cfg['ov_model_dir'])
 
-    def _get_stopping_criteria(self, generate_cfg: dict):
+        # Concurrent chat calls are batched into shared generate calls if max_batch_size > 1
+        self.max_batch_size = cfg.get('max_batch_size', 1)
+        self._batcher = None
+        if self.max_batch_size > 1:
+            self.tokenizer.padding_side = 'left'
+            if self.tokenizer.pad_token is None:
+                self.tokenizer.pad_token = self.tokenizer.eos_token
+            self._batcher = _GenerateBatcher(self, self.max_batch_size, batch_wait=cfg.get('batch_wait', 0.01))
+
+        self.kv_cache: Optional[KVCachePool] = None
+        if cfg.get('kv_cache_reuse', False):
+            if getattr(self.ov_model, 'stateful', False):
+                logger.warning('The KV cache is not reused, since the model keeps it as an internal state. '
+                               'Please export the model with `optimum-cli export openvino --disable-stateful`.')
+            else:
+                self.kv_cache = KVCachePool(max_bytes=cfg.get('kv_cache_max_bytes', 2 * 1024**3))
+
+    def _get_stopping_criteria(self, generate_cfg: dict, prompt_len: int, cancel_event: Optional[Event] = None):
         from transformers.generation.stopping_criteria import StoppingCriteria, StoppingCriteriaList
 
         class StopSequenceCriteria(StoppingCriteria):
@@ -77,19 +102,29 @@ class OpenVINO(BaseFnCallModel):
                     The sequence (or list of sequences) on which to stop execution.
                 tokenizer:
                     The tokenizer used to decode the model outputs.
+                prompt_len:
+                    The number of prompt tokens, which are not searched.
             """
 
-            def __init__(self, stop_sequences, tokenizer):
-                if isinstance(stop_sequences, str):
-                    stop_sequences = [stop_sequences]
-                self.stop_sequences = stop_sequences
-                self.tokenizer = tokenizer
+            def __init__(self, stop_sequences, tokenizer, prompt_len):
+                self.checker = StopSequenceChecker(stop_sequences, tokenizer, prompt_len)
 
             def __call__(self, input_ids, scores, **kwargs) -> bool:
-                decoded_output = self.tokenizer.decode(input_ids.tolist()[0])
-                return any(decoded_output.endswith(stop_sequence) for stop_sequence in self.stop_sequences)
+                return self.checker.check(input_ids[0])
+
+        class CancelCriteria(StoppingCriteria):
+            """Stop generation once the consumer of the stream has stopped reading it."""
 
-        return StoppingCriteriaList([StopSequenceCriteria(generate_cfg['stop'], self.tokenizer)])
+            def __init__(self, cancel_event: Event):
+                self.cancel_event = cancel_event
+
+            def __call__(self, input_ids, scores, **kwargs) -> bool:
+                return self.cancel_event.is_set()
+
+        criteria = [StopSequenceCriteria(generate_cfg['stop'], self.tokenizer, prompt_len)]
+        if cancel_event is not None:
+            criteria.append(CancelCriteria(cancel_event))
+        return StoppingCriteriaList(criteria)
 
     def _chat_stream(
         self,
@@ -101,30 +136,42 @@ class OpenVINO(BaseFnCallModel):
         generate_cfg = copy.deepcopy(generate_cfg)
         prompt = build_text_completion_prompt(messages)
         logger.debug(f'LLM Input:\n{pformat(prompt, indent=2)}')
+        if self._batcher is not None:
+            yield from self._chat_stream_batched(prompt, delta_stream, generate_cfg)
+            return
         input_token = self.tokenizer(prompt, return_tensors='pt').input_ids
         streamer = TextIteratorStreamer(self.tokenizer, timeout=60.0, skip_prompt=True, skip_special_tokens=True)
+        cancel_event = Event()
         generate_cfg.update(
             dict(
                 input_ids=input_token,
                 streamer=streamer,
                 max_new_tokens=generate_cfg.get('max_new_tokens', 2048),
-                stopping_criteria=self._get_stopping_criteria(generate_cfg=generate_cfg),
+                stopping_criteria=self._get_stopping_criteria(generate_cfg=generate_cfg,
+                                                              prompt_len=input_token.shape[1],
+                                                              cancel_event=cancel_event),
             ))
         del generate_cfg['stop']
         del generate_cfg['seed']
-        
+        self._prepare_kv_cache(input_token, generate_cfg)
+
         def generate_and_signal_complete():
-            self.ov_model.generate(**generate_cfg)
+            output = self.ov_model.generate(**generate_cfg)
+            self._save_kv_cache(output)
 
         t1 = Thread(target=generate_and_signal_complete)
         t1.start()
         partial_text = ''
-        for new_text in streamer:
-            partial_text += new_text
-            if delta_stream:
-                yield [Message(ASSISTANT, new_text)]
-            else:
-                yield [Message(ASSISTANT, partial_text)]
+        try:
+            for new_text in streamer:
+                partial_text += new_text
+                if delta_stream:
+                    yield [Message(ASSISTANT, new_text)]
+                else:
+                    yield [Message(ASSISTANT, partial_text)]
+        finally:
+            # Let the generation thread stop at the next token if the consumer stops early
+            cancel_event.set()
 
     def _chat_no_stream(
         self,
@@ -134,17 +181,332 @@ class OpenVINO(BaseFnCallModel):
         generate_cfg = copy.deepcopy(generate_cfg)
         prompt = build_text_completion_prompt(messages)
         logger.debug(f'LLM Input:\n{pformat(prompt, indent=2)}')
+        if self._batcher is not None:
+            *_, last = self._chat_stream_batched(prompt, delta_stream=False, generate_cfg=generate_cfg)
+            return last
         input_token = self.tokenizer(prompt, return_tensors='pt').input_ids
         generate_cfg.update(
             dict(
                 input_ids=input_token,
                 max_new_tokens=generate_cfg.get('max_new_tokens', 2048),
-                stopping_criteria=self._get_stopping_criteria(generate_cfg=generate_cfg),
+                stopping_criteria=self._get_stopping_criteria(generate_cfg=generate_cfg,
+                                                              prompt_len=input_token.shape[1]),
             ))
         del generate_cfg['stop']
         del generate_cfg['seed']
+        self._prepare_kv_cache(input_token, generate_cfg)
 
         response = self.ov_model.generate(**generate_cfg)
+        if self.kv_cache is not None:
+            self._save_kv_cache(response)
+            response = response.sequences
         response = response[:, len(input_token[0]):]
         answer = self.tokenizer.batch_decode(response, skip_special_tokens=True)[0]
         return [Message(ASSISTANT, answer)]
+
+    def _prepare_kv_cache(self, input_token, generate_cfg: dict):
+        """Start the generation from the cached KV of the longest common prefix with a previous generation."""
+        if self.kv_cache is None:
+            return
+        import torch
+
+        generate_cfg.update(return_dict_in_generate=True, use_cache=True)
+        # At least the last prompt token is fed to the model, to get the logits of the first new token
+        prefix_len, past = self.kv_cache.lookup(input_token[0, :-1].tolist())
+        if prefix_len > 0:
+            generate_cfg['past_key_values'] = tuple(tuple(t[..., :prefix_len, :] for t in layer) for layer in past)
+            generate_cfg['attention_mask'] = torch.ones_like(input_token)
+            logger.debug(f'Reusing the KV cache of {prefix_len} of the {input_token.shape[1]} prompt tokens')
+
+    def _save_kv_cache(self, output):
+        if self.kv_cache is None or getattr(output, 'past_key_values', None) is None:
+            return
+        past = output.past_key_values
+        if hasattr(past, 'to_legacy_cache'):
+            past = past.to_legacy_cache()
+        # The KV of the last generated token is not computed
+        kv_len = past[0][0].shape[-2]
+        nbytes = sum(t.numel() * t.element_size() for layer in past for t in layer)
+        self.kv_cache.put(output.sequences[0, :kv_len].tolist(), past, nbytes)
+
+    def _chat_stream_batched(self, prompt: str, delta_stream: bool, generate_cfg: dict) -> Iterator[List[Message]]:
+        request = _GenerateRequest(prompt,
+                                   stop=generate_cfg.pop('stop'),
+                                   max_new_tokens=generate_cfg.pop('max_new_tokens', 2048),
+                                   generate_cfg={k: v for k, v in generate_cfg.items() if k != 'seed'})
+        self._batcher.submit(request)
+        decoder = IncrementalDecoder(self.tokenizer)
+        partial_text = ''
+        try:
+            while True:
+                item = request.queue.get()
+                if item is _END_OF_GENERATION:
+                    new_text = decoder.flush()
+                elif isinstance(item, BaseException):
+                    raise item
+                else:
+                    new_text = decoder.add(item)
+                if new_text:
+                    partial_text += new_text
+                    if delta_stream:
+                        yield [Message(ASSISTANT, new_text)]
+                    else:
+                        yield [Message(ASSISTANT, partial_text)]
+                if item is _END_OF_GENERATION:
+                    break
+            if not partial_text:
+                yield [Message(ASSISTANT, '')]
+        finally:
+            # The row of this request is skipped from the next token on, if the consumer stops early
+            request.cancelled.set()
+
+    def _generate_batch(self, requests: List['_GenerateRequest']):
+        """Generate for the requests in one generate call, where each row stops on its own criteria."""
+        import torch
+        from transformers.generation.stopping_criteria import StoppingCriteria, StoppingCriteriaList
+        from transformers.generation.streamers import BaseStreamer
+
+        inputs = self.tokenizer([r.prompt for r in requests], return_tensors='pt', padding=True)
+        prompt_len = inputs.input_ids.shape[1]  # The prompts are left-padded to the same length
+        checkers = [StopSequenceChecker(r.stop, self.tokenizer, prompt_len) for r in requests]
+        eos_token_ids = {self.tokenizer.eos_token_id}
+        generation_eos = getattr(self.ov_model.generation_config, 'eos_token_id', None)
+        if generation_eos is not None:
+            eos_token_ids.update(generation_eos if isinstance(generation_eos, list) else [generation_eos])
+
+        class BatchStopCriteria(StoppingCriteria):
+
+            def __call__(self, input_ids, scores, **kwargs):
+                num_new_tokens = input_ids.shape[1] - prompt_len
+                for i, r in enumerate(requests):
+                    if not r.finished:
+                        r.finished = (r.cancelled.is_set() or num_new_tokens >= r.max_new_tokens or
+                                      checkers[i].check(input_ids[i]))
+                return torch.tensor([r.finished for r in requests], dtype=torch.bool, device=input_ids.device)
+
+        class BatchStreamer(BaseStreamer):
+            """Routes the new token of each row to its request, until the row is finished."""
+
+            def __init__(self):
+                self.skip_prompt = True
+
+            def put(self, value):
+                if self.skip_prompt:
+                    self.skip_prompt = False
+                    return
+                for r, token_id in zip(requests, value.tolist()):
+                    if r.finished:
+                        continue
+                    if token_id in eos_token_ids:
+                        r.finished = True
+                        continue
+                    r.queue.put(token_id)
+
+            def end(self):
+                pass
+
+        self.ov_model.generate(
+            **inputs,
+            **requests[0].generate_cfg,
+            max_new_tokens=max(r.max_new_tokens for r in requests),
+            pad_token_id=self.tokenizer.pad_token_id,
+            stopping_criteria=StoppingCriteriaList([BatchStopCriteria()]),
+            streamer=BatchStreamer(),
+        )
+
+
+class StopSequenceChecker:
+    """Searches the newly generated tokens of one sequence for the stop sequences.
+
+    Only a tail window of the tokens is decoded at each step, which is long enough to cover the longest stop sequence,
+    rather than the whole sequence, whose decoding would make the generation quadratic in the output length.
+    """
+
+    def __init__(self, stop_sequences: Union[str, List[str]], tokenizer, prompt_len: int):
+        if isinstance(stop_sequences, str):
+            stop_sequences = [stop_sequences]
+        self.stop_sequences = [s for s in stop_sequences if s]
+        self.tokenizer = tokenizer
+        self.prompt_len = prompt_len
+        # A token decodes to at least one character, or to a part of a character of up to four bytes
+        self.window = 4 * max([len(s) for s in self.stop_sequences], default=0) + 4
+
+    def check(self, token_ids) -> bool:
+        """Whether the sequence contains a stop sequence. The token_ids are of the prompt and the generated tokens."""
+        if not self.stop_sequences:
+            return False
+        start = max(self.prompt_len, len(token_ids) - self.window)
+        tail = token_ids[start:]
+        if hasattr(tail, 'tolist'):
+            tail = tail.tolist()
+        text = self.tokenizer.decode(tail)
+        return any(stop in text for stop in self.stop_sequences)
+
+
+class KVCachePool:
+    """The KV caches of previous generations, kept in an LRU bounded by their total size in bytes.
+
+    A lookup returns the cache whose tokens share the longest common prefix with the new prompt, so the consecutive
+    calls of a conversation reuse the KV of their shared history, without the need for a session id.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        # {key: (token_ids, past_key_values, nbytes)}
+        self._entries: OrderedDict = OrderedDict()
+        self._next_key = 0
+        self._lock = Lock()
+
+    def lookup(self, token_ids: List[int]) -> Tuple[int, Any]:
+        """Returns the length of the longest common prefix, and the past key-values which cover it."""
+        best_len, best_key = 0, None
+        with self._lock:
+            for key, (cached_ids, _, _) in self._entries.items():
+                prefix_len = _common_prefix_len(cached_ids, token_ids)
+                if prefix_len > best_len:
+                    best_len, best_key = prefix_len, key
+            if best_key is None:
+                return 0, None
+            self._entries.move_to_end(best_key)
+            return best_len, self._entries[best_key][1]
+
+    def put(self, token_ids: List[int], past_key_values: Any, nbytes: int):
+        if nbytes > self.max_bytes:
+            return
+        with self._lock:
+            # A cache whose tokens are a prefix of the new ones is superseded
+            for key, (cached_ids, _, _) in list(self._entries.items()):
+                if cached_ids == token_ids[:len(cached_ids)]:
+                    self._remove(key)
+            self._entries[self._next_key] = (token_ids, past_key_values, nbytes)
+            self._next_key += 1
+            self.nbytes += nbytes
+            while self.nbytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _remove(self, key: int):
+        self.nbytes -= self._entries.pop(key)[2]
+
+
+def _common_prefix_len(a: List[int], b: List[int]) -> int:
+    n = min(len(a), len(b))
+    for i in range(n):
+        if a[i] != b[i]:
+            return i
+    return n
+
+
+class IncrementalDecoder:
+    """Decodes a stream of token ids into text pieces, like the `TextStreamer` of transformers.
+
+    The tokens are decoded since the last newline only, and the text is held back until a word is complete, since the
+    decoded text of a token may change with the tokens after it.
+    """
+
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        self.token_ids: List[int] = []
+        self.printed_len = 0
+
+    def add(self, token_id: int) -> str:
+        self.token_ids.append(token_id)
+        text = self.tokenizer.decode(self.token_ids, skip_special_tokens=True)
+        if text.endswith('\n'):
+            new_text = text[self.printed_len:]
+            self.token_ids, self.printed_len = [], 0
+        elif text.endswith('\ufffd'):
+            # An incomplete multi-byte character
+            new_text = ''
+        elif text and _is_cjk_char(text[-1]):
+            new_text = text[self.printed_len:]
+            self.printed_len += len(new_text)
+        else:
+            new_text = text[self.printed_len:text.rfind(' ') + 1]
+            self.printed_len += len(new_text)
+        return new_text
+
+    def flush(self) -> str:
+        text = self.tokenizer.decode(self.token_ids, skip_special_tokens=True) if self.token_ids else ''
+        new_text = text[self.printed_len:]
+        self.token_ids, self.printed_len = [], 0
+        return new_text
+
+
+def _is_cjk_char(char: str) -> bool:
+    cp = ord(char)
+    return (0x4E00 <= cp <= 0x9FFF or 0x3400 <= cp <= 0x4DBF or 0x20000 <= cp <= 0x2CEAF or 0xF900 <= cp <= 0xFAFF or
+            0x2F800 <= cp <= 0x2FA1F)
+
+
+_END_OF_GENERATION = object()
+
+
+class _GenerateRequest:
+
+    def __init__(self, prompt: str, stop: List[str], max_new_tokens: int, generate_cfg: dict):
+        self.prompt = prompt
+        self.stop = stop
+        self.max_new_tokens = max_new_tokens
+        self.generate_cfg = generate_cfg
+        # The generated token ids, then an exception or _END_OF_GENERATION
+        self.queue = queue.Queue()
+        self.cancelled = Event()
+        self.finished = False  # Set by the generation thread
+
+    @property
+    def batch_key(self) -> str:
+        # Only the requests with the same sampling parameters can share a generate call
+        return json.dumps(self.generate_cfg, sort_keys=True, default=str)
+
+
+class _GenerateBatcher:
+    """Collects the concurrent requests into batches, and runs them one batch at a time in a background thread.
+
+    A batch is closed once it is full, or `batch_wait` seconds after its first request. The requests that arrive while a
+    batch is generating wait for the next batch.
+    """
+
+    def __init__(self, llm: OpenVINO, max_batch_size: int, batch_wait: float):
+        self.llm = llm
+        self.max_batch_size = max_batch_size
+        self.batch_wait = batch_wait
+        self._pending = queue.Queue()
+        self._thread: Optional[Thread] = None
+        self._lock = Lock()
+
+    def submit(self, request: _GenerateRequest):
+        self._pending.put(request)
+        with self._lock:
+            if self._thread is None:
+                self._thread = Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            batch = [self._pending.get()]
+            deadline = time.monotonic() + self.batch_wait
+            while len(batch) < self.max_batch_size:
+                try:
+                    batch.append(self._pending.get(timeout=max(deadline - time.monotonic(), 0)))
+                except queue.Empty:
+                    break
+            groups: Dict[str, List[_GenerateRequest]] = {}
+            for request in batch:
+                if not request.cancelled.is_set():
+                    groups.setdefault(request.batch_key, []).append(request)
+            for requests in groups.values():
+                self._generate(requests)
+
+    def _generate(self, requests: List[_GenerateRequest]):
+        try:
+            self.llm._generate_batch(requests)
+        except Exception as e:
+            logger.warning(f'Failed to generate for a batch of {len(requests)} requests: {e}')
+            for r in requests:
+                r.queue.put(e)
+        for r in requests:
+            r.queue.put(_END_OF_GENERATION)
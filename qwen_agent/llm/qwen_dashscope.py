@@ -8,6 +8,7 @@ import dashscope
 from qwen_agent.llm.base import ModelServiceError, register_llm
 from qwen_agent.llm.function_calling import BaseFnCallModel
 from qwen_agent.llm.schema import ASSISTANT, Message
+from qwen_agent.llm.usage import normalize_usage
 from qwen_agent.log import logger
 
 
@@ -17,6 +18,7 @@ class QwenChatAtDS(BaseFnCallModel):
     def __init__(self, cfg: Optional[Dict] = None):
         super().__init__(cfg)
         self.model = self.model or 'qwen-max'
+        self.service_info = get_service_info_policy(self.generate_cfg)
         initialize_dashscope(cfg)
 
     def _chat_stream(
@@ -36,9 +38,9 @@ class QwenChatAtDS(BaseFnCallModel):
             stream=True,
             **generate_cfg)
         if delta_stream:
-            return self._delta_stream_output(response)
+            return self._delta_stream_output(response, service_info=self.service_info)
         else:
-            return self._full_stream_output(response)
+            return self._full_stream_output(response, service_info=self.service_info)
 
     def _chat_no_stream(
         self,
@@ -60,7 +62,7 @@ class QwenChatAtDS(BaseFnCallModel):
                 Message(role=ASSISTANT,
                         content=response.output.choices[0].message.content,
                         reasoning_content=response.output.choices[0].message.get('reasoning_content', ''),
-                        extra={'model_service_info': response})
+                        extra=build_extra(response, self.service_info))
             ]
         else:
             raise ModelServiceError(code=response.code,
@@ -76,36 +78,81 @@ class QwenChatAtDS(BaseFnCallModel):
         return self._chat(messages, stream=stream, delta_stream=False, generate_cfg=generate_cfg)
 
     @staticmethod
-    def _delta_stream_output(response) -> Iterator[List[Message]]:
-        for chunk in response:
-            if chunk.status_code == HTTPStatus.OK:
-                yield [
-                    Message(role=ASSISTANT,
-                            content=chunk.output.choices[0].message.content,
-                            reasoning_content=chunk.output.choices[0].message.reasoning_content,
-                            extra={'model_service_info': chunk})
-                ]
-            else:
-                raise ModelServiceError(code=chunk.code, message=chunk.message, extra={'model_service_info': chunk})
+    def _delta_stream_output(response, service_info: str = 'summary') -> Iterator[List[Message]]:
+        try:
+            for chunk in response:
+                if chunk.status_code == HTTPStatus.OK:
+                    yield [
+                        Message.fast_construct(role=ASSISTANT,
+                                               content=chunk.output.choices[0].message.content,
+                                               reasoning_content=chunk.output.choices[0].message.reasoning_content,
+                                               extra=build_extra(chunk, service_info))
+                    ]
+                else:
+                    raise ModelServiceError(code=chunk.code, message=chunk.message, extra={'model_service_info': chunk})
+        finally:
+            # Close the DashScope stream, which aborts the generation if the consumer stops early
+            if hasattr(response, 'close'):
+                response.close()
 
     @staticmethod
-    def _full_stream_output(response) -> Iterator[List[Message]]:
+    def _full_stream_output(response, service_info: str = 'summary') -> Iterator[List[Message]]:
         full_content = ''
         full_reasoning_content = ''
-        for chunk in response:
-            if chunk.status_code == HTTPStatus.OK:
-                if chunk.output.choices[0].message.get('reasoning_content', ''):
-                    full_reasoning_content += chunk.output.choices[0].message.reasoning_content
-                if chunk.output.choices[0].message.content:
-                    full_content += chunk.output.choices[0].message.content
-                yield [
-                    Message(role=ASSISTANT,
-                            content=full_content,
-                            reasoning_content=full_reasoning_content,
-                            extra={'model_service_info': chunk})
-                ]
-            else:
-                raise ModelServiceError(code=chunk.code, message=chunk.message, extra={'model_service_info': chunk})
+        try:
+            for chunk in response:
+                if chunk.status_code == HTTPStatus.OK:
+                    if chunk.output.choices[0].message.get('reasoning_content', ''):
+                        full_reasoning_content += chunk.output.choices[0].message.reasoning_content
+                    if chunk.output.choices[0].message.content:
+                        full_content += chunk.output.choices[0].message.content
+                    yield [
+                        Message.fast_construct(role=ASSISTANT,
+                                               content=full_content,
+                                               reasoning_content=full_reasoning_content,
+                                               extra=build_extra(chunk, service_info))
+                    ]
+                else:
+                    raise ModelServiceError(code=chunk.code, message=chunk.message, extra={'model_service_info': chunk})
+        finally:
+            # Close the DashScope stream, which aborts the generation if the consumer stops early
+            if hasattr(response, 'close'):
+                response.close()
+
+
+# How much of the DashScope response to keep in Message.extra['model_service_info']:
+#   'summary': A slim record of the request id, status code and finish reason, on every message.
+#   'final': The slim record, only on the message of the final chunk.
+#   'none': Nothing.
+#   'raw': The raw response object, which is large and not serializable.
+SERVICE_INFO_POLICIES = ('summary', 'final', 'none', 'raw')
+
+
+def get_service_info_policy(generate_cfg: dict) -> str:
+    # Set with `generate_cfg={'service_info': 'final'}`, which is not passed on to DashScope
+    policy = generate_cfg.pop('service_info', 'summary')
+    if policy not in SERVICE_INFO_POLICIES:
+        raise ValueError(f'The value of service_info must be one of {SERVICE_INFO_POLICIES}, but got "{policy}".')
+    return policy
+
+
+def build_extra(response, service_info: str = 'summary') -> dict:
+    """The extra of a message generated from a DashScope response or stream chunk."""
+    extra = {'usage': normalize_usage(response.usage)}
+    if service_info == 'raw':
+        extra['model_service_info'] = response
+    elif service_info != 'none':
+        choices = (response.output or {}).get('choices') or [{}]
+        finish_reason = choices[0].get('finish_reason')
+        if finish_reason == 'null':
+            finish_reason = None
+        if (service_info == 'summary') or finish_reason:
+            extra['model_service_info'] = {
+                'request_id': response.request_id,
+                'status_code': response.status_code,
+                'finish_reason': finish_reason,
+            }
+    return extra
 
 
 def initialize_dashscope(cfg: Optional[Dict] = None) -> None:
@@ -133,7 +180,7 @@ def initialize_dashscope(cfg: Optional[Dict] = None) -> None:
             logger.info('Setting the dashscope api_key.')
             dashscope.api_key = api_key
         # or do nothing since both keys are the same
-  
+
     if base_http_api_url is not None:
         dashscope.base_http_api_url = base_http_api_url.strip()
     if base_websocket_api_url is not None:
@@ -9,7 +9,7 @@ import dashscope
 
 from qwen_agent.llm.base import ModelServiceError, register_llm
 from qwen_agent.llm.function_calling import BaseFnCallModel
-from qwen_agent.llm.qwen_dashscope import initialize_dashscope
+from qwen_agent.llm.qwen_dashscope import build_extra, get_service_info_policy, initialize_dashscope
 from qwen_agent.llm.schema import ASSISTANT, ContentItem, Message
 from qwen_agent.log import logger
 
@@ -24,6 +24,7 @@ class QwenVLChatAtDS(BaseFnCallModel):
     def __init__(self, cfg: Optional[Dict] = None):
         super().__init__(cfg)
         self.model = self.model or 'qwen-vl-max'
+        self.service_info = get_service_info_policy(self.generate_cfg)
         initialize_dashscope(cfg)
 
     def _chat_stream(
@@ -38,7 +39,7 @@ class QwenVLChatAtDS(BaseFnCallModel):
         messages = _format_local_files(messages)
         if not self.support_audio_input:
             messages = rm_unsupported_modality(messages)
-        
+
         messages = [msg.model_dump() for msg in messages]
         if messages[-1]['role'] == ASSISTANT:
             messages[-1]['partial'] = True
@@ -50,28 +51,33 @@ class QwenVLChatAtDS(BaseFnCallModel):
                                                          **generate_cfg)
         full_content = []
         full_reasoning_content = ''
-        for chunk in response:
-            if chunk.status_code == HTTPStatus.OK:
-                if chunk.output.choices:
-                    if 'reasoning_content' in chunk.output.choices[0].message and chunk.output.choices[
-                            0].message.reasoning_content:
-                        full_reasoning_content += chunk.output.choices[0].message.reasoning_content
-                    if 'content' in chunk.output.choices[0].message and chunk.output.choices[0].message.content:
-                        for item in chunk.output.choices[0].message.content:
-                            for k, v in item.items():
-                                if k == 'text':
-                                    if full_content and full_content[-1].text:
-                                        full_content[-1].text += chunk.output.choices[0].message.content[0]['text']
-                                    elif k in ('text', 'box'):
-                                        full_content.append(ContentItem(text=v))
-                    yield [
-                        Message(role=ASSISTANT,
-                                content=full_content,
-                                reasoning_content=full_reasoning_content,
-                                extra={'model_service_info': chunk})
-                    ]
-            else:
-                raise ModelServiceError(code=chunk.code, message=chunk.message, extra={'model_service_info': chunk})
+        try:
+            for chunk in response:
+                if chunk.status_code == HTTPStatus.OK:
+                    if chunk.output.choices:
+                        if 'reasoning_content' in chunk.output.choices[0].message and chunk.output.choices[
+                                0].message.reasoning_content:
+                            full_reasoning_content += chunk.output.choices[0].message.reasoning_content
+                        if 'content' in chunk.output.choices[0].message and chunk.output.choices[0].message.content:
+                            for item in chunk.output.choices[0].message.content:
+                                for k, v in item.items():
+                                    if k == 'text':
+                                        if full_content and full_content[-1].text:
+                                            full_content[-1].text += chunk.output.choices[0].message.content[0]['text']
+                                        elif k in ('text', 'box'):
+                                            full_content.append(ContentItem(text=v))
+                        yield [
+                            Message(role=ASSISTANT,
+                                    content=full_content,
+                                    reasoning_content=full_reasoning_content,
+                                    extra=build_extra(chunk, self.service_info))
+                        ]
+                else:
+                    raise ModelServiceError(code=chunk.code, message=chunk.message, extra={'model_service_info': chunk})
+        finally:
+            # Close the DashScope stream, which aborts the generation if the consumer stops early
+            if hasattr(response, 'close'):
+                response.close()
 
     def _chat_no_stream(
         self,
@@ -81,7 +87,7 @@ class QwenVLChatAtDS(BaseFnCallModel):
         messages = _format_local_files(messages)
         if not self.support_audio_input:
             messages = rm_unsupported_modality(messages)
-        
+
         messages = [msg.model_dump() for msg in messages]
         if messages[-1]['role'] == ASSISTANT:
             messages[-1]['partial'] = True
@@ -99,13 +105,13 @@ class QwenVLChatAtDS(BaseFnCallModel):
                     Message(role=ASSISTANT,
                             content=[ContentItem(text=full_content)],
                             reasoning_content=full_reasoning_content,
-                            extra={'model_service_info': response})
+                            extra=build_extra(response, self.service_info))
                 ]
             else:
                 return [
                     Message(role=ASSISTANT,
                             content=[ContentItem(text=full_content)],
-                            extra={'model_service_info': response})
+                            extra=build_extra(response, self.service_info))
                 ]
         else:
             raise ModelServiceError(code=response.code,
@@ -6,7 +6,7 @@ from typing import List
 
 from qwen_agent.llm import ModelServiceError
 from qwen_agent.llm.base import register_llm
-from qwen_agent.llm.oai import TextChatAtOAI
+from qwen_agent.llm.oai import TextChatAtOAI, convert_fncall_messages_to_oai
 from qwen_agent.llm.schema import ContentItem, Message
 from qwen_agent.log import logger
 from qwen_agent.utils.utils import (encode_audio_as_base64, encode_image_as_base64, encode_video_as_base64)
@@ -67,6 +67,7 @@ class QwenVLChatAtOAI(TextChatAtOAI):
             new_msg = msg.model_dump()
             new_msg['content'] = new_content
             new_messages.append(new_msg)
+        new_messages = convert_fncall_messages_to_oai(new_messages)
 
         if logger.isEnabledFor(logging.DEBUG):
             lite_messages = copy.deepcopy(new_messages)
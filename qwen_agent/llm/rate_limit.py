@@ -0,0 +1,132 @@
+import asyncio
+import threading
+import time
+from collections import deque
+from typing import Dict, Optional
+
+# How often an async waiter checks whether it is its turn
+ASYNC_POLL_INTERVAL = 0.05
+
+
+class _TokenBucket:
+
+    def __init__(self, per_minute: float, window: float):
+        self.rate = per_minute / 60.0
+        self.capacity = max(self.rate * window, 1.0)
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now: float):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        return max(0.0, (amount - self.level) / self.rate)
+
+
+class RateLimiter:
+    """A client-side limiter of the requests per minute (RPM) and the tokens per minute (TPM).
+
+    The limits are enforced with token buckets before the requests are sent, so that bursts do not run into the
+    throttling of the model service. The waiters are served first-come, first-served, no matter whether they are
+    threads calling `acquire` or coroutines awaiting `acquire_async`.
+
+    Args:
+        rpm: The maximum number of requests per minute, or None for no limit.
+        tpm: The maximum number of tokens per minute, or None for no limit.
+        window: The bursts are capped at the quota of this many seconds. By default, a full minute of quota can be
+          used at once. A shorter window spreads the requests out more evenly.
+    """
+
+    def __init__(self, rpm: Optional[float] = None, tpm: Optional[float] = None, window: float = 60.0):
+        self.rpm = rpm
+        self.tpm = tpm
+        self._requests = _TokenBucket(rpm, window) if rpm else None
+        self._tokens = _TokenBucket(tpm, window) if tpm else None
+        self._cond = threading.Condition()
+        self._waiters = deque()
+
+    def acquire(self, num_tokens: int = 0) -> None:
+        """Block until one request with `num_tokens` tokens can be sent."""
+        ticket = object()
+        with self._cond:
+            self._waiters.append(ticket)
+            try:
+                while True:
+                    wait = self._try_take(ticket, num_tokens)
+                    if wait == 0:
+                        return
+                    self._cond.wait(timeout=wait)
+            except BaseException:
+                self._leave(ticket)
+                raise
+
+    async def acquire_async(self, num_tokens: int = 0) -> None:
+        """The same as `acquire`, without blocking the event loop."""
+        ticket = object()
+        with self._cond:
+            self._waiters.append(ticket)
+        try:
+            while True:
+                with self._cond:
+                    wait = self._try_take(ticket, num_tokens)
+                if wait == 0:
+                    return
+                await asyncio.sleep(ASYNC_POLL_INTERVAL if wait is None else min(wait, ASYNC_POLL_INTERVAL))
+        except BaseException:
+            with self._cond:
+                self._leave(ticket)
+            raise
+
+    def _try_take(self, ticket: object, num_tokens: int) -> Optional[float]:
+        """Take the quota if it is the turn of the ticket and the quota suffices, in which case 0 is returned.
+
+        Otherwise, return the time to wait for the quota, or None if the ticket has to wait for its turn.
+        The caller must hold the lock.
+        """
+        if self._waiters[0] is not ticket:
+            return None
+        now = time.monotonic()
+        wait = 0.0
+        if self._requests is not None:
+            self._requests.refill(now)
+            wait = max(wait, self._requests.wait_time(1))
+        if self._tokens is not None:
+            num_tokens = min(num_tokens, self._tokens.capacity)  # A large request must not wait forever
+            self._tokens.refill(now)
+            wait = max(wait, self._tokens.wait_time(num_tokens))
+        if wait > 0:
+            return wait
+        if self._requests is not None:
+            self._requests.level -= 1
+        if self._tokens is not None:
+            self._tokens.level -= num_tokens
+        self._waiters.popleft()
+        self._cond.notify_all()
+        return 0
+
+    def _leave(self, ticket: object):
+        # The caller must hold the lock
+        if ticket in self._waiters:
+            self._waiters.remove(ticket)
+            self._cond.notify_all()
+
+
+_rate_limiters: Dict[str, RateLimiter] = {}
+_rate_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(key: str,
+                     rpm: Optional[float] = None,
+                     tpm: Optional[float] = None,
+                     window: float = 60.0) -> RateLimiter:
+    """Get the process-wide rate limiter of a model service, e.g., keyed by its endpoint and model name.
+
+    All the LLM objects of the same key share one limiter, and the limits given when it is first created apply.
+    """
+    with _rate_limiters_lock:
+        limiter = _rate_limiters.get(key)
+        if limiter is None:
+            limiter = RateLimiter(rpm=rpm, tpm=tpm, window=window)
+            _rate_limiters[key] = limiter
+        return limiter
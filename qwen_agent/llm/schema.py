@@ -1,3 +1,4 @@
+import copy
 from typing import List, Literal, Optional, Tuple, Union
 
 from pydantic import BaseModel, field_validator, model_validator
@@ -20,6 +21,16 @@ AUDIO = 'audio'
 VIDEO = 'video'
 
 
+def _construct_without_validation(cls, values: dict):
+    # The same as what `BaseModel.model_construct` does, minus the overhead of looking up the field defaults.
+    obj = cls.__new__(cls)
+    object.__setattr__(obj, '__dict__', values)
+    object.__setattr__(obj, '__pydantic_fields_set__', set(values))
+    object.__setattr__(obj, '__pydantic_extra__', None)
+    object.__setattr__(obj, '__pydantic_private__', None)
+    return obj
+
+
 class BaseModelCompatibleDict(BaseModel):
 
     def __getitem__(self, item):
@@ -59,6 +70,16 @@ class FunctionCall(BaseModelCompatibleDict):
     def __init__(self, name: str, arguments: str):
         super().__init__(name=name, arguments=arguments)
 
+    @classmethod
+    def fast_construct(cls, name: str, arguments: str) -> 'FunctionCall':
+        """Create an instance without validation. Only use it when the values are known to be valid."""
+        return _construct_without_validation(cls, {'name': name, 'arguments': arguments})
+
+    def model_dump(self, **kwargs):
+        if kwargs:
+            return super().model_dump(**kwargs)
+        return {'name': self.name, 'arguments': self.arguments}
+
     def __repr__(self):
         return f'FunctionCall({self.model_dump()})'
 
@@ -78,6 +99,22 @@ class ContentItem(BaseModelCompatibleDict):
                  video: Optional[Union[str, list]] = None):
         super().__init__(text=text, image=image, file=file, audio=audio, video=video)
 
+    @classmethod
+    def fast_construct(cls,
+                       text: Optional[str] = None,
+                       image: Optional[str] = None,
+                       file: Optional[str] = None,
+                       audio: Optional[Union[str, dict]] = None,
+                       video: Optional[Union[str, list]] = None) -> 'ContentItem':
+        """Create an instance without validation. Only use it when the values are known to be valid."""
+        return _construct_without_validation(cls, {
+            'text': text,
+            'image': image,
+            'file': file,
+            'audio': audio,
+            'video': video
+        })
+
     @model_validator(mode='after')
     def check_exclusivity(self):
         provided_fields = 0
@@ -100,9 +137,18 @@ class ContentItem(BaseModelCompatibleDict):
         return f'ContentItem({self.model_dump()})'
 
     def get_type_and_value(self) -> Tuple[Literal['text', 'image', 'file', 'audio', 'video'], str]:
-        (t, v), = self.model_dump().items()
-        assert t in ('text', 'image', 'file', 'audio', 'video')
-        return t, v
+        # Read the fields directly instead of calling model_dump, since it is called on every item of every message.
+        fields = self.__dict__
+        for t in ('text', 'image', 'file', 'audio', 'video'):
+            v = fields[t]
+            if v is not None:
+                return t, v
+        raise ValueError("Exactly one of 'text', 'image', 'file', 'audio', or 'video' must be provided.")
+
+    def model_dump(self, **kwargs):
+        if kwargs:
+            return super().model_dump(**kwargs)
+        return {k: (v if isinstance(v, str) else copy.deepcopy(v)) for k, v in self.__dict__.items() if v is not None}
 
     @property
     def type(self) -> Literal['text', 'image', 'file', 'audio', 'video']:
@@ -140,6 +186,65 @@ class Message(BaseModelCompatibleDict):
                          function_call=function_call,
                          extra=extra)
 
+    @classmethod
+    def fast_construct(cls,
+                       role: str,
+                       content: Union[str, List[ContentItem]],
+                       reasoning_content: Optional[Union[str, List[ContentItem]]] = None,
+                       name: Optional[str] = None,
+                       function_call: Optional[FunctionCall] = None,
+                       extra: Optional[dict] = None) -> 'Message':
+        """Create an instance without validation. Only use it when the values are known to be valid.
+
+        For example, when the fields are taken from messages that have been validated already. The content items and
+        the function call must be ContentItem and FunctionCall objects rather than dicts.
+        """
+        if content is None:
+            content = ''
+        return _construct_without_validation(
+            cls, {
+                'role': role,
+                'content': content,
+                'reasoning_content': reasoning_content,
+                'name': name,
+                'function_call': function_call,
+                'extra': extra
+            })
+
+    def shallow_copy(self, **update) -> 'Message':
+        """Copy-on-write: the copy shares the content items and other field values with this message.
+
+        Only the content list itself is copied, so that items can be appended to or replaced in the copy without
+        affecting the original message. The content items must not be modified in place; replace them instead.
+
+        Args:
+            update: The fields to overwrite in the copy.
+        """
+        values = dict(self.__dict__)
+        if isinstance(values['content'], list):
+            values['content'] = list(values['content'])
+        values.update(update)
+        if values['content'] is None:
+            values['content'] = ''
+        return _construct_without_validation(type(self), values)
+
+    def model_dump(self, **kwargs):
+        if kwargs or (self.extra is not None):
+            return super().model_dump(**kwargs)
+        # A hand-written serializer for the most frequent case, i.e., model_dump() with exclude_none=True
+        dump = {'role': self.role}
+        for k in ('content', 'reasoning_content'):
+            v = getattr(self, k)
+            if isinstance(v, list):
+                dump[k] = [item.model_dump() for item in v]
+            elif v is not None:
+                dump[k] = v
+        if self.name is not None:
+            dump['name'] = self.name
+        if self.function_call is not None:
+            dump['function_call'] = self.function_call.model_dump()
+        return dump
+
     def __repr__(self):
         return f'Message({self.model_dump()})'
 
@@ -0,0 +1,123 @@
+import threading
+from typing import Any, Callable, Dict, Iterator, Optional
+
+from qwen_agent.utils.utils import close_iterator
+
+
+class _Flight:
+    """One upstream request, and the subscribers that share its output."""
+
+    def __init__(self, it_fn: Callable[[], Iterator], replay: bool):
+        self.it_fn = it_fn
+        self.it: Optional[Iterator] = None
+        # Without replay, only the latest chunk is kept, since each chunk may hold the full response so far.
+        # `offset` is the position of chunks[0] in the stream, i.e., the number of chunks dropped before it.
+        self.replay = replay
+        self.chunks = []
+        self.offset = 0
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.pulling = False  # Whether a subscriber is fetching the next chunk from upstream
+        self.num_subscribers = 0
+        self.cond = threading.Condition()
+
+
+# The in-flight requests of the process. Lock order: _flights_lock, then _Flight.cond.
+_flights: Dict[str, _Flight] = {}
+_flights_lock = threading.Lock()
+
+
+def single_flight_stream(key: str,
+                         it_fn: Callable[[], Iterator],
+                         replay: bool = True,
+                         share_fn: Optional[Callable[[Any], Any]] = None) -> Iterator:
+    """Iterate over `it_fn()`, unless an identical request, i.e., one with the same key, is already in flight, in which
+    case its output is shared instead.
+
+    There is no background thread: whichever subscriber needs the next chunk first fetches it from upstream, while the
+    others wait for it. The upstream stream is closed once all of its subscribers have stopped.
+
+    Args:
+        key: The canonical key of the request.
+        it_fn: The function that sends the request and returns its stream.
+        replay: Whether a subscriber that joins late receives all the earlier chunks, or only the latest chunk. The
+          latter suits the streams whose every chunk holds the full response so far. Without replay, only the latest
+          chunk is kept, and a subscriber that falls behind skips to it. This is decided by the first subscriber.
+        share_fn: The function to apply to the chunks received from a request started by another subscriber, e.g., to
+          copy the objects that the subscriber may modify.
+    """
+    with _flights_lock:
+        flight = _flights.get(key)
+        is_leader = flight is None
+        if is_leader:
+            flight = _Flight(it_fn, replay=replay)
+            _flights[key] = flight
+        with flight.cond:
+            flight.num_subscribers += 1
+            pos = 0 if (is_leader or flight.replay) else max(flight.offset + len(flight.chunks) - 1, 0)
+
+    def _fetch():
+        try:
+            if flight.it is None:
+                flight.it = flight.it_fn()
+            chunk = next(flight.it)
+            with flight.cond:
+                flight.chunks.append(chunk)
+                if not flight.replay:
+                    flight.offset += len(flight.chunks) - 1
+                    del flight.chunks[:-1]
+        except StopIteration:
+            with flight.cond:
+                flight.done = True
+        except BaseException as e:
+            with flight.cond:
+                flight.done, flight.error = True, e
+        finally:
+            with flight.cond:
+                flight.pulling = False
+                flight.cond.notify_all()
+                done = flight.done
+            if done:
+                _remove(key, flight)
+
+    try:
+        while True:
+            with flight.cond:
+                while (pos >= flight.offset + len(flight.chunks)) and (not flight.done) and flight.pulling:
+                    flight.cond.wait()
+                pos = max(pos, flight.offset)
+                if pos < flight.offset + len(flight.chunks):
+                    chunk, fetch = flight.chunks[pos - flight.offset], False
+                    pos += 1
+                elif flight.done:
+                    if flight.error is not None:
+                        raise flight.error
+                    return
+                else:
+                    flight.pulling, fetch = True, True
+            if fetch:
+                _fetch()
+                continue
+            yield chunk if (is_leader or share_fn is None) else share_fn(chunk)
+    finally:
+        with _flights_lock:
+            with flight.cond:
+                flight.num_subscribers -= 1
+                abandoned = (flight.num_subscribers == 0) and (not flight.done)
+            if abandoned and (_flights.get(key) is flight):
+                del _flights[key]
+        if abandoned:
+            # Nobody is fetching from upstream at this point, since the last subscriber has stopped.
+            close_iterator(flight.it)
+
+
+def single_flight_call(key: str, fn: Callable[[], Any], share_fn: Optional[Callable[[Any], Any]] = None) -> Any:
+    """The same as `single_flight_stream`, for a request that returns its whole output at once."""
+    *_, output = single_flight_stream(key, lambda: iter([fn()]), share_fn=share_fn)
+    return output
+
+
+def _remove(key: str, flight: _Flight):
+    with _flights_lock:
+        if _flights.get(key) is flight:
+            del _flights[key]
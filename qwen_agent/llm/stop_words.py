@@ -0,0 +1,133 @@
+from collections import deque
+from typing import Dict, List, Sequence, Tuple
+
+from qwen_agent.utils.tokenization_qwen import tokenizer
+
+
+class StopWordMatcher:
+    """A precompiled Aho-Corasick automaton for a fixed set of stop words.
+
+    The automaton locates the stop words of a streamed response in one pass over the newly arrived characters, no
+    matter how many stop words there are (see `StopWordScanner`). A match is reported as soon as a stop word is
+    complete, which is where the model service itself would have stopped generating. The partial stop words, i.e.,
+    the prefixes of a stop word that a streamed response may end with before the full stop word arrives, are
+    computed once here as well.
+    """
+
+    def __init__(self, stop: Sequence[str]):
+        self.stop: Tuple[str, ...] = tuple(s for s in stop if s)
+
+        # State 0 is the root. _out[state] is the length of the longest stop word ending at this state, or 0.
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._out: List[int] = [0]
+        for s in self.stop:
+            state = 0
+            for c in s:
+                if c not in self._goto[state]:
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append(0)
+                    self._goto[state][c] = len(self._goto) - 1
+                state = self._goto[state][c]
+            self._out[state] = max(self._out[state], len(s))
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for c, nxt in self._goto[state].items():
+                queue.append(nxt)
+                f = self._fail[state]
+                while f and (c not in self._goto[f]):
+                    f = self._fail[f]
+                self._fail[nxt] = self._goto[f].get(c, 0)
+                self._out[nxt] = max(self._out[nxt], self._out[self._fail[nxt]])
+
+        # It may end with partial stop word 'Observation' when the full stop word is 'Observation:'.
+        partial_stop = []
+        for s in self.stop:
+            s = tokenizer.tokenize(s)[:-1]
+            if s:
+                s = tokenizer.convert_tokens_to_string(s)
+                partial_stop.append(s)
+        self.partial_stop: Tuple[str, ...] = tuple(sorted(set(partial_stop)))
+
+    def scan(self, text: str, start: int = 0, state: int = 0) -> Tuple[int, int]:
+        """Feed text[start:] into the automaton, starting from the given state.
+
+        Returns:
+            The start of the first completed stop word (or -1 if none), and the automaton state to resume from.
+        """
+        if not self.stop:
+            return -1, 0
+        goto, fail, out = self._goto, self._fail, self._out
+        for i in range(start, len(text)):
+            c = text[i]
+            while state and (c not in goto[state]):
+                state = fail[state]
+            state = goto[state].get(c, 0)
+            if out[state]:
+                return i - out[state] + 1, state
+        return -1, state
+
+    def find(self, text: str) -> int:
+        """Return the start of the stop word that completes first in the whole text, or -1 if there is none.
+
+        This agrees with `scan`, but one C-level `str.find` per stop word is much faster than the per-character
+        automaton when the whole text is searched at once.
+        """
+        best_start, best_end = -1, len(text)
+        for s in self.stop:
+            # Only an occurrence that ends no later than the best one so far can replace it
+            k = text.find(s, 0, best_end)
+            if k < 0:
+                continue
+            end = k + len(s)
+            if (best_start < 0) or (end < best_end) or (k < best_start):
+                best_start, best_end = k, end
+        return best_start
+
+    def truncate(self, text: str) -> Tuple[bool, str]:
+        k = self.find(text)
+        if k >= 0:
+            return True, text[:k]
+        return False, text
+
+    def remove_partial_stop(self, text: str) -> str:
+        new_text = text
+        for s in self.partial_stop:
+            if text.endswith(s):
+                new_text = text[:-len(s)]
+        return new_text
+
+    def new_scanner(self) -> 'StopWordScanner':
+        return StopWordScanner(self)
+
+
+class StopWordScanner:
+    """Incremental stop word search over the texts of one streamed response, with the automaton of the matcher.
+
+    When streaming with `delta_stream=False`, every chunk carries the full response generated so far. The scanner
+    keeps the automaton state reached at the end of each text, and only feeds in the newly arrived characters.
+    """
+
+    def __init__(self, matcher: StopWordMatcher):
+        self.matcher = matcher
+        self._scanned: Dict[Tuple[int, int], Tuple[str, int, int]] = {}  # (msg_idx, item_idx) -> (text, state, pos)
+
+    def find(self, text: str, key: Tuple[int, int] = (0, 0)) -> int:
+        prev = self._scanned.get(key)
+        if (prev is not None) and text.startswith(prev[0]):
+            prev_text, state, pos = prev
+            if pos >= 0:
+                return pos
+            pos, state = self.matcher.scan(text, start=len(prev_text), state=state)
+        else:
+            pos, state = self.matcher.scan(text)
+        self._scanned[key] = (text, state, pos)
+        return pos
+
+    def truncate(self, text: str, key: Tuple[int, int] = (0, 0)) -> Tuple[bool, str]:
+        k = self.find(text, key=key)
+        if k >= 0:
+            return True, text[:k]
+        return False, text
@@ -0,0 +1,114 @@
+import contextvars
+import threading
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional
+
+from qwen_agent.llm.schema import Message
+
+
+def normalize_usage(usage: Any) -> Optional[Dict[str, Optional[int]]]:
+    """Convert the token usage reported by a model service, e.g., OpenAI's or DashScope's, into a dict of
+    prompt_tokens, completion_tokens, total_tokens and cached_tokens. cached_tokens is None if the model service does
+    not report it."""
+    if not usage:
+        return None
+    prompt_tokens = _get(usage, 'prompt_tokens') or _get(usage, 'input_tokens') or 0
+    completion_tokens = _get(usage, 'completion_tokens') or _get(usage, 'output_tokens') or 0
+    cached_tokens = _get(_get(usage, 'prompt_tokens_details'), 'cached_tokens')
+    return {
+        'prompt_tokens': prompt_tokens,
+        'completion_tokens': completion_tokens,
+        'total_tokens': _get(usage, 'total_tokens') or (prompt_tokens + completion_tokens),
+        'cached_tokens': cached_tokens,
+    }
+
+
+def cache_hit_ratio(prompt_tokens: int, cached_tokens: Optional[int]) -> Optional[float]:
+    """The fraction of the prompt tokens served by the prefix cache of the model service, e.g., vLLM's automatic prefix
+    caching or DashScope's context cache, if the model service reports it."""
+    if (cached_tokens is None) or (not prompt_tokens):
+        return None
+    return cached_tokens / prompt_tokens
+
+
+def get_usage(messages: List[Message]) -> Optional[Dict[str, int]]:
+    """The usage of the LLM call that produced the messages, which is kept in `Message.extra['usage']`."""
+    for msg in messages:
+        if msg.extra and msg.extra.get('usage'):
+            return msg.extra['usage']
+    return None
+
+
+def _get(obj: Any, key: str) -> Any:
+    if obj is None:
+        return None
+    if isinstance(obj, dict):
+        return obj.get(key)
+    return getattr(obj, key, None)
+
+
+class UsageTracker:
+    """The total token usage of the LLM calls made in a `track_usage` block.
+
+    cached_tokens and cache_hit_ratio only cover the calls whose model service reports the cached tokens, and are None
+    if there are no such calls.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.num_calls = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.total_tokens = 0
+        self.cached_tokens: Optional[int] = None
+        self._cache_reported_prompt_tokens = 0  # The prompt tokens of the calls that report the cached tokens
+
+    def add(self, usage: Dict[str, Optional[int]]):
+        with self._lock:
+            self.num_calls += 1
+            self.prompt_tokens += usage.get('prompt_tokens', 0)
+            self.completion_tokens += usage.get('completion_tokens', 0)
+            self.total_tokens += usage.get('total_tokens', 0)
+            if usage.get('cached_tokens') is not None:
+                self.cached_tokens = (self.cached_tokens or 0) + usage['cached_tokens']
+                self._cache_reported_prompt_tokens += usage.get('prompt_tokens', 0)
+
+    def as_dict(self) -> Dict[str, Optional[int]]:
+        with self._lock:
+            return {
+                'num_calls': self.num_calls,
+                'prompt_tokens': self.prompt_tokens,
+                'completion_tokens': self.completion_tokens,
+                'total_tokens': self.total_tokens,
+                'cached_tokens': self.cached_tokens,
+                'cache_hit_ratio': cache_hit_ratio(self._cache_reported_prompt_tokens, self.cached_tokens),
+            }
+
+
+# The trackers of the enclosing `track_usage` blocks, outermost first
+_active_trackers: contextvars.ContextVar = contextvars.ContextVar('qwen_agent_usage_trackers', default=())
+
+
+@contextmanager
+def track_usage() -> Iterator[UsageTracker]:
+    """Sum up the token usage of all the LLM calls made in the block, including the nested calls made by agents,
+    tools and memory. For example:
+
+        with track_usage() as usage:
+            *_, responses = agent.run(messages)
+        print(usage.as_dict())
+
+    The blocks can be nested, and the threads started by the agents inherit the trackers.
+    """
+    tracker = UsageTracker()
+    token = _active_trackers.set(_active_trackers.get() + (tracker,))
+    try:
+        yield tracker
+    finally:
+        _active_trackers.reset(token)
+
+
+def record_usage(usage: Optional[Dict[str, Optional[int]]]):
+    if usage:
+        for tracker in _active_trackers.get():
+            tracker.add(usage)
@@ -2,8 +2,6 @@ import json
 from importlib import import_module
 from typing import Dict, Iterator, List, Optional, Union
 
-import json5
-
 from qwen_agent import Agent
 from qwen_agent.llm import BaseChatModel
 from qwen_agent.llm.schema import ASSISTANT, DEFAULT_SYSTEM_MESSAGE, USER, Message
@@ -12,7 +10,7 @@ from qwen_agent.settings import (DEFAULT_MAX_REF_TOKEN, DEFAULT_PARSER_PAGE_SIZE
                                  DEFAULT_RAG_SEARCHERS)
 from qwen_agent.tools import BaseTool
 from qwen_agent.tools.simple_doc_parser import PARSER_SUPPORTED_FILE_TYPES
-from qwen_agent.utils.utils import extract_files_from_messages, extract_text_from_message, get_file_type
+from qwen_agent.utils.utils import extract_files_from_messages, extract_text_from_message, get_file_type, json_loads
 
 
 class Memory(Agent):
@@ -109,7 +107,7 @@ class Memory(Agent):
                 if keyword.endswith('```'):
                     keyword = keyword[:-3]
                 try:
-                    keyword_dict = json5.loads(keyword)
+                    keyword_dict = json_loads(keyword)
                     if 'text' not in keyword_dict:
                         keyword_dict['text'] = query
                     query = json.dumps(keyword_dict, ensure_ascii=False)
@@ -6,8 +6,25 @@ from typing import List, Literal
 DEFAULT_MAX_INPUT_TOKENS: int = int(os.getenv(
     'QWEN_AGENT_DEFAULT_MAX_INPUT_TOKENS', 58000))  # The LLM will truncate the input messages if they exceed this limit
 
+# The number of token counts of message texts memoized for truncating the input messages
+TOKEN_COUNT_CACHE_SIZE: int = int(os.getenv('QWEN_AGENT_TOKEN_COUNT_CACHE_SIZE', 10000))
+
+# Check that the input messages are not modified in place by agents and LLMs, which share rather than deep-copy the
+# conversation history. Only meant for debugging, since it serializes the history on every step.
+DEBUG_MESSAGE_MUTATION: bool = os.getenv('QWEN_AGENT_DEBUG_MESSAGE_MUTATION', '0').strip().lower() in ('1', 'true')
+# Let the agents created with the same dict `llm` share one LLM object, see get_shared_chat_model
+SHARE_LLM_INSTANCES: bool = os.getenv('QWEN_AGENT_SHARE_LLM_INSTANCES', '1').strip().lower() in ('1', 'true')
+
 # Settings for agents
 MAX_LLM_CALL_PER_RUN: int = int(os.getenv('QWEN_AGENT_MAX_LLM_CALL_PER_RUN', 20))
+MAX_PARALLEL_TOOL_CALLS: int = int(os.getenv('QWEN_AGENT_MAX_PARALLEL_TOOL_CALLS',
+                                             8))  # The tool calls of one turn to run concurrently, 1 to disable
+# Start a tool call as soon as it is complete in the streamed LLM output, instead of after the whole output
+EAGER_TOOL_CALLS: bool = os.getenv('QWEN_AGENT_EAGER_TOOL_CALLS', '0').strip().lower() in ('1', 'true')
+# The layout of the prompt of Assistant. With 'prefix_cache', the retrieved knowledge is put into the latest user
+# message instead of the system message, so that the system message and the tool schemas, followed by the history, form
+# a prefix that stays the same across turns, which the prefix caches of the model services can reuse.
+PROMPT_LAYOUT: Literal['default', 'prefix_cache'] = os.getenv('QWEN_AGENT_PROMPT_LAYOUT', 'default')
 
 # Settings for tools
 DEFAULT_WORKSPACE: str = os.getenv('QWEN_AGENT_DEFAULT_WORKSPACE', 'workspace')
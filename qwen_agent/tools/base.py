@@ -175,6 +175,15 @@ class BaseTool(ABC):
     def file_access(self) -> bool:
         return False
 
+    @property
+    def thread_safe(self) -> bool:
+        """Whether this tool can be called concurrently with the other tool calls of the same turn.
+
+        Tools that keep state across calls, e.g., a shared interpreter, should return False, or be configured with
+        {'thread_safe': False}, so that the calls to them run one by one.
+        """
+        return self.cfg.get('thread_safe', True)
+
 
 class BaseToolWithFileAccess(BaseTool, ABC):
 
@@ -9,12 +9,11 @@ from contextlib import redirect_stdout
 from functools import partial
 from typing import Any, Dict, List, Optional, Union
 
-import json5
 import regex
 from tqdm import tqdm
 
 from qwen_agent.tools.base import BaseTool
-from qwen_agent.utils.utils import extract_code
+from qwen_agent.utils.utils import extract_code, json_loads
 
 
 class GenericRuntime:
@@ -103,9 +102,14 @@ class PythonExecutor(BaseTool):
         self.pool = Pool(multiprocess.cpu_count())
         self.timeout_length = timeout_length
 
+    @property
+    def thread_safe(self) -> bool:
+        # All the calls of this instance share one runtime
+        return self.cfg.get('thread_safe', False)
+
     def call(self, params: Union[str, dict], **kwargs) -> list:
         try:
-            params = json5.loads(params)
+            params = json_loads(params)
             code = params['code']
         except Exception:
             code = extract_code(params)
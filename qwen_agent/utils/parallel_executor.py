@@ -1,3 +1,4 @@
+import contextvars
 import random
 import time
 from concurrent.futures import ThreadPoolExecutor, as_completed
@@ -32,7 +33,8 @@ def parallel_exec(
         # Get the tasks for the current chunk
         futures = []
         for kwargs in list_of_kwargs:
-            futures.append(executor.submit(fn, **kwargs))
+            # Run in a copy of the caller's context, e.g., to count the token usage of the LLM calls made by fn
+            futures.append(executor.submit(contextvars.copy_context().run, fn, **kwargs))
             if jitter > 0.0:
                 time.sleep(jitter * random.random())
         for future in as_completed(futures):
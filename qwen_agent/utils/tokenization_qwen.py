@@ -1,13 +1,16 @@
 """Tokenization classes for QWen."""
 
 import base64
+import threading
 import unicodedata
+from collections import OrderedDict
 from pathlib import Path
 from typing import Collection, Dict, List, Set, Union
 
 import tiktoken
 
 from qwen_agent.log import logger
+from qwen_agent.settings import TOKEN_COUNT_CACHE_SIZE
 
 VOCAB_FILES_NAMES = {'vocab_file': 'qwen.tiktoken'}
 
@@ -230,3 +233,29 @@ tokenizer = QWenTokenizer(Path(__file__).resolve().parent / 'qwen.tiktoken')
 
 def count_tokens(text: str) -> int:
     return tokenizer.count_tokens(text)
+
+
+# Keyed by the text itself, so that the dict compares the texts on a hit and a hash collision cannot return the count
+# of another text. The cache holds on to at most TOKEN_COUNT_CACHE_SIZE texts.
+_token_count_cache: 'OrderedDict[str, int]' = OrderedDict()
+_token_count_cache_lock = threading.Lock()
+
+
+def count_tokens_cached(text: str) -> int:
+    """Same as count_tokens, but memoized in a process-wide LRU cache.
+
+    This is meant for texts that are counted over and over again, such as the conversation history, which is
+    re-counted on every LLM call. A cache hit still hashes and compares the text, which is linear in its length when
+    the text is a newly built string, but that is much cheaper than tokenizing it.
+    """
+    with _token_count_cache_lock:
+        cnt = _token_count_cache.get(text)
+        if cnt is not None:
+            _token_count_cache.move_to_end(text)
+            return cnt
+    cnt = tokenizer.count_tokens(text)
+    with _token_count_cache_lock:
+        _token_count_cache[text] = cnt
+        while len(_token_count_cache) > TOKEN_COUNT_CACHE_SIZE:
+            _token_count_cache.popitem(last=False)
+    return cnt
@@ -8,11 +8,12 @@ import shutil
 import signal
 import socket
 import sys
+import threading
 import time
 import traceback
 import urllib.parse
 from io import BytesIO
-from typing import Any, List, Literal, Optional, Tuple, Union
+from typing import Any, Dict, List, Literal, Optional, Tuple, Union
 
 import json5
 import requests
@@ -274,26 +275,120 @@ def extract_code(text: str) -> str:
         text = triple_match.group(1)
     else:
         try:
-            text = json5.loads(text)['code']
+            text = json_loads(text)['code']
         except Exception:
             print_traceback(is_error=False)
     # If no code blocks found, return original text
     return text
 
 
+# Number of attempts made at each tier of `json_loads`, and the number of texts that no tier could parse
+JSON_LOADS_STATS: Dict[str, int] = {'json': 0, 'repair': 0, 'json5': 0, 'failed': 0}
+_JSON_LOADS_STATS_LOCK = threading.Lock()
+
+
+def _count_json_loads(tier: str) -> None:
+    with _JSON_LOADS_STATS_LOCK:
+        JSON_LOADS_STATS[tier] += 1
+
+
+def get_json_loads_stats() -> Dict[str, int]:
+    with _JSON_LOADS_STATS_LOCK:
+        return dict(JSON_LOADS_STATS)
+
+
 def json_loads(text: str) -> dict:
+    """Parse model-generated JSON.
+
+    The C-accelerated `json` module is tried first. If it fails, a light repair pass fixes the defects commonly seen
+    in LLM outputs (see `repair_json`) and `json` is tried again. The slow pure-Python `json5` is the last resort.
+    """
     text = text.strip('\n')
     if text.startswith('```') and text.endswith('\n```'):
         text = '\n'.join(text.split('\n')[1:-1])
     try:
+        _count_json_loads('json')
         return json.loads(text)
     except json.decoder.JSONDecodeError as json_err:
         try:
+            _count_json_loads('repair')
+            return json.loads(repair_json(text))
+        except json.decoder.JSONDecodeError:
+            pass
+        try:
+            _count_json_loads('json5')
             return json5.loads(text)
         except ValueError:
+            _count_json_loads('failed')
             raise json_err
 
 
+def repair_json(text: str) -> str:
+    """Fix the common defects of LLM-generated JSON in a single pass.
+
+    This handles trailing commas, single-quoted strings, unescaped control characters (such as newlines in code)
+    inside strings, and truncated outputs with unclosed objects or arrays. Outputs truncated in the middle of a value
+    or right after a separator are not completed.
+    """
+    out = []
+    closers = []
+    quote = ''
+    escaped = False
+
+    def _rm_trailing_comma():
+        i = len(out) - 1
+        while i >= 0 and out[i] in ' \t\r\n':
+            i -= 1
+        if i >= 0 and out[i] == ',':
+            del out[i]
+
+    for c in text:
+        if quote:
+            if escaped:
+                escaped = False
+                if c == "'":  # \' is not a valid escape in JSON
+                    out[-1] = c
+                    continue
+            elif c == '\\':
+                escaped = True
+            elif c == quote:
+                c = '"'
+                quote = ''
+            elif c == '"':
+                c = '\\"'
+            elif c in _JSON_CONTROL_CHAR_ESCAPES:
+                c = _JSON_CONTROL_CHAR_ESCAPES[c]
+            out.append(c)
+        elif c in '"\'':
+            quote = c
+            out.append('"')
+        elif c in '{[':
+            closers.append('}' if c == '{' else ']')
+            out.append(c)
+        elif c in '}]':
+            _rm_trailing_comma()
+            if closers:
+                closers.pop()
+            out.append(c)
+        else:
+            out.append(c)
+
+    # Complete the truncated output, but only when it ends right after a complete value. A value that was cut off in
+    # the middle, or an output that ends after a `,` or `:` and so is missing its next value, is left unclosed, so that
+    # the truncated arguments are rejected instead of being used.
+    if quote:
+        return ''.join(out)
+    if closers and ''.join(out).rstrip()[-1:] not in ('"', ']', '}'):
+        return ''.join(out)
+    while closers:
+        _rm_trailing_comma()
+        out.append(closers.pop())
+    return ''.join(out)
+
+
+_JSON_CONTROL_CHAR_ESCAPES = {'\n': '\\n', '\r': '\\r', '\t': '\\t'}
+
+
 class PydanticJSONEncoder(json.JSONEncoder):
 
     def default(self, obj):
@@ -310,6 +405,45 @@ def json_dumps_compact(obj: dict, ensure_ascii=False, indent=None, **kwargs) ->
     return json.dumps(obj, ensure_ascii=ensure_ascii, indent=indent, cls=PydanticJSONEncoder, **kwargs)
 
 
+class CancellationToken:
+    """A flag for stopping a running agent from another thread, e.g., from the stop handler of a server.
+
+    Pass it to `Agent.run(messages, cancel_token=token)`. After `token.cancel()` is called, the run stops at its next
+    step and closes the LLM streams and the HTTP requests that are still open.
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+
+    def cancel(self) -> None:
+        self._event.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+
+def close_iterator(it: Any) -> None:
+    """Close a generator, or any iterator with a `close` method, so that it can release its resources right away."""
+    if hasattr(it, 'close'):
+        it.close()
+
+
+def snapshot_messages(messages: List[Union[Message, dict]]) -> List[dict]:
+    return [(Message(**msg) if isinstance(msg, dict) else msg).model_dump() for msg in messages]
+
+
+def check_messages_unchanged(messages: List[Union[Message, dict]], snapshot: List[dict], where: str):
+    """Raise an error if the messages differ from the snapshot taken by `snapshot_messages`.
+
+    Agents and LLMs share the conversation history with their callers instead of deep-copying it, and must copy a
+    message before modifying it. This check is enabled by setting QWEN_AGENT_DEBUG_MESSAGE_MUTATION=1.
+    """
+    if snapshot_messages(messages) != snapshot:
+        raise RuntimeError(f'The input messages have been modified in place by {where}. '
+                           'Please copy a message with `Message.shallow_copy` before modifying it.')
+
+
 def format_as_multimodal_message(
     msg: Message,
     add_upload_info: bool,
@@ -321,7 +455,7 @@ def format_as_multimodal_message(
     content: List[ContentItem] = []
     if isinstance(msg.content, str):  # if text content
         if msg.content:
-            content = [ContentItem(text=msg.content)]
+            content = [ContentItem.fast_construct(text=msg.content)]
     elif isinstance(msg.content, list):  # if multimodal content
         files = []
         for item in msg.content:
@@ -388,15 +522,15 @@ def format_as_multimodal_message(
                     upload_info_already_added = True
 
             if not upload_info_already_added:
-                content = [ContentItem(text=upload)] + content
+                content = [ContentItem.fast_construct(text=upload)] + content
     else:
         raise TypeError
-    msg = Message(role=msg.role,
-                  content=content,
-                  reasoning_content=msg.reasoning_content,
-                  name=msg.name if msg.role == FUNCTION else None,
-                  function_call=msg.function_call,
-                  extra=msg.extra)
+    msg = Message.fast_construct(role=msg.role,
+                                 content=content,
+                                 reasoning_content=msg.reasoning_content,
+                                 name=msg.name if msg.role == FUNCTION else None,
+                                 function_call=msg.function_call,
+                                 extra=msg.extra)
     return msg
 
 
@@ -66,3 +66,46 @@ def test_assistant_vl():
     *_, last = agent.run(messages)
 
     assert len(last[-1].content) > 0
+
+
+def test_assistant_prefix_cache_layout():
+    from qwen_agent.llm.function_calling import BaseFnCallModel
+    from qwen_agent.tools.base import BaseTool
+
+    class RecordingModel(BaseFnCallModel):
+
+        def __init__(self):
+            super().__init__({'model': 'fake'})
+            self.requests = []
+
+        def _chat_stream(self, messages, delta_stream, generate_cfg):
+            self.requests.append(messages)
+            yield [Message('assistant', 'OK.')]
+
+        def _chat_no_stream(self, messages, generate_cfg):
+            raise NotImplementedError
+
+    class Lookup(BaseTool):
+        name = 'lookup'
+        description = 'Look up a word.'
+        parameters = [{'name': 'word', 'type': 'string', 'required': True}]
+
+        def call(self, params, **kwargs):
+            return ''
+
+    llm = RecordingModel()
+    agent = Assistant(llm=llm, system_message='Be brief.', function_list=[Lookup()])
+    agent.prompt_layout = 'prefix_cache'
+
+    history = [Message('user', 'What is A?')]
+    *_, rsp = agent.run(history, knowledge='A is the first letter.')
+    history = history + rsp + [Message('user', 'What is B?')]
+    *_, rsp = agent.run(history, knowledge='B is the second letter.')
+
+    first, second = llm.requests
+    # The system message with the tool schemas, and the history, are the same prefix in both requests
+    assert first[0] == second[0]
+    assert 'lookup' in str(first[0].content) and ('letter' not in str(first[0].content))
+    # The knowledge is put into the latest question
+    assert 'B is the second letter.' in str(second[-1].content)
+    assert 'A is the first letter.' not in str(second)
@@ -0,0 +1,134 @@
+import threading
+import time
+
+from qwen_agent.agents import FnCallAgent
+from qwen_agent.llm.function_calling import BaseFnCallModel
+from qwen_agent.llm.schema import ASSISTANT, FUNCTION, USER, Message
+from qwen_agent.tools.base import BaseTool
+from qwen_agent.utils.utils import CancellationToken
+
+
+class SlowTool(BaseTool):
+    description = 'A tool that takes a while.'
+    parameters = [{'name': 'x', 'type': 'string', 'required': True}]
+
+    def __init__(self, name: str, cfg: dict = None, delay: float = 0.2):
+        self.name = name
+        super().__init__(cfg)
+        self.delay = delay
+        self.threads = []
+        self.start_times = []
+
+    def call(self, params: str, **kwargs) -> str:
+        self.threads.append(threading.current_thread())
+        self.start_times.append(time.time())
+        time.sleep(self.delay)
+        return f'{self.name}: {self._verify_json_format_args(params)["x"]}'
+
+
+def test_call_tools_concurrently_in_order():
+    tools = [SlowTool('a'), SlowTool('b'), SlowTool('c', cfg={'thread_safe': False})]
+    agent = FnCallAgent(function_list=tools, llm={'model': 'qwen-max', 'model_type': 'qwen_dashscope'})
+    tool_calls = [('a', '{"x": "1"}'), ('c', '{"x": "2"}'), ('b', '{"x": "3"}'), ('c', '{"x": "4"}')]
+
+    t0 = time.time()
+    results = list(agent._call_tools(tool_calls, messages=[]))
+    assert time.time() - t0 < 0.7  # a and b overlap with the two calls to c, which run one by one
+
+    assert results == [('a', 'a: 1'), ('c', 'c: 2'), ('b', 'b: 3'), ('c', 'c: 4')]
+    assert tools[2].threads == [threading.current_thread()] * 2
+    assert tools[0].threads[0] is not threading.current_thread()
+
+
+def test_close_call_tools_without_waiting():
+    tools = [SlowTool('a'), SlowTool('b', delay=2)]
+    agent = FnCallAgent(function_list=tools, llm={'model': 'qwen-max', 'model_type': 'qwen_dashscope'})
+
+    t0 = time.time()
+    results = agent._call_tools([('a', '{"x": "1"}'), ('b', '{"x": "2"}')], messages=[])
+    assert next(results) == ('a', 'a: 1')
+    results.close()  # The call to b, which is still running, is abandoned
+    assert time.time() - t0 < 1
+
+
+class StreamingFnCallModel(BaseFnCallModel):
+    """Streams two tool calls in the Nous format, slowly."""
+
+    def __init__(self):
+        super().__init__({'model': 'fake', 'generate_cfg': {'fncall_prompt_type': 'nous'}})
+        self.num_calls = 0
+        self.end_time = None
+
+    def _chat_stream(self, messages, delta_stream, generate_cfg):
+        self.num_calls += 1
+        if self.num_calls > 1:
+            yield [Message(ASSISTANT, 'Done.')]
+            return
+        text = ''
+        for name in ('a', 'b'):
+            text += f'<tool_call>\n{{"name": "{name}", "arguments": {{"x": "{name}"}}}}\n</tool_call>\n'
+            yield [Message(ASSISTANT, text)]
+            time.sleep(0.2)
+        self.end_time = time.time()
+
+    def _chat_no_stream(self, messages, generate_cfg):
+        raise NotImplementedError
+
+
+def test_eager_tool_calls():
+    tools = [SlowTool('a'), SlowTool('b')]
+    llm = StreamingFnCallModel()
+    agent = FnCallAgent(function_list=tools, llm=llm)
+    agent.eager_tool_calls = True
+
+    *_, last = agent.run([Message(USER, 'hi')])
+    assert [m.function_call.name for m in last if m.function_call] == ['a', 'b']
+    assert [m.content for m in last if m.role == FUNCTION] == ['a: a', 'b: b']
+    assert last[-1].content == 'Done.'
+    # The call to `a` is complete before `b` is generated, and started before the stream ends
+    assert tools[0].start_times[0] < llm.end_time
+
+
+class EndlessModel(BaseFnCallModel):
+    """Streams text until the consumer stops reading."""
+
+    def __init__(self):
+        super().__init__({'model': 'fake'})
+        self.closed = False
+
+    def _chat_stream(self, messages, delta_stream, generate_cfg):
+        text = ''
+        try:
+            while True:
+                text += 'la '
+                yield [Message(ASSISTANT, text)]
+        finally:
+            self.closed = True
+
+    def _chat_no_stream(self, messages, generate_cfg):
+        raise NotImplementedError
+
+
+def test_close_run():
+    llm = EndlessModel()
+    agent = FnCallAgent(llm=llm)
+
+    rsp_iter = agent.run([Message(USER, 'hi')])
+    next(rsp_iter)
+    assert not llm.closed
+    rsp_iter.close()
+    assert llm.closed
+
+
+def test_cancel_run():
+    llm = EndlessModel()
+    agent = FnCallAgent(llm=llm)
+    cancel_token = CancellationToken()
+
+    num_responses = 0
+    for _ in agent.run([Message(USER, 'hi')], cancel_token=cancel_token):
+        num_responses += 1
+        if num_responses == 3:
+            cancel_token.cancel()
+    assert num_responses == 3
+    assert llm.closed
@@ -88,3 +88,42 @@ def test_llm_retry_failure(stream, delta_stream):
         response = llm.chat(messages=messages, stream=stream, delta_stream=delta_stream)
         if stream:
             list(response)
+
+
+@pytest.mark.parametrize('service_info', ['summary', 'final', 'none'])
+def test_service_info_retention(service_info):
+    from dashscope.api_entities.dashscope_response import DashScopeAPIResponse, GenerationResponse
+
+    from qwen_agent.llm.qwen_dashscope import QwenChatAtDS
+
+    def _chunk(content, finish_reason):
+        return GenerationResponse.from_api_response(
+            DashScopeAPIResponse(status_code=200,
+                                 request_id='req-1',
+                                 output={
+                                     'choices': [{
+                                         'finish_reason': finish_reason,
+                                         'message': {
+                                             'role': 'assistant',
+                                             'content': content
+                                         }
+                                     }]
+                                 },
+                                 usage={
+                                     'input_tokens': 5,
+                                     'output_tokens': len(content)
+                                 }))
+
+    chunks = [_chunk('Hel', 'null'), _chunk('lo', 'stop')]
+    outputs = list(QwenChatAtDS._full_stream_output(iter(chunks), service_info=service_info))
+
+    assert outputs[-1][-1].content == 'Hello'
+    assert outputs[-1][-1].extra['usage']['completion_tokens'] == 2
+    info = [rsp[-1].extra.get('model_service_info') for rsp in outputs]
+    final_info = {'request_id': 'req-1', 'status_code': 200, 'finish_reason': 'stop'}
+    if service_info == 'summary':
+        assert info == [{'request_id': 'req-1', 'status_code': 200, 'finish_reason': None}, final_info]
+    elif service_info == 'final':
+        assert info == [None, final_info]
+    else:
+        assert info == [None, None]
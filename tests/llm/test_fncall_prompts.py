@@ -0,0 +1,85 @@
+import pytest
+
+from qwen_agent.llm.fncall_prompts.nous_fncall_prompt import NousFnCallPrompt
+from qwen_agent.llm.fncall_prompts.qwen_fncall_prompt import FN_ARGS, FN_NAME, QwenFnCallPrompt
+from qwen_agent.llm.schema import ASSISTANT, FUNCTION, SYSTEM, USER, ContentItem, FunctionCall, Message
+from qwen_agent.utils.utils import check_messages_unchanged, snapshot_messages
+
+NOUS_RESPONSE = ('Let me check.\n<tool_call>\n{"name": "get_weather", "arguments": {"location": "SF"}}\n</tool_call>\n'
+                 '<tool_call>\n{"name": "get_time", "arguments": {"tz": "PST"}}\n</tool_call>\n<tool_response>')
+
+QWEN_RESPONSE = (f'I will call.\n{FN_NAME}: get_weather\n{FN_ARGS}: {{"location": "SF"}}\n'
+                 f'{FN_NAME}: get_time\n{FN_ARGS}: {{"tz": "PST"}}')
+
+
+def _stream(fncall_prompt, response: str, **kwargs):
+    stream_state = {}
+    for i in range(1, len(response) + 1):
+        messages = [Message(ASSISTANT, [ContentItem(text=response[:i])])]
+        streamed = fncall_prompt.postprocess_fncall_messages(messages, stream_state=stream_state, **kwargs)
+        full = fncall_prompt.postprocess_fncall_messages(messages, **kwargs)
+        assert [m.model_dump() for m in streamed] == [m.model_dump() for m in full]
+        yield response[:i], streamed
+
+
+def test_nous_incremental_parse():
+    first_call = None
+    for text, output in _stream(NousFnCallPrompt(), NOUS_RESPONSE, parallel_function_calls=True):
+        fn_msgs = [m for m in output if m.function_call]
+        if first_call is None and '</tool_call>' in text:
+            first_call = fn_msgs[0].function_call
+        if first_call is not None:
+            # A completed tool call is parsed only once
+            assert fn_msgs[0].function_call is first_call
+    assert [m.function_call.name for m in output if m.function_call] == ['get_weather', 'get_time']
+    assert output[0].content[0].text == 'Let me check.\n'
+
+
+def test_qwen_incremental_parse():
+    for _, output in _stream(QwenFnCallPrompt(), QWEN_RESPONSE, parallel_function_calls=True):
+        pass
+    assert [m.function_call.name for m in output if m.function_call] == ['get_weather', 'get_time']
+    assert output[-1].function_call.arguments == '{"tz": "PST"}'
+
+
+@pytest.mark.parametrize('fncall_prompt,response', [(NousFnCallPrompt(), NOUS_RESPONSE),
+                                                    (QwenFnCallPrompt(), QWEN_RESPONSE)])
+def test_incremental_parse_does_not_modify_earlier_outputs(fncall_prompt, response):
+    stream_state = {}
+    messages = [Message(ASSISTANT, [ContentItem(text=response)], extra={'chunk': 1})]
+    first = fncall_prompt.postprocess_fncall_messages(messages, stream_state=stream_state)
+    messages = [Message(ASSISTANT, [ContentItem(text=response)], extra={'usage': {'total_tokens': 10}})]
+    second = fncall_prompt.postprocess_fncall_messages(messages, stream_state=stream_state)
+    assert [m.extra for m in first if m.function_call] == [{'chunk': 1}] * 2
+    assert [m.extra for m in second if m.function_call] == [{'usage': {'total_tokens': 10}}] * 2
+
+
+def test_nous_preprocess_does_not_modify_input():
+    messages = [
+        Message(SYSTEM, [ContentItem(text='sys')]),
+        Message(USER, [ContentItem(text='weather?')]),
+        Message(ASSISTANT, [ContentItem(text='Let me check.')], function_call=FunctionCall('get_weather', '{}')),
+        Message(FUNCTION, [ContentItem(text='sunny')], name='get_weather'),
+    ]
+    snapshot = snapshot_messages(messages)
+    functions = [{'name': 'get_weather', 'description': '', 'parameters': {}}]
+    NousFnCallPrompt().preprocess_fncall_messages(messages, functions=functions, lang='en')
+    check_messages_unchanged(messages, snapshot, where='NousFnCallPrompt.preprocess_fncall_messages')
+
+    messages[0].content[0].text = 'changed'
+    with pytest.raises(RuntimeError):
+        check_messages_unchanged(messages, snapshot, where='test')
+
+
+def test_tool_system_cache():
+    functions = [{'name': 'get_weather', 'description': 'Get the weather.', 'parameters': {'type': 'object'}}]
+    messages = [Message(USER, [ContentItem(text='weather?')])]
+    for fncall_prompt in (NousFnCallPrompt(), QwenFnCallPrompt()):
+        first = fncall_prompt.preprocess_fncall_messages(messages, functions=functions, lang='en')
+        second = fncall_prompt.preprocess_fncall_messages(messages, functions=functions, lang='en')
+        assert first[0].content[0].text is second[0].content[0].text
+
+        # Changing a tool invalidates the cached tool system prompt
+        new_functions = [{**functions[0], 'description': 'Get the current weather.'}]
+        third = fncall_prompt.preprocess_fncall_messages(messages, functions=new_functions, lang='en')
+        assert 'Get the current weather.' in third[0].content[0].text
@@ -0,0 +1,58 @@
+from qwen_agent.llm.function_calling import BaseFnCallModel
+from qwen_agent.llm.schema import ASSISTANT, USER, Message
+
+RESPONSE = ('<tool_call>\n{"name": "get_weather", "arguments": {"location": "SF"}}\n</tool_call>\n'
+            '<tool_call>\n{"name": "get_time", "arguments": {"tz": "PST"}}\n</tool_call>\n'
+            '<tool_response>\nIt is sunny in San Francisco.\n</tool_response>')
+RESPONSE_CHUNK_SIZE = 7
+NUM_RESPONSE_CHUNKS = (len(RESPONSE) + RESPONSE_CHUNK_SIZE - 1) // RESPONSE_CHUNK_SIZE
+
+FUNCTIONS = [
+    {
+        'name': 'get_weather',
+        'description': '',
+        'parameters': {}
+    },
+    {
+        'name': 'get_time',
+        'description': '',
+        'parameters': {}
+    },
+]
+
+
+class StreamingModel(BaseFnCallModel):
+
+    def __init__(self):
+        super().__init__({'model': 'fake', 'generate_cfg': {'fncall_prompt_type': 'nous'}})
+        self.num_chunks = 0
+        self.closed = False
+
+    def _chat_stream(self, messages, delta_stream, generate_cfg):
+        try:
+            for i in range(0, len(RESPONSE), RESPONSE_CHUNK_SIZE):
+                self.num_chunks += 1
+                yield [Message(ASSISTANT, RESPONSE[:i + RESPONSE_CHUNK_SIZE])]
+        finally:
+            self.closed = True
+
+    def _chat_no_stream(self, messages, generate_cfg):
+        raise NotImplementedError
+
+
+def test_stop_after_fncall():
+    # Stop when the model starts to make up a function result
+    llm = StreamingModel()
+    *_, last = llm.chat([Message(USER, 'hi')], functions=FUNCTIONS)
+    assert [m.function_call.name for m in last] == ['get_weather', 'get_time']
+    assert llm.closed
+    assert llm.num_chunks < NUM_RESPONSE_CHUNKS - 5
+
+    # Stop right after the first function call
+    llm = StreamingModel()
+    *_, last = llm.chat([Message(USER, 'hi')],
+                        functions=FUNCTIONS,
+                        extra_generate_cfg={'parallel_function_calls': False})
+    assert [m.function_call.name for m in last] == ['get_weather']
+    assert llm.closed
+    assert llm.num_chunks < NUM_RESPONSE_CHUNKS // 2
@@ -0,0 +1,58 @@
+import threading
+import time
+
+from qwen_agent.llm.function_calling import BaseFnCallModel
+from qwen_agent.llm.schema import ASSISTANT, USER, Message
+
+
+class SlowStartModel(BaseFnCallModel):
+    """The n-th request waits first_chunk_delays[n] seconds before streaming its reply."""
+
+    def __init__(self, first_chunk_delays, hedge_cfg):
+        super().__init__({'model': 'fake', 'generate_cfg': {'hedge': hedge_cfg}})
+        self.first_chunk_delays = first_chunk_delays
+        self.num_calls = 0
+        self.closed = []
+        self._lock = threading.Lock()
+
+    def _chat_stream(self, messages, delta_stream, generate_cfg):
+        with self._lock:
+            n = self.num_calls
+            self.num_calls += 1
+        try:
+            time.sleep(self.first_chunk_delays[n])
+            yield [Message(ASSISTANT, f'reply {n}')]
+            yield [Message(ASSISTANT, f'reply {n}, done')]
+        finally:
+            self.closed.append(n)
+
+    def _chat_no_stream(self, messages, generate_cfg):
+        raise NotImplementedError
+
+
+def test_hedged_request_wins():
+    llm = SlowStartModel(first_chunk_delays=[0.5, 0.0], hedge_cfg={'initial_delay': 0.1, 'budget': 1.0})
+
+    t0 = time.time()
+    *_, rsp = llm.chat([Message(USER, 'hi')])
+    assert time.time() - t0 < 0.4
+    assert rsp[-1].content == 'reply 1, done'
+    assert llm.hedge_policy.stats() == {
+        'num_requests': 1,
+        'num_hedged': 1,
+        'num_hedge_wins': 1,
+        'hedge_rate': 1.0,
+        'win_rate': 1.0,
+    }
+
+    time.sleep(0.6)
+    assert sorted(llm.closed) == [0, 1]  # The slow request is closed once it produces its first chunk
+
+
+def test_hedge_budget():
+    llm = SlowStartModel(first_chunk_delays=[0.3, 0.0], hedge_cfg={'initial_delay': 0.1, 'budget': 0.5})
+
+    *_, rsp = llm.chat([Message(USER, 'hi')])
+    assert rsp[-1].content == 'reply 0, done'
+    assert llm.num_calls == 1
+    assert llm.hedge_policy.stats()['num_hedged'] == 0
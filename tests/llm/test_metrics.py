@@ -0,0 +1,84 @@
+import time
+
+from qwen_agent.llm.function_calling import BaseFnCallModel
+from qwen_agent.llm.metrics import InMemoryMetricsSink, PrometheusMetricsSink, add_metrics_sink, remove_metrics_sink
+from qwen_agent.llm.schema import ASSISTANT, USER, Message
+
+
+class TimedModel(BaseFnCallModel):
+    """Streams three chunks, 0.2 seconds before the first one and 0.05 seconds apart."""
+
+    def __init__(self, generate_cfg=None):
+        super().__init__({'model': 'fake', 'model_type': 'timed', 'generate_cfg': generate_cfg or {}})
+
+    def _chat_stream(self, messages, delta_stream, generate_cfg):
+        time.sleep(0.2)
+        full_text = ''
+        for text in ('Hel', 'lo, ', 'world!'):
+            full_text += text
+            yield [Message(ASSISTANT, text if delta_stream else full_text)]
+            time.sleep(0.05)
+
+    def _chat_no_stream(self, messages, generate_cfg):
+        time.sleep(0.1)
+        return [Message(ASSISTANT, 'Hello, world!')]
+
+
+def test_stream_metrics():
+    sink = InMemoryMetricsSink()
+    add_metrics_sink(sink)
+    try:
+        *_, rsp = TimedModel().chat([Message(USER, 'hi')])
+    finally:
+        remove_metrics_sink(sink)
+
+    metrics = rsp[-1].extra['metrics']
+    assert list(sink.records) == [metrics]
+    assert metrics['model_type'] == 'timed' and metrics['stream']
+    assert metrics['num_chunks'] == 3
+    assert 0.2 <= metrics['ttft'] < 0.3
+    assert 0.05 <= metrics['itl_p50'] < 0.1
+    assert metrics['duration'] >= metrics['queue_time'] + metrics['ttft']
+    assert metrics['model_time'] >= 0.3
+    assert metrics['completion_tokens'] > 0
+    assert metrics['cached_tokens'] is None and metrics['cache_hit_ratio'] is None  # Not reported by the model
+
+
+def test_metrics_opt_in():
+    outputs = list(TimedModel().chat([Message(USER, 'hi')]))
+    assert len(outputs) == 3
+    assert not outputs[-1][-1].extra
+
+    llm = TimedModel(generate_cfg={'metrics': True})
+    rsp = llm.chat([Message(USER, 'hi')], stream=False)
+    assert 0.1 <= rsp[-1].extra['metrics']['ttft'] < 0.2
+    *_, rsp = llm.chat([Message(USER, 'hi')], stream=True, delta_stream=True)  # The metrics come last
+    assert rsp[-1].content == '' and rsp[-1].extra['metrics']['num_chunks'] == 3
+
+
+def test_metrics_of_stream_closed_early():
+    sink = InMemoryMetricsSink()
+    add_metrics_sink(sink)
+    try:
+        for delta_stream in (False, True):
+            for _ in TimedModel().chat([Message(USER, 'hi')], delta_stream=delta_stream):
+                break
+    finally:
+        remove_metrics_sink(sink)
+
+    assert len(sink.records) == 2
+    for metrics in sink.records:
+        assert metrics['num_chunks'] == 1
+        assert metrics['completion_tokens'] > 0
+
+
+def test_prometheus_sink():
+    sink = PrometheusMetricsSink()
+    sink.record({'model': 'fake', 'model_type': 'timed', 'queue_time': 0.01, 'ttft': 0.3, 'completion_tokens': 5})
+    sink.record({'model': 'fake', 'model_type': 'timed', 'queue_time': 0.01, 'ttft': 3.0, 'completion_tokens': 7})
+    text = sink.render()
+    assert 'qwen_agent_llm_ttft_seconds_bucket{model_type="timed",model="fake",le="0.5"} 1\n' in text
+    assert 'qwen_agent_llm_ttft_seconds_bucket{model_type="timed",model="fake",le="+Inf"} 2\n' in text
+    assert 'qwen_agent_llm_ttft_seconds_sum{model_type="timed",model="fake"} 3.3\n' in text
+    assert 'qwen_agent_llm_completion_tokens_total{model_type="timed",model="fake"} 12\n' in text
+    assert 'qwen_agent_llm_requests_total{model_type="timed",model="fake"} 2\n' in text
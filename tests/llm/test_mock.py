@@ -0,0 +1,83 @@
+import pytest
+
+from qwen_agent.agents import FnCallAgent
+from qwen_agent.llm import ModelServiceError, get_chat_model, track_usage
+from qwen_agent.llm.mock import filler_text, tokenize
+from qwen_agent.llm.schema import USER, Message
+from qwen_agent.tools.base import BaseTool
+
+
+class Weather(BaseTool):
+    name = 'get_weather'
+    description = 'Get the weather of a city.'
+    parameters = {'type': 'object', 'properties': {'city': {'type': 'string'}}, 'required': ['city']}
+
+    def call(self, params: str, **kwargs) -> str:
+        return f'Sunny in {self._verify_json_format_args(params)["city"]}.'
+
+
+@pytest.mark.parametrize('fncall_prompt_type', ['nous', 'qwen'])
+def test_mock_tool_calls(fncall_prompt_type):
+    llm = get_chat_model({
+        'model_type': 'mock',
+        'responses': [
+            {
+                'content': 'Let me check.',
+                'tool_calls': [{
+                    'name': 'get_weather',
+                    'arguments': {
+                        'city': 'Paris'
+                    }
+                }]
+            },
+            'Reply {call_index}.',
+        ],
+        'generate_cfg': {
+            'fncall_prompt_type': fncall_prompt_type
+        },
+    })
+    agent = FnCallAgent(function_list=[Weather()], llm=llm)
+    with track_usage() as usage:
+        *_, rsp = agent.run([Message(USER, 'Weather in Paris?')])
+
+    assert [(m.role, m.content.strip()) for m in rsp] == [
+        ('assistant', 'Let me check.'),
+        ('assistant', ''),
+        ('function', 'Sunny in Paris.'),
+        ('assistant', 'Reply 1.'),
+    ]
+    assert rsp[1].function_call.arguments == '{"city": "Paris"}'
+    assert usage.as_dict()['num_calls'] == 2
+
+
+def test_mock_timing_and_errors():
+    llm = get_chat_model({
+        'model_type': 'mock',
+        'response_tokens': 8,
+        'chunk_tokens': 2,
+        'ttft': 0.05,
+        'fail_first': 1,
+        'generate_cfg': {
+            'metrics': True
+        },
+    })
+    messages = [Message(USER, 'hi')]
+    with pytest.raises(ModelServiceError):
+        llm.chat(messages, stream=False)
+
+    chunks = list(llm.chat(messages, delta_stream=True))
+    assert ''.join(c[-1].content for c in chunks) == filler_text(8)
+    metrics = chunks[-1][-1].extra['metrics']
+    assert metrics['ttft'] >= 0.05
+    assert metrics['completion_tokens'] == 8 and metrics['num_chunks'] >= 4
+
+
+def test_mock_templated_response():
+    llm = get_chat_model({'model_type': 'mock', 'responses': ['You said: {last_user}']})
+    rsp = llm.chat([Message(USER, 'hi')], stream=False)
+    assert rsp[-1].content == 'You said: hi'
+    assert rsp[-1].extra['usage'] == {'prompt_tokens': 1, 'completion_tokens': 3, 'total_tokens': 4, 'cached_tokens': 0}
+
+
+def test_tokenize():
+    assert tokenize('Hello  world, 你好!\n') == ['Hello', '  world,', ' ', '你', '好', '!', '\n']
@@ -0,0 +1,97 @@
+from types import SimpleNamespace as NS
+
+from qwen_agent.agents import FnCallAgent
+from qwen_agent.llm import get_chat_model
+from qwen_agent.llm.schema import USER, Message
+from qwen_agent.tools.base import BaseTool
+
+
+class Weather(BaseTool):
+    name = 'get_weather'
+    description = 'Get the weather of a city.'
+    parameters = {'type': 'object', 'properties': {'city': {'type': 'string'}}, 'required': ['city']}
+
+    def call(self, params: str, **kwargs) -> str:
+        return f'Sunny in {self._verify_json_format_args(params)["city"]}.'
+
+
+def _chunk(content=None, tool_calls=None):
+    delta = NS(content=content, tool_calls=tool_calls)
+    return NS(choices=[NS(delta=delta)], usage=None)
+
+
+def _tool_call_delta(index, id=None, name=None, arguments=None):
+    return NS(index=index, id=id, function=NS(name=name, arguments=arguments))
+
+
+def test_native_tool_calls():
+    llm = get_chat_model({
+        'model': 'stub',
+        'model_server': 'http://127.0.0.1:1/v1',
+        'generate_cfg': {
+            'fncall_prompt_type': 'native'
+        }
+    })
+    requests = []
+
+    def _chat_complete_create(**kwargs):
+        requests.append(kwargs)
+        if len(requests) == 1:
+            return iter([
+                _chunk(content='Let me check.'),
+                _chunk(tool_calls=[_tool_call_delta(0, id='call_a', name='get_weather', arguments='{"city": ')]),
+                _chunk(tool_calls=[_tool_call_delta(0, arguments='"Paris"}')]),
+                _chunk(tool_calls=[_tool_call_delta(1, id='call_b', name='get_weather', arguments='{"city": "Rome"}')]),
+            ])
+        return iter([_chunk(content='Both are sunny.')])
+
+    llm._chat_complete_create = _chat_complete_create
+    agent = FnCallAgent(function_list=[Weather()], llm=llm)
+    *_, rsp = agent.run([Message(USER, 'Weather in Paris and Rome?')])
+
+    assert [(m.role, m.content, m.function_call and m.function_call.arguments) for m in rsp] == [
+        ('assistant', 'Let me check.', None),
+        ('assistant', '', '{"city": "Paris"}'),
+        ('assistant', '', '{"city": "Rome"}'),
+        ('function', 'Sunny in Paris.', None),
+        ('function', 'Sunny in Rome.', None),
+        ('assistant', 'Both are sunny.', None),
+    ]
+    assert rsp[1].extra['function_id'] == 'call_a'
+
+    # The functions are sent as tools, without any template in the prompt
+    assert requests[0]['tools'][0] == {'type': 'function', 'function': Weather().function}
+    assert '<tool_call>' not in str(requests[0]['messages'])
+    # The calls and their results are sent back in the format of the OpenAI API
+    assistant_msg, *tool_msgs = requests[1]['messages'][-3:]
+    assert assistant_msg['content'] == 'Let me check.'
+    assert assistant_msg['tool_calls'] == [
+        {
+            'id': 'call_a',
+            'type': 'function',
+            'function': {
+                'name': 'get_weather',
+                'arguments': '{"city": "Paris"}'
+            }
+        },
+        {
+            'id': 'call_b',
+            'type': 'function',
+            'function': {
+                'name': 'get_weather',
+                'arguments': '{"city": "Rome"}'
+            }
+        },
+    ]
+    assert tool_msgs == [
+        {
+            'role': 'tool',
+            'tool_call_id': 'call_a',
+            'content': 'Sunny in Paris.'
+        },
+        {
+            'role': 'tool',
+            'tool_call_id': 'call_b',
+            'content': 'Sunny in Rome.'
+        },
+    ]
@@ -0,0 +1,169 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from qwen_agent.llm import ModelServiceError, get_chat_model, track_usage
+from qwen_agent.llm.schema import USER, Message
+
+USAGE = {'prompt_tokens': 12, 'completion_tokens': 4, 'total_tokens': 16, 'prompt_tokens_details': {'cached_tokens': 8}}
+
+
+class StubOAIServer:
+    """A local model service that speaks just enough of the OpenAI chat completions API."""
+
+    def __init__(self, reply: str = 'Hello!', fail: bool = False):
+        self.reply = reply
+        self.fail = fail
+        self.num_requests = 0
+        self.last_request = None
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_POST(self):
+                stub.num_requests += 1
+                req = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                stub.last_request = req
+                if stub.fail:
+                    self._send(500, 'application/json', json.dumps({'error': {'message': 'boom'}}).encode())
+                elif req.get('stream'):
+                    chunks = [{'content': stub.reply[:3]}, {'content': stub.reply[3:]}]
+                    events = [_completion('chat.completion.chunk', delta=c) for c in chunks]
+                    if (req.get('stream_options') or {}).get('include_usage'):
+                        events.append(dict(_completion('chat.completion.chunk'), choices=[], usage=USAGE))
+                    body = ''.join('data: ' + json.dumps(e) + '\n\n' for e in events) + 'data: [DONE]\n\n'
+                    self._send(200, 'text/event-stream', body.encode())
+                else:
+                    message = {'role': 'assistant', 'content': stub.reply}
+                    self._send(200, 'application/json',
+                               json.dumps(dict(_completion('chat.completion', message=message), usage=USAGE)).encode())
+
+            def _send(self, status: int, content_type: str, body: bytes):
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.send_header('x-should-retry', 'false')  # Disable the retries of the openai client
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.httpd.server_address[1]}/v1'
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def _completion(obj: str, **choice) -> dict:
+    return {
+        'id': 'stub',
+        'object': obj,
+        'created': 0,
+        'model': 'stub',
+        'choices': [dict(index=0, finish_reason=None, **choice)],
+    }
+
+
+@pytest.fixture
+def servers():
+    servers = [StubOAIServer(reply='Hello from a!'), StubOAIServer(reply='Hello from b!')]
+    yield servers
+    for s in servers:
+        s.close()
+
+
+def test_oai_pool_least_outstanding(servers):
+    llm = get_chat_model({
+        'model': 'stub',
+        'model_type': 'oai_pool',
+        'model_servers': [s.url for s in servers],
+    })
+    messages = [Message(USER, 'hi')]
+
+    stream_a = llm.chat(messages)
+    stream_b = llm.chat(messages)
+    assert next(stream_a)[-1].content.startswith('Hel')
+    assert next(stream_b)[-1].content.startswith('Hel')
+    assert [s['in_flight'] for s in llm.endpoint_stats()] == [1, 1]
+
+    *_, rsp = stream_b
+    assert [s['in_flight'] for s in llm.endpoint_stats()] == [1, 0]
+    # The endpoint that is still busy is skipped, although it is the turn of the first endpoint
+    rsp = llm.chat(messages, stream=False)
+    assert rsp[-1].content == 'Hello from b!'
+    stream_a.close()
+    assert [s['in_flight'] for s in llm.endpoint_stats()] == [0, 0]
+    assert [s.num_requests for s in servers] == [1, 2]
+
+
+def test_oai_pool_failover(servers):
+    servers[0].fail = True
+    llm = get_chat_model({
+        'model': 'stub',
+        'model_type': 'oai_pool',
+        'model_servers': [s.url for s in servers],
+        'failure_threshold': 1,
+        'cooldown': 60,
+    })
+    messages = [Message(USER, 'hi')]
+
+    for _ in range(3):
+        *_, rsp = llm.chat(messages)
+        assert rsp[-1].content == 'Hello from b!'
+    # The failed endpoint is ejected after its first failure
+    assert servers[0].num_requests == 1
+    assert [s['healthy'] for s in llm.endpoint_stats()] == [False, True]
+
+    servers[1].fail = True
+    with pytest.raises(ModelServiceError):
+        llm.chat(messages, stream=False)
+
+
+def test_oai_stream_usage_opt_in(servers):
+    llm = get_chat_model({'model': 'stub', 'model_server': servers[0].url})
+    *_, rsp = llm.chat([Message(USER, 'hi')])
+    assert 'stream_options' not in servers[0].last_request
+    assert 'usage' not in (rsp[-1].extra or {})
+
+    assert get_chat_model({'model': 'gpt-4o-mini', 'model_type': 'oai'}).stream_usage
+    assert get_chat_model({
+        'model': 'qwen-max',
+        'model_type': 'oai',
+        'model_server': 'https://dashscope.aliyuncs.com/compatible-mode/v1',
+    }).stream_usage
+
+
+def test_oai_usage(servers):
+    llm = get_chat_model({
+        'model': 'stub',
+        'model_server': servers[0].url,
+        'generate_cfg': {
+            'stream_options': {
+                'include_usage': True
+            }
+        },
+    })
+    messages = [Message(USER, 'hi')]
+    expected = {'prompt_tokens': 12, 'completion_tokens': 4, 'total_tokens': 16, 'cached_tokens': 8}
+
+    with track_usage() as usage:
+        *_, rsp = llm.chat(messages)
+        assert rsp[-1].content == 'Hello from a!'
+        assert rsp[-1].extra['usage'] == expected
+        rsp = llm.chat(messages, stream=False)
+        assert rsp[-1].extra['usage'] == expected
+    assert usage.as_dict() == dict(num_calls=2,
+                                   prompt_tokens=24,
+                                   completion_tokens=8,
+                                   total_tokens=32,
+                                   cached_tokens=16,
+                                   cache_hit_ratio=16 / 24)
+
+    rsp = list(llm.quick_chat_oai([{'role': 'user', 'content': 'hi'}]))[-1]
+    assert rsp['usage']['prompt_tokens_details'] == {'cached_tokens': 8}
@@ -0,0 +1,100 @@
+import threading
+
+from qwen_agent.llm.openvino import IncrementalDecoder, KVCachePool, OpenVINO, StopSequenceChecker, _GenerateBatcher
+
+
+class CharTokenizer:
+    """One token per character, so that the tests run without transformers."""
+
+    def __init__(self):
+        self.num_decoded_tokens = 0
+
+    def encode(self, text):
+        return [ord(c) for c in text]
+
+    def decode(self, token_ids, skip_special_tokens=False):
+        self.num_decoded_tokens += len(token_ids)
+        return ''.join(chr(t) for t in token_ids)
+
+
+def test_stop_sequence_checker_decodes_tail_only():
+    tokenizer = CharTokenizer()
+    prompt = tokenizer.encode('Observation: in the prompt')
+    checker = StopSequenceChecker(['Observation:'], tokenizer, prompt_len=len(prompt))
+
+    token_ids = list(prompt)
+    for c in 'x' * 500:
+        token_ids.append(ord(c))
+        assert not checker.check(token_ids)
+    # The cost of each step is bounded by the window, not by the length of the output
+    assert tokenizer.num_decoded_tokens <= 500 * checker.window
+
+    for c in 'Observation:':
+        token_ids.append(ord(c))
+    assert checker.check(token_ids)
+
+
+def test_incremental_decoder():
+    tokenizer = CharTokenizer()
+    decoder = IncrementalDecoder(tokenizer)
+    pieces = [decoder.add(t) for t in tokenizer.encode('Hello wor')]
+    assert ''.join(pieces) == 'Hello '  # The incomplete word is held back
+    pieces = [decoder.add(t) for t in tokenizer.encode('ld\n你好')]
+    assert ''.join(pieces) == 'world\n你好'
+    assert decoder.flush() == ''
+
+
+def test_batched_generation():
+    llm = object.__new__(OpenVINO)
+    llm.tokenizer = CharTokenizer()
+    batches = []
+
+    def _generate_batch(requests):
+        batches.append([r.prompt for r in requests])
+        for r in requests:
+            for t in llm.tokenizer.encode(f'Reply to {r.prompt}'):
+                r.queue.put(t)
+
+    llm._generate_batch = _generate_batch
+    llm._batcher = _GenerateBatcher(llm, max_batch_size=4, batch_wait=1.0)
+    results = {}
+
+    def chat(prompt, generate_cfg):
+        *_, rsp = llm._chat_stream_batched(prompt, delta_stream=False, generate_cfg=generate_cfg)
+        results[prompt] = rsp[-1].content
+
+    cfg = {'stop': ['Observation:'], 'seed': 42}
+    threads = [
+        threading.Thread(target=chat, args=('a', dict(cfg))),
+        threading.Thread(target=chat, args=('b', dict(cfg, temperature=0.5))),
+        threading.Thread(target=chat, args=('c', dict(cfg, seed=1))),
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert results == {'a': 'Reply to a', 'b': 'Reply to b', 'c': 'Reply to c'}
+    # The requests with different sampling parameters do not share a generate call
+    assert sorted(sorted(b) for b in batches) == [['a', 'c'], ['b']]
+
+
+def test_kv_cache_pool():
+    pool = KVCachePool(max_bytes=100)
+    system = [1, 2, 3]
+    pool.put(system + [10, 11], past_key_values='turn 1', nbytes=40)
+    pool.put([7, 7], past_key_values='other', nbytes=40)
+
+    # The next call of the conversation reuses the cache of its history
+    assert pool.lookup(system + [10, 11, 12, 13]) == (5, 'turn 1')
+    assert pool.lookup([9]) == (0, None)
+
+    # The cache of the longer history supersedes the cache of its prefix
+    pool.put(system + [10, 11, 12, 13, 14], past_key_values='turn 2', nbytes=50)
+    assert len(pool) == 2 and pool.nbytes == 90
+
+    # The least recently used cache is evicted to stay within the bytes
+    pool.lookup([7])
+    pool.put([8], past_key_values='new', nbytes=30)
+    assert pool.lookup(system) == (0, None)
+    assert pool.lookup([7, 7]) == (2, 'other')
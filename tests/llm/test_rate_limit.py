@@ -0,0 +1,88 @@
+import asyncio
+import threading
+import time
+
+from qwen_agent.llm.function_calling import BaseFnCallModel
+from qwen_agent.llm.rate_limit import RateLimiter
+from qwen_agent.llm.schema import ASSISTANT, USER, Message
+
+
+def test_rpm():
+    limiter = RateLimiter(rpm=120, window=1)  # Two requests per second, and bursts of two requests
+
+    t0 = time.time()
+    for _ in range(4):
+        limiter.acquire()
+    assert 0.9 < time.time() - t0 < 1.3
+
+
+def test_tpm():
+    limiter = RateLimiter(tpm=600, window=1)  # Ten tokens per second, and bursts of ten tokens
+
+    t0 = time.time()
+    limiter.acquire(10)
+    assert time.time() - t0 < 0.1
+    limiter.acquire(5)
+    assert 0.4 < time.time() - t0 < 0.7
+    limiter.acquire(1000)  # More than the burst size, which must not block forever
+    assert time.time() - t0 < 1.9
+
+
+def test_fair_queuing():
+    limiter = RateLimiter(rpm=600, window=0.1)  # Ten requests per second, one at a time
+    limiter.acquire()
+    order = []
+
+    def _worker(i):
+        limiter.acquire()
+        order.append(i)
+
+    threads = []
+    for i in range(5):
+        threads.append(threading.Thread(target=_worker, args=(i,)))
+        threads[-1].start()
+        time.sleep(0.01)
+    for t in threads:
+        t.join()
+    assert order == [0, 1, 2, 3, 4]
+
+
+def test_async():
+    limiter = RateLimiter(rpm=120, window=1)
+
+    async def _main():
+        t0 = time.time()
+        await asyncio.gather(*[limiter.acquire_async() for _ in range(3)])
+        return time.time() - t0
+
+    assert 0.4 < asyncio.run(_main()) < 0.8
+
+
+class EchoModel(BaseFnCallModel):
+
+    def _chat_stream(self, messages, delta_stream, generate_cfg):
+        yield [Message(ASSISTANT, 'ok')]
+
+    def _chat_no_stream(self, messages, generate_cfg):
+        return [Message(ASSISTANT, 'ok')]
+
+
+def test_rate_limiter_shared_by_llms():
+    cfg = {
+        'model': 'echo',
+        'model_server': 'http://127.0.0.1:1/v1',
+        'generate_cfg': {
+            'rate_limit': {
+                'rpm': 120,
+                'window': 1,
+            }
+        }
+    }
+    llm1, llm2 = EchoModel(cfg), EchoModel(cfg)
+    assert llm1.rate_limiter is llm2.rate_limiter
+    assert 'rate_limit' not in llm1.generate_cfg
+
+    t0 = time.time()
+    for llm in (llm1, llm2, llm1):
+        llm.chat([Message(USER, 'hi')], stream=False)
+    assert 0.4 < time.time() - t0 < 0.8
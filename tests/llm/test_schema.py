@@ -0,0 +1,47 @@
+import copy
+
+from pydantic import BaseModel
+
+from qwen_agent.llm.schema import ContentItem, FunctionCall, Message
+
+MESSAGES = [
+    Message('user', 'hi'),
+    Message('assistant', [ContentItem(text='a'),
+                          ContentItem(image='x.png'),
+                          ContentItem(video=['a.jpg', 'b.jpg'])],
+            reasoning_content='think',
+            function_call=FunctionCall('f', '{}')),
+    Message('function', [ContentItem(audio={'data': 'x.wav'})], name='f', extra={'k': [1, {
+        'z': 2
+    }]}),
+    Message('assistant', None),
+]
+
+
+def test_fast_model_dump():
+    for msg in MESSAGES:
+        assert msg.model_dump() == BaseModel.model_dump(msg, exclude_none=True)
+        if isinstance(msg.content, list):
+            for item in msg.content:
+                assert item.model_dump() == BaseModel.model_dump(item, exclude_none=True)
+                assert item.get_type_and_value() == next(iter(item.model_dump().items()))
+
+
+def test_fast_construct():
+    for msg in MESSAGES:
+        fields = {
+            k: getattr(msg, k) for k in ('role', 'content', 'reasoning_content', 'name', 'function_call', 'extra')
+        }
+        new_msg = Message.fast_construct(**fields)
+        assert new_msg == msg
+        assert copy.deepcopy(new_msg) == msg
+        assert new_msg.model_dump_json() == msg.model_dump_json()
+
+
+def test_shallow_copy():
+    msg = MESSAGES[1]
+    new_msg = msg.shallow_copy()
+    new_msg.content.append(ContentItem(text='b'))
+    assert len(msg.content) == 3
+    assert new_msg.content[0] is msg.content[0]
+    assert msg.shallow_copy(name='x').model_dump() == {**msg.model_dump(), 'name': 'x'}
@@ -0,0 +1,27 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from qwen_agent.agents import Assistant, FnCallAgent
+from qwen_agent.llm import clear_shared_chat_models, get_shared_chat_model
+
+
+def test_agents_share_llm():
+    clear_shared_chat_models()
+    cfg = {'model': 'stub', 'model_server': 'http://127.0.0.1:1/v1', 'generate_cfg': {'top_p': 0.8}}
+    a = FnCallAgent(llm=dict(cfg))
+    b = Assistant(llm={'generate_cfg': {'top_p': 0.8}, 'model_server': 'http://127.0.0.1:1/v1', 'model': 'stub'})
+    assert a.llm is b.llm
+    assert a.mem.llm is a.llm
+
+    other = FnCallAgent(llm=dict(cfg, generate_cfg={'top_p': 0.5}))
+    assert other.llm is not a.llm
+
+    with ThreadPoolExecutor(4) as executor:
+        llms = list(
+            executor.map(get_shared_chat_model, [{
+                'model': 'stub',
+                'model_server': 'http://127.0.0.1:2/v1'
+            }] * 8))
+    assert all(llm is llms[0] for llm in llms)
+
+    clear_shared_chat_models()
+    assert FnCallAgent(llm=dict(cfg)).llm is not a.llm
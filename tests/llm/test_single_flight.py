@@ -0,0 +1,83 @@
+import threading
+import time
+
+from qwen_agent.llm.function_calling import BaseFnCallModel
+from qwen_agent.llm.schema import ASSISTANT, USER, Message
+from qwen_agent.llm.single_flight import _flights, single_flight_stream
+
+
+class CountingModel(BaseFnCallModel):
+
+    def __init__(self, cfg=None):
+        super().__init__(cfg or {'model': 'fake', 'generate_cfg': {'single_flight': True}})
+        self.num_calls = 0
+
+    def _chat_stream(self, messages, delta_stream, generate_cfg):
+        self.num_calls += 1
+        for text in ('a', 'ab', 'abc'):
+            time.sleep(0.1)
+            yield [Message(ASSISTANT, text)]
+
+    def _chat_no_stream(self, messages, generate_cfg):
+        self.num_calls += 1
+        time.sleep(0.2)
+        return [Message(ASSISTANT, 'abc')]
+
+
+def _run_concurrently(fn, n):
+    results = [None] * n
+
+    def _worker(i):
+        results[i] = fn()
+
+    threads = [threading.Thread(target=_worker, args=(i,)) for i in range(n)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+
+def test_single_flight_stream():
+    llm = CountingModel()
+    results = _run_concurrently(lambda: [rsp[-1].content for rsp in llm.chat([Message(USER, 'hi')])], n=4)
+    assert llm.num_calls == 1
+    for res in results:
+        assert res[-1] == 'abc'
+    # A different request is not coalesced
+    *_, rsp = llm.chat([Message(USER, 'hello')])
+    assert llm.num_calls == 2
+
+
+def test_single_flight_no_stream():
+    llm = CountingModel()
+    results = _run_concurrently(lambda: llm.chat([Message(USER, 'hi')], stream=False), n=4)
+    assert llm.num_calls == 1
+    assert [res[-1].content for res in results] == ['abc'] * 4
+    assert len(set(id(res[-1]) for res in results)) == 4  # Each caller gets its own messages
+
+
+def test_single_flight_subscriber_leaves():
+    llm = CountingModel()
+    stream1 = llm.chat([Message(USER, 'hi')])
+    stream2 = llm.chat([Message(USER, 'hi')])
+    assert next(stream1)[-1].content == 'a'
+    assert next(stream2)[-1].content == 'a'
+    stream1.close()
+    assert [rsp[-1].content for rsp in stream2] == ['ab', 'abc']
+    assert llm.num_calls == 1
+
+
+def test_single_flight_off_by_default():
+    llm = CountingModel({'model': 'fake'})
+    _run_concurrently(lambda: llm.chat([Message(USER, 'hi')], stream=False), n=2)
+    assert llm.num_calls == 2
+
+
+def test_single_flight_without_replay_keeps_latest_chunk():
+    stream1 = single_flight_stream('key', lambda: iter(['a', 'ab', 'abc']), replay=False)
+    assert [next(stream1), next(stream1)] == ['a', 'ab']
+    assert _flights['key'].chunks == ['ab']
+    stream2 = single_flight_stream('key', lambda: iter([]), replay=False)
+    assert list(stream2) == ['ab', 'abc']
+    assert list(stream1) == ['abc']
@@ -0,0 +1,63 @@
+import pytest
+
+from qwen_agent.llm.base import _postprocess_stop_words
+from qwen_agent.llm.schema import ASSISTANT, ContentItem, Message
+from qwen_agent.llm.stop_words import StopWordMatcher
+
+
+def _naive_truncate(text: str, stop: list):
+    truncated = False
+    for s in stop:
+        k = text.find(s)
+        if k >= 0:
+            truncated = True
+            text = text[:k]
+    return truncated, text
+
+
+@pytest.mark.parametrize('text', [
+    'Thought: I need to search.\nAction: search\nObservation: xxx',
+    'abcdef',
+    'no stop words here',
+    '✿RESULT✿ at the beginning',
+])
+def test_matcher_agrees_with_naive_truncation(text):
+    stop = ['Observation:', 'cd', 'abcdef', '✿RESULT✿', '✿RETURN✿']
+    assert StopWordMatcher(stop).truncate(text) == _naive_truncate(text, stop)
+
+
+def test_scanner_streaming():
+    stop = ['Observation:', 'cd', 'abcdef']
+    matcher = StopWordMatcher(stop)
+    full = 'Thought: ok\nAction: x\nabcdef Observation: y'
+    scanner = matcher.new_scanner()
+    for i in range(1, len(full) + 1):
+        # The scanner only searches the new characters but must agree with a full search.
+        assert scanner.truncate(full[:i]) == _naive_truncate(full[:i], stop)
+
+
+def test_scanner_reset_on_rewrite():
+    scanner = StopWordMatcher(['STOP']).new_scanner()
+    assert scanner.find('hello ST') == -1
+    assert scanner.find('STOP here') == 0
+
+
+def test_postprocess_stop_words_partial_stop():
+    matcher = StopWordMatcher(['Observation:'])
+    assert matcher.partial_stop == ('Observation',)
+    messages = [Message(ASSISTANT, [ContentItem(text='Action: search\nObservation')])]
+    messages = _postprocess_stop_words(messages, stop=['Observation:'], scanner=matcher.new_scanner())
+    assert messages[0].content[0].text == 'Action: search\n'
+
+
+def test_postprocess_stop_words_does_not_modify_input():
+    item = ContentItem(text='Action: search\nObservation: xxx')
+    messages = _postprocess_stop_words([Message(ASSISTANT, [item])], stop=['Observation:'])
+    assert messages[0].content[0].text == 'Action: search\n'
+    assert item.text == 'Action: search\nObservation: xxx'
+
+
+@pytest.mark.parametrize('text', ['xaabcd', 'abaab', 'bcab', 'aab', 'ccc', ''])
+def test_find_agrees_with_scan(text):
+    matcher = StopWordMatcher(['aab', 'ab', 'b', 'bcd', 'cd'])
+    assert matcher.find(text) == matcher.scan(text)[0]
@@ -0,0 +1,32 @@
+from qwen_agent.llm.base import _truncate_input_messages_roughly
+from qwen_agent.llm.schema import ASSISTANT, SYSTEM, USER, Message
+from qwen_agent.utils import tokenization_qwen
+
+
+def test_truncation_only_tokenizes_new_messages(monkeypatch):
+    counted = []
+    count_tokens = tokenization_qwen.tokenizer.count_tokens
+
+    def _count_tokens(text):
+        counted.append(text)
+        return count_tokens(text)
+
+    monkeypatch.setattr(tokenization_qwen.tokenizer, 'count_tokens', _count_tokens)
+
+    messages = [Message(SYSTEM, 'You are a helpful assistant. (test_truncation_only_tokenizes_new_messages)')]
+    for i in range(20):
+        messages.append(Message(USER, f'Question {i} of test_truncation_only_tokenizes_new_messages.'))
+        counted.clear()
+        new_messages = _truncate_input_messages_roughly(messages, max_tokens=100000)
+        assert len(new_messages) == len(messages)
+        assert len(counted) == 2  # Either the system message or the previous answer, and the new question
+        messages.append(Message(ASSISTANT, f'Answer {i}.'))
+    counted.clear()
+    _truncate_input_messages_roughly(messages, max_tokens=100000)
+    assert counted == ['Answer 19.']
+
+    # Counts are shared with the truncation under a smaller budget
+    counted.clear()
+    new_messages = _truncate_input_messages_roughly(messages, max_tokens=60)
+    assert len(new_messages) < len(messages)
+    assert not counted
@@ -0,0 +1,94 @@
+from qwen_agent.agents import FnCallAgent
+from qwen_agent.llm import track_usage
+from qwen_agent.llm.function_calling import BaseFnCallModel
+from qwen_agent.llm.schema import ASSISTANT, USER, Message
+from qwen_agent.llm.usage import normalize_usage, record_usage
+from qwen_agent.tools.base import BaseTool
+
+
+class UsageReportingModel(BaseFnCallModel):
+    """Calls the tool `ask` once, then answers. Every reply reports 10 prompt tokens and 2 completion tokens."""
+
+    def __init__(self):
+        super().__init__({'model': 'fake', 'generate_cfg': {'fncall_prompt_type': 'nous'}})
+        self.num_calls = 0
+
+    def _chat_stream(self, messages, delta_stream, generate_cfg):
+        self.num_calls += 1
+        if self.num_calls == 1:
+            text = '<tool_call>\n{"name": "ask", "arguments": {"q": "x"}}\n</tool_call>'
+        else:
+            text = 'Done.'
+        yield [Message(ASSISTANT, text[:3])]
+        yield [
+            Message(ASSISTANT, text, extra={'usage': normalize_usage({
+                'prompt_tokens': 10,
+                'completion_tokens': 2
+            })})
+        ]
+
+    def _chat_no_stream(self, messages, generate_cfg):
+        return [Message(ASSISTANT, 'Yes.', extra={'usage': normalize_usage({'input_tokens': 5, 'output_tokens': 1})})]
+
+
+class AskTool(BaseTool):
+    """A tool that makes an LLM call of its own."""
+    name = 'ask'
+    description = 'Ask a question.'
+    parameters = [{'name': 'q', 'type': 'string', 'required': True}]
+
+    def call(self, params: str, **kwargs) -> str:
+        return UsageReportingModel().chat([Message(USER, 'q')], stream=False)[-1].content
+
+
+def test_normalize_usage():
+    assert normalize_usage({
+        'prompt_tokens': 7,
+        'completion_tokens': 3,
+        'total_tokens': 10,
+        'prompt_tokens_details': {
+            'cached_tokens': 4
+        },
+    }) == {
+        'prompt_tokens': 7,
+        'completion_tokens': 3,
+        'total_tokens': 10,
+        'cached_tokens': 4,
+    }
+    assert normalize_usage({
+        'input_tokens': 7,
+        'output_tokens': 3
+    }) == {
+        'prompt_tokens': 7,
+        'completion_tokens': 3,
+        'total_tokens': 10,
+        'cached_tokens': None,  # The model service does not report it
+    }
+    assert normalize_usage(None) is None
+
+
+def test_track_usage_of_agent_run():
+    agent = FnCallAgent(function_list=[AskTool()], llm=UsageReportingModel())
+    with track_usage() as usage:
+        *_, last = agent.run([Message(USER, 'hi')])
+    assert last[-1].content == 'Done.'
+    assert last[-1].extra['usage']['prompt_tokens'] == 10
+    # Two calls by the agent, and one by the tool, which runs in a worker thread
+    assert usage.as_dict() == {
+        'num_calls': 3,
+        'prompt_tokens': 25,
+        'completion_tokens': 5,
+        'total_tokens': 30,
+        'cached_tokens': None,
+        'cache_hit_ratio': None,
+    }
+
+
+def test_cache_hit_ratio_of_reported_calls():
+    with track_usage() as usage:
+        record_usage(normalize_usage({'prompt_tokens': 10, 'completion_tokens': 1}))
+        assert usage.as_dict()['cache_hit_ratio'] is None
+        record_usage(normalize_usage({'prompt_tokens': 10, 'prompt_tokens_details': {'cached_tokens': 5}}))
+    # Only the calls that report the cached tokens are counted
+    assert usage.as_dict()['cached_tokens'] == 5
+    assert usage.as_dict()['cache_hit_ratio'] == 0.5
@@ -52,3 +52,13 @@ def test_storage_get_delete(operate):
     tool.call({'operate': operate, 'key': '345/456/11'})
 
     tool.call({'operate': operate, 'key': '/345/456/12'})
+
+
+def test_python_executor_truncated_code(monkeypatch):
+    from qwen_agent.tools.python_executor import PythonExecutor
+
+    tool = PythonExecutor()
+    executed = []
+    monkeypatch.setattr(tool, 'apply', lambda code: executed.append(code) or ['', ''])
+    tool.call('{"code": "for i in range(3):\\n    print(i')
+    assert 'for i in range(3):\n    print(i' not in executed
@@ -0,0 +1,55 @@
+import pytest
+
+from qwen_agent.utils.utils import get_json_loads_stats, json_loads, repair_json
+
+
+@pytest.mark.parametrize('text,expected', [
+    ('{"a": 1, "b": [1, 2,],}', {
+        'a': 1,
+        'b': [1, 2]
+    }),
+    ("{'code': 'print(\"hi\")'}", {
+        'code': 'print("hi")'
+    }),
+    ('{"code": "import os\nprint(os.getcwd())"}', {
+        'code': 'import os\nprint(os.getcwd())'
+    }),
+    ('{"query": "weather", "files": ["a.pdf", "b.pdf"', {
+        'query': 'weather',
+        'files': ['a.pdf', 'b.pdf']
+    }),
+    ('{"a": {"b": [1, 2]', {
+        'a': {
+            'b': [1, 2]
+        }
+    }),
+])
+def test_repair_json(text, expected):
+    assert json_loads(repair_json(text)) == expected
+
+
+@pytest.mark.parametrize('text', [
+    '{"code": "for i in range(3):\n    print(i',
+    '{"query": "weather", "files": ["a.pdf", "b.pd',
+    '{"a": [1, 2',
+    '{"a": [1, 2,',
+    '{"a": {"b": 1,',
+    '{"a": "x", "b":',
+])
+def test_repair_json_truncated_value(text):
+    with pytest.raises(ValueError):
+        json_loads(text)
+
+
+def test_json_loads_tiers():
+    before = get_json_loads_stats()
+    assert json_loads('{"a": 1}') == {'a': 1}
+    assert json_loads('{"a": 1,}') == {'a': 1}
+    assert json_loads('{a: 1}') == {'a': 1}  # unquoted keys are left to json5
+    with pytest.raises(ValueError):
+        json_loads('not json at all')
+    after = get_json_loads_stats()
+    assert after['json'] - before['json'] == 4
+    assert after['repair'] - before['repair'] == 3
+    assert after['json5'] - before['json5'] == 2
+    assert after['failed'] - before['failed'] == 1